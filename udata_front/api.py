@@ -2,9 +2,14 @@ from flask import current_app, make_response, abort
 
 import logging
 import requests
+from bson import ObjectId
 
 from udata.app import cache
 from udata.api import apiv2, API
+from udata.core.dataset.permissions import OwnablePermission
+from udata.harvest.models import HarvestJob
+
+from udata_front.models import HarvestItemRecord
 
 log = logging.getLogger(__name__)
 
@@ -73,3 +78,51 @@ class CaptchEtatAPI(API):
         resp = make_response(bytes(req.content))
         resp.headers['Content-Type'] = req.headers.get('Content-Type')
         return resp
+
+
+harvest_ns = apiv2.namespace('harvest', 'Harvest related operations')
+harvest_items_parser = apiv2.page_parser()
+harvest_items_parser.add_argument('status', type=str, location='args',
+                                  help='filter items by status (done, skipped, failed...)')
+
+
+@harvest_ns.route('/job/<string:ident>/items/', endpoint='harvest_job_items')
+class HarvestJobItemsAPI(API):
+    @apiv2.secure
+    @apiv2.expect(harvest_items_parser)
+    @apiv2.doc('harvest_job_items')
+    def get(self, ident):
+        '''List the items of a harvest job stored out of the job document'''
+        if not ObjectId.is_valid(ident):
+            abort(404, description='Unknown harvest job')
+        job = HarvestJob.objects(id=ident).only('id', 'data', 'source').first()
+        if not job:
+            abort(404, description='Unknown harvest job')
+        # Same scope as the source: its owner, its organization members or an admin
+        if not job.source or not OwnablePermission(job.source).can():
+            abort(403, description='Not allowed to read this harvest job')
+        args = harvest_items_parser.parse_args()
+        page = max(args['page'] or 1, 1)
+        page_size = max(min(args['page_size'] or 20, 100), 1)
+
+        query = {'job': job.id}
+        if args['status']:
+            query['status'] = args['status']
+        collection = HarvestItemRecord._get_collection()
+        cursor = (collection.find(query, {'job': 0})
+                  .sort('_id', 1)
+                  .skip((page - 1) * page_size)
+                  .limit(page_size))
+        return {
+            'data': [{
+                'id': str(item['_id']),
+                'remote_id': item.get('remote_id'),
+                'dataset': str(item['dataset']) if item.get('dataset') else None,
+                'status': item.get('status'),
+                'created': item['created'].isoformat() if item.get('created') else None,
+            } for item in cursor],
+            'page': page,
+            'page_size': page_size,
+            'total': collection.count_documents(query),
+            'summary': (job.data or {}).get('items', {}),
+        }
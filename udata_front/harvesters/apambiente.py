@@ -17,16 +17,27 @@ Usage:
 """
 
 from datetime import datetime
+import logging
 import requests
 from urllib.parse import urlparse, urlencode
 
-from udata.harvest.backends.base import BaseBackend
-from udata.models import Resource, Dataset, License
+from udata.harvest.backends.base import BaseBackend, HarvestFeature
+from udata.i18n import lazy_gettext as _
+from udata.models import Dataset, License
 from owslib.csw import CatalogueServiceWeb
 
 from udata.harvest.models import HarvestItem
 
+from .tools.csw_incremental import (
+    fall_back_to_full,
+    is_incremental,
+    modified_constraints,
+    start_incremental,
+)
 from .tools.harvester_utils import normalize_url_slashes
+from .tools.resource_diff import sync_resources
+
+log = logging.getLogger(__name__)
 
 # backend = 'https://sniambgeoportal.apambiente.pt/geoportal/csw'
 
@@ -40,6 +51,11 @@ class PortalAmbienteBackend(BaseBackend):
     """
 
     display_name = 'Harvester Portal do Ambiente'
+    features = (
+        HarvestFeature('incremental', _('Incremental harvest'),
+                       _('Only request records modified since the last harvest '
+                         '(with a full sweep every full_sweep_days days)')),
+    )
 
     def inner_harvest(self):
         """
@@ -51,14 +67,22 @@ class PortalAmbienteBackend(BaseBackend):
         Yields:
             None. Calls self.process_dataset for each harvested record.
         """
-        startposition = 0
+        start_incremental(self, self.has_feature('incremental'))
+        startposition = 1  # CSW is 1-based
         csw = CatalogueServiceWeb(self.source.url)
-        csw.getrecords2(maxrecords=1)
-        matches = csw.results.get("matches")
+        try:
+            csw.getrecords2(constraints=modified_constraints(self), maxrecords=1)
+        except Exception as e:
+            if not is_incremental(self):
+                raise
+            fall_back_to_full(self, e)
+            csw.getrecords2(maxrecords=1)
+        matches = int(csw.results.get("matches") or 0)
 
         while startposition <= matches:
-            csw.getrecords2(maxrecords=100, startposition=startposition)
-            startposition = csw.results.get('nextrecord')
+            csw.getrecords2(constraints=modified_constraints(self),
+                            maxrecords=100, startposition=startposition)
+            nextrecord = int(csw.results.get('nextrecord') or 0)
             for rec in csw.records:
                 item = {}
                 record = csw.records[rec]
@@ -70,6 +94,18 @@ class PortalAmbienteBackend(BaseBackend):
                 item["type"] = record.type
                 # Process the dataset (create or update in udata)
                 self.process_dataset(record.identifier, title=record.title, date=None, items=item)
+            # nextrecord is 0 after the last page
+            if nextrecord <= startposition:
+                break
+            startposition = nextrecord
+
+    def autoarchive(self):
+        # Unmodified records are not requested on incremental runs:
+        # deleted records are only detected by full sweeps
+        if is_incremental(self):
+            log.info('Incremental harvest: autoarchive skipped until the next full sweep')
+            return
+        return super().autoarchive()
 
     def inner_process_dataset(self, item: HarvestItem, **kwargs):
         """
@@ -104,9 +140,6 @@ class PortalAmbienteBackend(BaseBackend):
 
         dataset.description = item.get('description')
 
-        # Force recreation of all resources
-        dataset.resources = []
-
         url = item.get('url')
 
         # Determine resource format/type
@@ -117,13 +150,12 @@ class PortalAmbienteBackend(BaseBackend):
             if len(type) > 3:
                 type = "wms"
 
-        # Create and append the resource
-        new_resource = Resource(
-            title=dataset.title,
-            url=url,
-            filetype='remote',
-            format=type
-        )
-        dataset.resources.append(new_resource)
+        # Sync the resource (only written when added or changed)
+        sync_resources(dataset, [{
+            'title': dataset.title,
+            'url': url,
+            'filetype': 'remote',
+            'format': type
+        }])
 
         return dataset
@@ -5,8 +5,12 @@
 
 import json
 import logging
+import requests
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
 from uuid import UUID
 from urllib.parse import urljoin, urlparse
 
@@ -25,11 +29,11 @@ from udata.core.dataset.models import HarvestDatasetMetadata, HarvestResourceMet
 from udata.core.dataset.rdf import frequency_from_rdf
 from udata.frontend.markdown import parse_html
 from udata.models import (
-    db, Resource, License, SpatialCoverage, GeoZone, Organization
+    db, Resource, License, SpatialCoverage, GeoZone
 )
 from udata.utils import get_by, daterange_start, daterange_end, safe_unicode
 
-from udata.harvest.backends.base import BaseBackend, HarvestFilter
+from udata.harvest.backends.base import BaseBackend, HarvestFeature, HarvestFilter
 from udata.harvest.exceptions import HarvestException, HarvestSkipException
 
 from udata.harvest.filters import (
@@ -37,6 +41,9 @@ from udata.harvest.filters import (
     is_url, empty_none, hash
 )
 from .tools.harvester_utils import missing_datasets_warning, normalize_url_slashes
+from .tools.http_cache import HTTPValidatorCache
+from .tools.organization_resolver import OrganizationResolver
+from .tools.tag_normalizer import normalize_tags, with_tag_stats
 
 from .schemas.ckan import schema as ckan_schema
 from .schemas.dkan import schema as dkan_schema
@@ -54,10 +61,21 @@ class CkanPTBackend(BaseBackend):
                       _('A CKAN Organization name')),
         HarvestFilter(_('Tag'), 'tags', str, _('A CKAN tag name')),
     )
+    features = (
+        HarvestFeature('unpublish_missing', _('Unpublish missing datasets'),
+                       _('Whether datasets of the domain no longer listed by the source '
+                         'should be made private (full harvests only)')),
+    )
     schema = ckan_schema
 
     harvest_config = {}
 
+    # Concurrent package_show requests (source config: `concurrency`)
+    CONCURRENCY = 8
+    MAX_CONCURRENCY = 32
+    # Page size of package_search (CKAN caps `rows` at 1000 by default)
+    SEARCH_ROWS = 1000
+
     def __init__(self, source_or_job, dryrun=False, max_items=None):
         super(CkanPTBackend, self).__init__(source_or_job, dryrun=dryrun, max_items=max_items)
         try:
@@ -80,10 +98,12 @@ class CkanPTBackend(BaseBackend):
         path = '/'.join(['dataset', name])
         return urljoin(self.source.url, path)
 
-    def get_action(self, endpoint, fix=False, **kwargs):
+    def get_action(self, endpoint, fix=False, session=None, **kwargs):
         url = self.action_url(endpoint)
         if fix:
             response = self.post(url, '{}', params=kwargs)
+        elif session is not None:
+            response = session.get(url, params=kwargs)
         else:
             response = self.get(url, params=kwargs)
 
@@ -116,12 +136,110 @@ class CkanPTBackend(BaseBackend):
             msg = response.text.strip('"')
             raise HarvestException(msg)
 
+    def get_package_list(self):
+        '''
+        Fetch `package_list` with a conditional GET.
+
+        The listing is kept in the HTTP cache so that an unchanged list
+        (304) is not downloaded again. Datasets are still processed since
+        package contents may change without changing the list.
+        '''
+        url = self.action_url('package_list')
+        http_cache = HTTPValidatorCache.for_backend(self)
+
+        def get(url, headers=None, **kwargs):
+            headers = dict(self.get_headers(), **(headers or {}))
+            return requests.get(url, headers=headers, verify=self.verify_ssl, **kwargs)
+
+        response = http_cache.fetch(url, get=get, keep_body=True, force=self.dryrun)
+        if response.status_code == 304:
+            body = http_cache.body(url)
+        else:
+            response.raise_for_status()
+            body = response.content
+
+        data = json.loads(body)
+        if not data.get('success', False):
+            error = data.get('error')
+            if isinstance(error, dict):
+                error = error.get('message', 'Unknown error')
+            raise HarvestException(error)
+
+        if not self.dryrun:
+            http_cache.commit(url, body=body)
+        return data['result']
+
+    def get_concurrency(self):
+        try:
+            concurrency = int(self.config.get('concurrency', self.CONCURRENCY))
+        except (TypeError, ValueError):
+            concurrency = self.CONCURRENCY
+        return max(1, min(concurrency, self.MAX_CONCURRENCY))
+
+    def make_session(self, pool_size):
+        '''A `requests.Session` with a connection pool shared by the fetch threads'''
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(self.get_headers())
+        session.verify = self.verify_ssl
+        return session
+
+    def prefetch_packages(self, names):
+        '''
+        Fetch `package_show` for `names` with a bounded thread pool and
+        yield `(name, package)` in the order of `names`.
+
+        At most 2 requests per thread are in flight, so memory stays bounded.
+        A failed request yields its exception instead of the package, which
+        is raised when the item is processed (and the item marked as failed).
+        '''
+        concurrency = self.get_concurrency()
+        session = self.make_session(concurrency)
+
+        def fetch(name):
+            try:
+                return self.get_action('package_show', session=session, id=name)['result']
+            except Exception as e:
+                return e
+
+        pending = deque()
+        with session, ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for name in names:
+                pending.append((name, pool.submit(fetch, name)))
+                if len(pending) >= concurrency * 2:
+                    name, future = pending.popleft()
+                    yield name, future.result()
+            while pending:
+                name, future = pending.popleft()
+                yield name, future.result()
+
+    def search_packages(self, q, fix=False):
+        '''
+        Walk `package_search` results page by page (`start`/`rows`) until
+        `count` is reached and yield the full package dicts.
+        '''
+        start = 0
+        while True:
+            response = self.get_action('package_search', fix=fix, q=q,
+                                       rows=self.SEARCH_ROWS, start=start,
+                                       sort='name asc')
+            result = response['result']
+            packages = result['results']
+            yield from packages
+            start += len(packages)
+            if not packages or start >= result['count']:
+                break
+
     def get_status(self):
         url = urljoin(self.source.url, '/api/util/status')
         response = self.get(url)
         return response.json()
 
+    @with_tag_stats
     def inner_harvest(self):
+        self.organizations = OrganizationResolver(dryrun=self.dryrun)
 
         try:
             self.harvest_config = json.loads(safe_unicode(self.source.description))
@@ -146,20 +264,29 @@ class CkanPTBackend(BaseBackend):
                     param = '-' + param
                 params.append(param)
             q = ' AND '.join(params)
-            response = self.get_action('package_search', fix=fix, q=q, rows=1000)
-            names = [r['name'] for r in response['result']['results']]
+            # Search results hold the full packages: no package_show needed
+            packages = self.search_packages(q, fix=fix)
+            if self.max_items:
+                packages = islice(packages, self.max_items)
+            for package in packages:
+                self.process_dataset(package['name'], package=package)
         else:
-            response = self.get_action('package_list', fix=fix)
-            names = response['result']
-        if self.max_items:
-            names = names[:self.max_items]
-        for name in names:
-            #self.add_item(name)
-            self.process_dataset(name)
-
-    def inner_process_dataset(self, item: HarvestItem):
-        response = self.get_action('package_show', id=item.remote_id)
-        data = self.validate(response['result'], self.schema)
+            names = self.get_package_list()
+            if self.max_items:
+                names = names[:self.max_items]
+            for name, package in self.prefetch_packages(names):
+                self.process_dataset(name, package=package)
+
+        # Check if datasets removed in origin, only when the whole source was listed
+        if self.has_feature('unpublish_missing') and not (self.dryrun or filters or self.max_items):
+            missing_datasets_warning(job_items=self.job.items, source=self.source)
+
+    def inner_process_dataset(self, item: HarvestItem, package=None):
+        if package is None:
+            package = self.get_action('package_show', id=item.remote_id)['result']
+        elif isinstance(package, Exception):
+            raise package
+        data = self.validate(package, self.schema)
 
         if type(data) == list:
             data = data[0]
@@ -181,20 +308,16 @@ class CkanPTBackend(BaseBackend):
         dataset.description = parse_html(data['notes'])
 
         # Detect Org
-        organization_acronym = data['organization']['name']
-        orgObj = Organization.objects(acronym=organization_acronym).first()
-        if orgObj:
-            #print 'Found %s' % orgObj.acronym
-            dataset.organization = orgObj
-        else:
-            orgObj = Organization()
-            orgObj.acronym = organization_acronym
-            orgObj.name = data['organization']['title']
-            orgObj.description = data['organization']['description']
-            orgObj.save()
-            #print 'Created %s' % orgObj.acronym
-
-            dataset.organization = orgObj
+        organization = data['organization']
+        if organization:
+            org = self.organizations.get_or_create(
+                organization['name'],
+                name=organization['title'],
+                description=organization['description'],
+            )
+            # None in dryrun when the organization does not exist yet
+            if org is not None:
+                dataset.organization = org
 
 
         # Detect license
@@ -203,7 +326,7 @@ class CkanPTBackend(BaseBackend):
                                         data['license_title'],
                                         default=default_license)
 
-        dataset.tags = [t['name'] for t in data['tags'] if t['name']]
+        dataset.tags = normalize_tags(t['name'] for t in data['tags'] if t['name'])
 
 
         dataset.tags.append(urlparse(self.source.url).hostname)
@@ -328,10 +451,3 @@ class CkanPTBackend(BaseBackend):
                         dataset.resources.remove(resource)
 
         return dataset
-
-    def finalize(self):
-        super(CkanPTBackend, self).finalize()
-
-        # Check if datasets removed in origin
-        if not self.dryrun:
-            missing_datasets_warning(job_items=self.job.items, source=self.source)
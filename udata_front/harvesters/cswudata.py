@@ -14,20 +14,38 @@ Usage:
 """
 
 import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
-from udata.harvest.backends.base import BaseBackend
-from udata.models import Resource, Dataset, License, SpatialCoverage
+from udata.harvest.backends.base import BaseBackend, HarvestFeature
+from udata.i18n import lazy_gettext as _
+from udata.models import Dataset, License, SpatialCoverage
 from owslib.csw import CatalogueServiceWeb
 
 from udata.harvest.models import HarvestItem
-from udata.harvest.exceptions import HarvestException
+from udata.harvest.exceptions import HarvestException, HarvestSkipException
 from udata.harvest.filters import (
     to_date,
-    normalize_tag,
     normalize_string,
 )
 
+from .tools.csw_incremental import (
+    fall_back_to_full,
+    is_incremental,
+    modified_constraints,
+    start_incremental,
+)
+from .tools.harvester_utils import (
+    HARVEST_FINGERPRINT_KEY,
+    skip_if_unchanged,
+    stored_extras,
+)
+from .tools.resource_diff import sync_resources
+from .tools.tag_normalizer import normalize_tags, with_tag_stats
+
 log = logging.getLogger(__name__)
 
 
@@ -42,10 +60,39 @@ class CSWUdataBackend(BaseBackend):
 
     display_name = "CSW Harvester"
 
+    # Version of the payload -> dataset mapping: bump it whenever the mapping
+    # changes so that datasets with an unchanged payload are mapped again
+    MAPPING_VERSION = 2
+
+    PAGE_SIZE = 100
+    # Pages fetched concurrently (overridable with the `concurrency` config key)
+    CONCURRENCY = 4
+    MAX_CONCURRENCY = 16
+    # Identifiers per GetRecordById request in two-pass mode
+    RECORD_BATCH_SIZE = 50
+    features = (
+        HarvestFeature(
+            "incremental",
+            _("Incremental harvest"),
+            _("Only request records modified since the last harvest "
+              "(with a full sweep every full_sweep_days days)"),
+        ),
+        HarvestFeature(
+            "two_pass",
+            _("Two-pass harvest"),
+            _("List modification dates first and only download full records "
+              "of new or modified datasets (requires GetRecordById with "
+              "several identifiers)"),
+        ),
+    )
+
+    @with_tag_stats
     def inner_harvest(self):
         """
         Iterates over CSW records and adds them to the harvest job.
         """
+        start_incremental(self, self.has_feature("incremental"))
+
         # base_url should be something like ".../srv/eng/csw"
         base_url = self.source.url
 
@@ -64,7 +111,36 @@ class CSWUdataBackend(BaseBackend):
             log.warning(f"Failed to resolve CSW endpoint URL, using original: {e}")
             pass
 
-        page_size = 100
+        csw = self.make_client(base_url)
+
+        # First request to get matches and validate endpoint
+        try:
+            csw.getrecords2(
+                constraints=modified_constraints(self), maxrecords=1, esn="full"
+            )
+        except Exception as e:
+            if not is_incremental(self):
+                raise
+            fall_back_to_full(self, e)
+            csw.getrecords2(maxrecords=1, esn="full")
+        matches = int(csw.results.get("matches", 0) or 0)
+        log.info(f"Found {matches} records in CSW endpoint")
+
+        if self.has_feature("two_pass"):
+            return self.harvest_two_pass(base_url, matches, csw)
+
+        for record in self.iter_records(base_url, matches, csw):
+            data = self.record_data(record)
+            self.process_dataset(data["id"], items=data)
+
+            if self.has_reached_max_items():
+                log.info("Reached maximum items limit")
+                return
+
+    def make_client(self, base_url):
+        """
+        Build an OWSLib client for `base_url` (one GetCapabilities request).
+        """
         # Set a generous timeout for the CSW client as government servers can be slow
         csw = CatalogueServiceWeb(base_url, timeout=60)
 
@@ -76,61 +152,209 @@ class CSWUdataBackend(BaseBackend):
                 for method in op.methods:
                     if method.get("url", "").startswith("http://"):
                         method["url"] = method["url"].replace("http://", "https://", 1)
+        return csw
 
-        # First request to get matches and validate endpoint
-        csw.getrecords2(maxrecords=1, esn="full")
-        matches = int(csw.results.get("matches", 0) or 0)
-        log.info(f"Found {matches} records in CSW endpoint")
+    def get_concurrency(self):
+        try:
+            concurrency = int(self.config.get("concurrency", self.CONCURRENCY))
+        except (TypeError, ValueError):
+            concurrency = self.CONCURRENCY
+        return max(1, min(concurrency, self.MAX_CONCURRENCY))
 
-        startposition = 1  # CSW is 1-based
-        while matches > 0 and startposition <= matches:
-            csw.getrecords2(
-                maxrecords=page_size, startposition=startposition, esn="full"
-            )
-            nextrecord = int(csw.results.get("nextrecord", 0) or 0)
-            log.debug(
-                f"Processing records {startposition} to {startposition + len(csw.records) - 1}"
-            )
+    def _iter_fetched(self, base_url, tasks, fetch, csw=None):
+        """
+        Run `fetch(client, task)` for each task and yield the returned records,
+        in the order of `tasks`.
+
+        Tasks run concurrently. OWSLib clients are not thread safe, so each
+        worker thread builds its own client (`csw` is reused by the harvest
+        thread when it runs alone). Results are consumed in submission order,
+        at most `concurrency` tasks ahead of the one being processed, so the
+        harvest stays deterministic and memory bounded.
+        A failed request raises and fails the harvest.
+        """
+        tasks = deque(tasks)
+        if not tasks:
+            return
+        concurrency = min(self.get_concurrency(), len(tasks))
+        clients = threading.local()
+
+        def run(task):
+            client = getattr(clients, "csw", None)
+            if client is None:
+                client = clients.csw = self.make_client(base_url)
+            return fetch(client, task)
+
+        if concurrency == 1 and csw is not None:
+            clients.csw = csw
+            for task in tasks:
+                yield from run(task)
+            return
 
-            for rec_id, record in csw.records.items():
-                resources = []
-
-                # CSW records use 'uris' field for resources, not 'references'
-                uris = getattr(record, "uris", None)
-                if uris:
-                    for uri in uris:
-                        if isinstance(uri, dict) and uri.get("url"):
-                            resources.append(uri)
-
-                # Fallback to references if uris is not available
-                if not resources:
-                    refs = getattr(record, "references", None)
-                    if refs:
-                        for ref in refs:
-                            if isinstance(ref, dict) and ref.get("url"):
-                                resources.append(ref)
-
-                data = {
-                    "id": record.identifier,
-                    "title": getattr(record, "title", "") or "",
-                    "description": getattr(record, "abstract", "") or "",
-                    "tags": getattr(record, "subjects", []) or [],
-                    "bbox": getattr(record, "bbox", None),
-                    "resources": resources,
-                    "type": getattr(record, "type", None),
-                    "created": getattr(record, "created", None),
-                    "modified": getattr(record, "modified", None),
-                }
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            try:
+                while tasks or pending:
+                    while tasks and len(pending) < concurrency:
+                        pending.append(pool.submit(run, tasks.popleft()))
+                    yield from pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def iter_records(self, base_url, matches, csw=None, esn="full"):
+        """
+        Yield the records of the `matches` results, in catalogue order.
+
+        The first page is requested alone: servers may cap `maxrecords`
+        below `PAGE_SIZE`, so the number of records it returns gives the
+        page size of the remaining pages, which are then requested
+        concurrently by `startposition`. A page returning fewer records than
+        requested is completed with follow-up requests.
+        """
+        if matches <= 0:
+            return
+        if self.max_items:
+            matches = min(matches, self.max_items)
+        constraints = modified_constraints(self)
+
+        def fetch(client, window):
+            startposition, count = window
+            records = []
+            while len(records) < count:
+                position = startposition + len(records)
+                client.getrecords2(
+                    constraints=constraints,
+                    maxrecords=count - len(records),
+                    startposition=position,
+                    esn=esn,
+                )
+                page = list(client.records.values())
+                if not page:
+                    log.warning(
+                        f"No records returned from position {position}, "
+                        f"{count - len(records)} records missing"
+                    )
+                    break
+                records.extend(page[:count - len(records)])
+                log.debug(f"Fetched records {position} to {position + len(page) - 1}")
+            return records
+
+        # CSW is 1-based
+        if csw is None:
+            csw = self.make_client(base_url)
+        csw.getrecords2(
+            constraints=constraints,
+            maxrecords=min(self.PAGE_SIZE, matches),
+            startposition=1,
+            esn=esn,
+        )
+        first = list(csw.records.values())[:matches]
+        yield from first
+        if not first:
+            return
+        page_size = len(first)
+        windows = [
+            (startposition, min(page_size, matches - startposition + 1))
+            for startposition in range(1 + page_size, matches + 1, page_size)
+        ]
+        yield from self._iter_fetched(base_url, windows, fetch, csw)
+
+    def iter_records_by_id(self, base_url, identifiers, csw=None):
+        """
+        Yield `(identifier, record)` for `identifiers`, in order, fetching
+        full records with `GetRecordById` in batches of `RECORD_BATCH_SIZE`.
+        `record` is None when the catalogue did not return it.
+        """
+        batch_size = self.RECORD_BATCH_SIZE
+
+        def fetch(client, batch):
+            client.getrecordbyid(id=batch, esn="full")
+            records = client.records
+            return [(identifier, records.get(identifier)) for identifier in batch]
 
-                self.process_dataset(data["id"], items=data)
+        batches = [
+            identifiers[i:i + batch_size] for i in range(0, len(identifiers), batch_size)
+        ]
+        yield from self._iter_fetched(base_url, batches, fetch, csw)
+
+    def harvest_two_pass(self, base_url, matches, csw):
+        """
+        List identifiers and modification dates with the summary element set,
+        then fetch full records only for new or modified identifiers.
 
+        The brief element set has no modification date, so the summary one
+        (still much lighter than full ISO records) is used for the listing.
+        Records whose `modified` date equals the one stored on their dataset
+        are skipped without downloading them.
+        """
+        listing = [
+            (record.identifier, getattr(record, "modified", None))
+            for record in self.iter_records(base_url, matches, csw, esn="summary")
+            if record.identifier
+        ]
+        stored = stored_extras(
+            self.source, [identifier for identifier, _modified in listing], "modified_at"
+        )
+        changed = []
+        for identifier, modified in listing:
+            dataset_id, extras = stored.get(identifier, (None, {}))
+            if modified and dataset_id and extras.get("modified_at") == modified:
+                self.process_dataset(identifier, unchanged=dataset_id)
                 if self.has_reached_max_items():
-                    log.info(f"Reached maximum items limit")
+                    log.info("Reached maximum items limit")
                     return
+            else:
+                changed.append(identifier)
+        log.info(
+            f"Two-pass harvest: {len(listing) - len(changed)} unchanged records, "
+            f"{len(changed)} to fetch"
+        )
 
-            if nextrecord == 0 or nextrecord <= startposition:
-                break
-            startposition = nextrecord
+        for identifier, record in self.iter_records_by_id(base_url, changed, csw):
+            if record is None:
+                self.process_dataset(identifier, missing=True)
+            else:
+                data = self.record_data(record)
+                self.process_dataset(identifier, items=data)
+
+            if self.has_reached_max_items():
+                log.info("Reached maximum items limit")
+                return
+
+    @staticmethod
+    def record_data(record):
+        """
+        Map an OWSLib CSW record to the metadata dict processed by `inner_process_dataset`.
+        """
+        resources = []
+
+        # CSW records use 'uris' field for resources, not 'references'
+        uris = getattr(record, "uris", None)
+        if uris:
+            for uri in uris:
+                if isinstance(uri, dict) and uri.get("url"):
+                    resources.append(uri)
+
+        # Fallback to references if uris is not available
+        if not resources:
+            refs = getattr(record, "references", None)
+            if refs:
+                for ref in refs:
+                    if isinstance(ref, dict) and ref.get("url"):
+                        resources.append(ref)
+
+        return {
+            "id": record.identifier,
+            "title": getattr(record, "title", "") or "",
+            "description": getattr(record, "abstract", "") or "",
+            "tags": getattr(record, "subjects", []) or [],
+            "bbox": getattr(record, "bbox", None),
+            "resources": resources,
+            "type": getattr(record, "type", None),
+            "created": getattr(record, "created", None),
+            "modified": getattr(record, "modified", None),
+        }
 
     def inner_process_dataset(self, item: HarvestItem, **kwargs):
         """
@@ -143,7 +367,15 @@ class CSWUdataBackend(BaseBackend):
         Returns:
             Dataset: The updated or created udata dataset.
         """
-        dataset = self.get_dataset(item.remote_id)
+        if kwargs.get("unchanged"):
+            item.dataset = kwargs["unchanged"]
+            raise HarvestSkipException(
+                "Dataset {0} not modified since last harvest".format(item.remote_id)
+            )
+        if kwargs.get("missing"):
+            raise HarvestException(
+                "Record {0} not returned by GetRecordById".format(item.remote_id)
+            )
 
         data = kwargs.get("items")
         if not data:
@@ -151,18 +383,16 @@ class CSWUdataBackend(BaseBackend):
                 "Missing data for dataset {0}".format(item.remote_id)
             )
 
+        fingerprint = skip_if_unchanged(self, item, data)
+        dataset = self.get_dataset(item.remote_id)
+
         # Set basic dataset fields
         dataset.title = normalize_string(data["title"])
         dataset.license = License.guess("cc-by")
 
         # Process tags - use config tag if available, otherwise use generic 'csw'
         default_tag = self.config.get("default_tag", "csw")
-        tags = [normalize_tag(default_tag)]
-        for tag in data.get("tags", []):
-            normalized = normalize_tag(tag)
-            if normalized:
-                tags.append(normalized)
-        dataset.tags = list(set(tags))  # Remove duplicates
+        dataset.tags = normalize_tags([default_tag] + list(data.get("tags", [])))
 
         dataset.description = normalize_string(data["description"])
 
@@ -182,6 +412,7 @@ class CSWUdataBackend(BaseBackend):
                 log.warning(f"Failed to parse modified date for {item.remote_id}: {e}")
 
         # Populate other extras
+        dataset.extras[HARVEST_FINGERPRINT_KEY] = fingerprint
         dataset.extras["dct_identifier"] = data.get("id")
         dataset.extras["uri"] = data.get("id")
 
@@ -195,9 +426,8 @@ class CSWUdataBackend(BaseBackend):
         # Process spatial coverage
         self._process_spatial(dataset, data)
 
-        # Force recreation of all resources
-        dataset.resources = []
-
+        # Sync resources: only added, removed or changed resources are written
+        specs = []
         for res_data in data.get("resources", []):
             url = res_data.get("url")
             if not url:
@@ -226,14 +456,14 @@ class CSWUdataBackend(BaseBackend):
             # Use resource name if available, otherwise use dataset title
             resource_title = name if name else dataset.title
 
-            # Create and append the resource
-            new_resource = Resource(
-                title=resource_title, url=url, filetype="remote", format=res_type
+            specs.append(
+                {"title": resource_title, "url": url, "filetype": "remote", "format": res_type}
             )
-            dataset.resources.append(new_resource)
+        diff = sync_resources(dataset, specs)
 
         log.debug(
-            f"Processed dataset {item.remote_id}: {dataset.title} with {len(dataset.resources)} resources"
+            f"Processed dataset {item.remote_id}: {dataset.title} with {len(dataset.resources)} resources "
+            f"{diff.summary()}"
         )
 
         return dataset
@@ -315,3 +545,11 @@ class CSWUdataBackend(BaseBackend):
         except (ValueError, AttributeError, TypeError) as e:
             log.warning(f"Failed to process spatial coverage: {e}")
             pass
+
+    def autoarchive(self):
+        # Unmodified records are not requested on incremental runs:
+        # deleted records are only detected by full sweeps
+        if is_incremental(self):
+            log.info("Incremental harvest: autoarchive skipped until the next full sweep")
+            return
+        return super().autoarchive()
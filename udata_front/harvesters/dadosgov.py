@@ -6,6 +6,7 @@ from udata.utils import faker
 
 from .dadosgovBackend import DGBaseBackend
 from udata.core.organization.models import Organization
+from .tools.organization_resolver import OrganizationResolver
 
 from flask import url_for, current_app
 
@@ -94,6 +95,7 @@ class DGBackend(DGBaseBackend):
         xmlRootData = urlopen(rootUrl).read()
         organizationDoc = minidom.parseString(xmlRootData)
         organizationElements = organizationDoc.getElementsByTagName('collection')
+        organizations = OrganizationResolver(dryrun=self.dryrun)
 
         for orgElement in organizationElements:
             orgName = orgElement.attributes['href'].value
@@ -114,18 +116,22 @@ class DGBackend(DGBaseBackend):
             # if there are any elements in the organization
             if datasetElements:
                 # check if the current organization exists in the db, if not create it
-                orgObj = Organization.objects(acronym=orgData['acronym']).first()
+                orgObj = organizations.get(orgData['acronym'])
 
                 if not orgObj:
                     print('--')
-                    orgObj = Organization()
-                    orgObj.acronym = orgData['acronym']
+                    orgObj = organizations.get_or_create(orgData['acronym'])
+                    if orgObj is None:
+                        # dryrun: the organization is not created, nor its datasets
+                        print(f"Organization '{orgData['acronym']}' would be created, skipping its datasets")
+                        continue
                     print(f'Created {orgObj.acronym}')
                     print('--')
 
                 orgObj.name = orgData['name']
                 orgObj.description = orgData['description']
-                orgObj.save()
+                if not self.dryrun:
+                    orgObj.save()
 
                 orgData['dbOrgId'] = orgObj.id
 
@@ -356,7 +362,8 @@ class DGBackend(DGBaseBackend):
 
             # update the number of datasets associated with this organization
             orgObj.metrics['datasets'] += 1
-            orgObj.save()
+            if not self.dryrun:
+                orgObj.save()
 
             return dataset
 
@@ -1,40 +1,206 @@
 from udata.harvest.backends.base import BaseBackend
-from udata.models import Resource, Dataset, License
-import requests
+from udata.models import Dataset, License
 # from urllib.parse import urlparse
 import urllib.parse as urlparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import requests
+
 from udata.harvest.models import HarvestItem
-from .tools.harvester_utils import normalize_url_slashes
+from .tools.harvester_utils import (
+    HARVEST_FINGERPRINT_KEY, mark_source_unchanged, normalize_url_slashes, skip_if_unchanged
+)
+from .tools.http_cache import HTTPValidatorCache
+from .tools.resource_diff import parse_links, sync_resources
+from .tools.tag_normalizer import normalize_tags, with_tag_stats
+
+HEADERS = {
+    'content-type': 'application/json',
+    'Accept-Charset': 'utf-8'
+}
+
+
+def _int(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def page_metadata(data):
+    '''The metadata records of a GeoNetwork `q` page, as a list of dicts'''
+    metadata = data.get("metadata")
+    if isinstance(metadata, dict):
+        return [metadata]
+    if isinstance(metadata, list):
+        return [each for each in metadata if isinstance(each, dict)]
+    return []
+
 
 # backend = 'https://snig.dgterritorio.gov.pt/rndg/srv/por/q?_content_type=json&fast=index&from=1&resultType=details&sortBy=referenceDateOrd&type=dataset%2Bor%2Bseries&dataPolicy=Dados%20abertos&keyword=DGT'
 
 
 class DGTBackend(BaseBackend):
     display_name = 'Harvester DGT'
+    # Version of the payload -> dataset mapping: bump it whenever the mapping
+    # changes so that datasets with an unchanged payload are mapped again
+    MAPPING_VERSION = 2
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         import logging
         self.logger = logging.getLogger(__name__)
 
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    PREFETCH_PAGES = 2
+    MAX_PREFETCH_PAGES = 8
+
+    def _config_int(self, key, default, maximum):
+        try:
+            value = int(self.config.get(key, default))
+        except (TypeError, ValueError):
+            value = default
+        return max(1, min(value, maximum))
+
+    def get_page_size(self):
+        return self._config_int('page_size', self.PAGE_SIZE, self.MAX_PAGE_SIZE)
+
+    def get_prefetch_pages(self):
+        return self._config_int('prefetch_pages', self.PREFETCH_PAGES, self.MAX_PREFETCH_PAGES)
+
+    def source_window(self):
+        '''`(from, to)` window of the source URL (`to` is None when not set)'''
+        params = dict(urlparse.parse_qsl(urlparse.urlsplit(self.source.url).query))
+        start = _int(params.get('from'), 1)
+        end = _int(params.get('to'))
+        return max(1, start), end
+
+    def page_url(self, start, end):
+        '''The source URL with its `from`/`to` window replaced'''
+        parts = urlparse.urlsplit(self.source.url)
+        query = [
+            (key, value)
+            for key, value in urlparse.parse_qsl(parts.query, keep_blank_values=True)
+            if key not in ('from', 'to')
+        ]
+        query += [('from', start), ('to', end)]
+        return urlparse.urlunsplit(
+            parts._replace(query=urlparse.urlencode(query, quote_via=urlparse.quote))
+        )
+
+    def fetch_page(self, start, end):
+        response = requests.get(self.page_url(start, end), headers=HEADERS, timeout=60)
+        response.raise_for_status()
+        response.encoding = 'utf-8'
+        return page_metadata(response.json())
+
+    def fetch_window(self, start, end):
+        '''
+        Fetch the records `start` to `end`. A page shorter than requested
+        (eg. trimmed by the server) is completed with follow-up requests; an
+        empty answer means the catalogue shrank and is logged.
+        '''
+        records = []
+        while start + len(records) <= end:
+            first = start + len(records)
+            metadata = self.fetch_page(first, end)
+            if not metadata:
+                self.logger.warning(
+                    'No records returned from %s to %s, %s records missing',
+                    first, end, end - first + 1
+                )
+                break
+            records.extend(metadata[:end - first + 1])
+        return records
+
+    def iter_metadata(self, metadata, total, start, end):
+        '''
+        Yield the metadata records of the first page (`metadata`, requested
+        from `start`) then of the following pages.
+
+        With the `summary/@count` total, the remaining `from`/`to` windows are
+        requested on a thread pool, up to `prefetch_pages` pages ahead of the
+        one being processed, and short pages are completed (`fetch_window`).
+        Without it, pages are requested one after the
+        other until a short page. Only records up to the `to` of the source
+        URL and `max_items` are requested. A failed page raises, as it would
+        fail the whole harvest anyway.
+        '''
+        # The server may cap the page size below the requested one
+        page_size = min(self.get_page_size(), len(metadata))
+        bounds = [bound for bound in (total, end) if bound is not None]
+        if self.max_items:
+            bounds.append(start + self.max_items - 1)
+        last = min(bounds) if bounds else None
+
+        if last is not None:
+            metadata = metadata[:max(0, last - start + 1)]
+        for each in metadata:
+            yield each
+        start += len(metadata)
+
+        if total is None:
+            while len(metadata) == page_size and (last is None or start <= last):
+                stop = start + page_size - 1
+                metadata = self.fetch_page(start, stop if last is None else min(stop, last))
+                for each in metadata:
+                    yield each
+                start += len(metadata)
+            return
+
+        windows = deque(range(start, last + 1, page_size))
+        if not windows:
+            return
+        prefetch = self.get_prefetch_pages()
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=prefetch) as pool:
+            try:
+                while windows or pending:
+                    while windows and len(pending) < prefetch:
+                        first = windows.popleft()
+                        pending.append(pool.submit(
+                            self.fetch_window, first, min(first + page_size - 1, last)
+                        ))
+                    metadata = pending.popleft().result()
+                    for each in metadata:
+                        yield each
+                    if not metadata:
+                        # The catalogue shrank during the harvest
+                        break
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    @with_tag_stats
     def inner_harvest(self):
 
-        headers = {
-            'content-type': 'application/json',
-            'Accept-Charset': 'utf-8'
-        }
-        res = requests.get(self.source.url, headers=headers)
-        
+        start, end = self.source_window()
+        rows = self.get_page_size()
+        if self.max_items:
+            rows = min(rows, self.max_items)
+        if end is not None:
+            rows = max(1, min(rows, end - start + 1))
+        url = self.page_url(start, start + rows - 1)
+
+        # Conditional GET: short-circuit if the catalogue is unchanged.
+        # Validators are only kept when the first page holds the whole
+        # catalogue, as it says nothing about the following pages.
+        http_cache = HTTPValidatorCache.for_backend(self)
+        res = http_cache.fetch(url, headers=HEADERS, timeout=60, force=self.dryrun)
+        if res.status_code == 304:
+            if not self.dryrun:
+                mark_source_unchanged(self.source)
+            return
+
         res.encoding = 'utf-8'
         data = res.json()
         metadata = data.get("metadata")
 
         # Garante que metadata é sempre uma lista de dicts
-        if isinstance(metadata, dict):
-            metadata = [metadata]
-        elif isinstance(metadata, str) and data.get("@to") == "1":
+        if isinstance(metadata, str) and data.get("@to") == "1":
             # Se for string e @to == "1", não é possível processar como dict, então ignora ou loga erro
             msg = ('Error: metadata é uma string, não um dict: %r', metadata)
             self.logger.error(msg)
@@ -45,16 +211,18 @@ class DGTBackend(BaseBackend):
             self.logger.error(msg)
             raise Exception(msg)
 
-        elif not isinstance(metadata, list):
-            metadata = []
+        metadata = page_metadata(data)
 
         if not metadata:
             msg = 'Erro: Metadados vazios. Nenhum dataset disponível.'
             self.logger.error(msg)
             raise Exception(msg)
 
+        total = _int((data.get("summary") or {}).get("@count"))
+        single_page = total is not None and start + len(metadata) > total
+
         # Loop through the metadata and process each item
-        for each in metadata:
+        for each in self.iter_metadata(metadata, total, start, end):
             item = {
                 "remote_id": each.get("geonet:info", {}).get("uuid"),
                 "title": each.get("defaultTitle"),
@@ -66,35 +234,22 @@ class DGTBackend(BaseBackend):
             #    item["date"] = datetime.strptime(each.get("publicationDate"),
             #                                     "%Y-%m-%d")
 
-            links = []
-            resources = item.get("resources")
-
-            # Checks if resources is a list or string and processes accordingly
-            if isinstance(resources, list):
-                for url in resources:
-                    url_parts = url.split('|')
-                    inner_link = {}
-                    inner_link['url'] = url_parts[2]
-                    inner_link['type'] = url_parts[3]
-                    inner_link['format'] = url_parts[4]
-                    links.append(inner_link)
-
-            elif isinstance(resources, str):
-                url_parts = resources.split('|')
-                inner_link = {}
-                inner_link['url'] = url_parts[2]
-                inner_link['type'] = url_parts[3]
-                inner_link['format'] = url_parts[4]
-                links.append(inner_link)
-
-            item['resources'] = links
+            item['resources'] = [
+                {'url': url, 'type': protocol, 'format': format}
+                for url, protocol, format in parse_links(item.get("resources"))
+            ]
 
             # self.add_item(item["remote_id"], item=item)
             self.process_dataset(item["remote_id"], items=item)
 
+        if (single_page and not self.dryrun
+                and not any(i.status == 'failed' for i in self.job.items)):
+            http_cache.commit(url)
+
     
     def inner_process_dataset(self, item: HarvestItem, **kwargs):
         """Process harvested data into a dataset"""
+        fingerprint = skip_if_unchanged(self, item, kwargs.get('items'))
         dataset = self.get_dataset(item.remote_id)
         # Here you comes your implementation. You should :
         # - fetch the remote dataset (if necessary)
@@ -114,13 +269,10 @@ class DGTBackend(BaseBackend):
             dataset.created_at = item['date']
 
         # Add keywords as tags
-        for keyword in item.get('keywords'):
-            dataset.tags.append(keyword)
-
-        # Recreate all resources
-        # Force recreation of all resources
-        dataset.resources = []
+        dataset.tags.extend(normalize_tags(item.get('keywords') or []))
 
+        # Sync resources: only added, removed or changed resources are written
+        specs = []
         for resource in item.get("resources"):
 
             parsed = urlparse.urlparse(resource['url'])
@@ -129,15 +281,16 @@ class DGTBackend(BaseBackend):
             except KeyError:
                 format = resource['url'].split('.')[-1]
 
-            new_resource = Resource(title=item['title'],
-                                    url=normalize_url_slashes(resource['url']),
-                                    filetype='remote',
-                                    format=format)
-            
-            
-            dataset.resources.append(new_resource)
+            specs.append({
+                'title': item['title'],
+                'url': normalize_url_slashes(resource['url']),
+                'filetype': 'remote',
+                'format': format,
+            })
+        sync_resources(dataset, specs)
 
         # Add extra metadata
         dataset.extras['harvest:name'] = self.source.name
+        dataset.extras[HARVEST_FINGERPRINT_KEY] = fingerprint
 
         return dataset
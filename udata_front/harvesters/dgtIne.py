@@ -1,13 +1,13 @@
 from udata.harvest.backends.base import BaseBackend
-from udata.models import Resource, Dataset, License
+from udata.models import Dataset, License
 import logging
 import json
 import subprocess
 import os
-import unicodedata
-import re
 
 from .tools.harvester_utils import normalize_url_slashes
+from .tools.resource_diff import sync_resources
+from .tools.tag_normalizer import normalize_tags, with_tag_stats
 class DGTINEBackend(BaseBackend):
     display_name = 'INE Harvester'
 
@@ -15,6 +15,7 @@ class DGTINEBackend(BaseBackend):
         super().__init__(*args, **kwargs)
         self.logger = logging.getLogger(__name__)
 
+    @with_tag_stats
     def inner_harvest(self):
         # Caminho do ficheiro JSON baixado
         json_path = '/tmp/catalogo_hvd.json'
@@ -79,20 +80,6 @@ class DGTINEBackend(BaseBackend):
         if os.path.exists(json_path):
             os.remove(json_path)
 
-    @staticmethod
-    def slugify(value):
-        """
-        Normaliza uma string para uso como tag (slug):
-        - remove acentos e cedilhas
-        - substitui espaços por hífens
-        - converte para minúsculas
-        - remove caracteres especiais
-        """
-        value = str(value)
-        value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
-        value = re.sub(r'[^\w\s-]', '', value).strip().lower()
-        return re.sub(r'[\s]+', '-', value)
-
     def inner_process_dataset(self, item: 'HarvestItem', **kwargs):
         dataset = self.get_dataset(item.remote_id)
         data = kwargs.get('items')
@@ -114,20 +101,20 @@ class DGTINEBackend(BaseBackend):
 
         # Corrigir TAGS
         original_tags = data.get('tags', [])
-        slug_tags = [self.slugify(tag) for tag in original_tags if isinstance(tag, str)]
+        slug_tags = normalize_tags(original_tags)
 
         dataset.tags = ['ine.pt'] + slug_tags
         dataset.extras['original_tags'] = original_tags
 
-        # Resources
-        dataset.resources = []
-        for url in data.get('resources', []):
-            if url:
-                dataset.resources.append(Resource(
-                    title=data['title'],
-                    url=normalize_url_slashes(url),
-                    filetype='remote',
-                    format=url.split('.')[-1] if '.' in url else 'file'
-                ))
+        # Resources (only added, removed or changed resources are written)
+        sync_resources(dataset, [
+            {
+                'title': data['title'],
+                'url': normalize_url_slashes(url),
+                'filetype': 'remote',
+                'format': url.split('.')[-1] if '.' in url else 'file',
+            }
+            for url in data.get('resources', []) if url
+        ])
         dataset.extras['harvest:name'] = self.source.name
         return dataset
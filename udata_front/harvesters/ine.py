@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import os
+import queue
 import re
-import unicodedata
+import threading
 import xml.etree.ElementTree as ET
 import time
 import random
@@ -15,18 +17,147 @@ from udata.harvest.backends.base import BaseBackend
 from udata.harvest.models import HarvestItem
 from slugify import slugify
 
-from .tools.harvester_utils import normalize_url_slashes
+from .tools.harvester_utils import (
+    HARVEST_FINGERPRINT_KEY,
+    fingerprint_salt,
+    mark_source_unchanged,
+    metadata_fingerprint,
+    normalize_url_slashes,
+    store_harvest_items,
+    stored_fingerprints,
+)
+from .tools.batch_sizer import AdaptiveBatchSizer
+from .tools.http_cache import HTTPValidatorCache
+from .tools.hvd_registry import HVDRegistry
+from .tools.tag_normalizer import (
+    normalize_tag,
+    normalize_tags,
+    with_tag_stats,
+)
+
+
+# Regex patterns
+KW_SPLIT_RE = re.compile(r"\s*(?:;|,|/|\n|\r|\t|\s+-\s+)\s*")
+
+
+# --------------------------
+# Extração de metadados (funções puras, executáveis num ProcessPoolExecutor)
+# --------------------------
+def extract_metadata(elem: ET.Element) -> dict:
+    """Extrai os metadados (já normalizados) de um elemento `indicator`."""
+    md = {}
+
+    node = elem.find("title")
+    if node is not None and node.text:
+        md["title"] = node.text
+
+    desc = ""
+    remote_url = None
+    node = elem.find("description")
+    if node is not None and node.text:
+        desc = node.text
+
+    html_node = elem.find("html")
+    if html_node is not None:
+        bdd_url = html_node.find("bdd_url")
+        if bdd_url is not None and bdd_url.text:
+            remote_url = bdd_url.text.strip()
+            desc = (desc + "\n" + bdd_url.text) if desc else bdd_url.text
+
+    if desc:
+        md["description"] = desc
+    if remote_url:
+        md["remote_url"] = remote_url
+
+    resources = []
+    json_node = elem.find("json")
+    if json_node is not None:
+        jds = json_node.find("json_dataset")
+        if jds is not None and jds.text:
+            resources.append(
+                {
+                    "title": "Dataset json url",
+                    "description": "Dataset em formato json",
+                    "url": normalize_url_slashes(jds.text),
+                    "filetype": "remote",
+                    "format": "json",
+                }
+            )
+        jmi = json_node.find("json_metainfo")
+        if jmi is not None and jmi.text:
+            resources.append(
+                {
+                    "title": "Json metainfo url",
+                    "description": "Metainfo em formato json",
+                    "url": normalize_url_slashes(jmi.text),
+                    "filetype": "remote",
+                    "format": "json",
+                }
+            )
+
+    md["resources"] = resources
+    md["resource_urls"] = [r["url"].strip() for r in resources]
+    md["resource_sig"] = {
+        (r["url"].strip(), r["title"], r["description"], r["format"])
+        for r in resources
+    }
+
+    keywords = set()
+    for kn in elem.findall("keywords"):
+        text = (kn.text or "").strip()
+        if not text:
+            continue
+        for part in KW_SPLIT_RE.split(text):
+            part = part.strip().strip(",")
+            if part:
+                keywords.add(part)
+
+    for tagname in ("theme", "subtheme"):
+        for tn in elem.findall(tagname):
+            val = (tn.text or "").strip()
+            if val:
+                keywords.add(val)
+
+    # Normalização partilhada (tools/tag_normalizer, com cache LRU)
+    md["tags_norm"] = sorted(set(normalize_tags(keywords)) | {"ine-pt"})
+
+    return md
+
+
+def extract_metadata_batch(payloads: list[bytes]) -> list[dict]:
+    """
+    Extrai metadados de um batch de subárvores `indicator` serializadas
+    (ET.tostring). Corre nos processos do pool de extração; devolve os
+    metadados pela ordem recebida.
+    """
+    return [extract_metadata(ET.fromstring(payload)) for payload in payloads]
 
 
 class INEBackend(BaseBackend):
     """
-    INE Harvester - modo FAST (2 fases):
-    1) Parse XML -> metadados em memória
-    2) Change detection + bulk_write no Mongo (muito mais rápido)
+    INE Harvester - modo FAST (pipeline):
+    1) Parse XML (iterparse) -> metadados por indicador
+    2) Change detection + bulk_write no Mongo por chunk de BULK_SIZE (muito mais rápido)
+
+    Com STREAMING_PIPELINE = True as duas fases correm em pipeline: cada chunk
+    é escrito enquanto o parsing continua e a memória fica constante,
+    independentemente do tamanho do catálogo. Com False, todos os metadados
+    são materializados antes da fase 2 (modo antigo de 2 fases).
 
     Configuração de ficheiro:
     - IS_TEST_MODE = True: usa /tmp/ine.xml (você adiciona/remove manualmente)
     - IS_TEST_MODE = False: descarrega de self.source.url, processa e remove automaticamente
+    - STREAM_PARSE = True: o stream HTTP alimenta diretamente o parser (thread de
+      download + fila limitada), sem escrever/reler o ficheiro; cópia opcional em
+      /tmp/ine.xml com STREAM_TEE_LOCAL_FILE
+
+    Extração: com extract_workers > 1 na config da fonte, os metadados são
+    extraídos num ProcessPoolExecutor (subárvores `indicator` serializadas,
+    em batches de EXTRACT_BATCH_SIZE, devolvidas pela ordem do XML).
+
+    Change detection: cada dataset guarda um fingerprint dos metadados
+    normalizados (extras['harvest:fingerprint']); indicadores com o mesmo
+    fingerprint são ignorados com uma query projetada, sem carregar documentos.
 
     Robustez:
     - Captura BulkWriteError, extrai bwe.details['writeErrors'] e isola operação falhada
@@ -36,6 +167,10 @@ class INEBackend(BaseBackend):
 
     display_name = "Instituto nacional de estatística"
 
+    # Versão do mapeamento metadados -> dataset: incrementar sempre que o
+    # mapeamento muda, para que os datasets inalterados sejam remapeados
+    MAPPING_VERSION = 2
+
     # HTTP Configuration
     MAX_RETRIES = 5
     INITIAL_RETRY_DELAY = 2
@@ -45,25 +180,56 @@ class INEBackend(BaseBackend):
 
     # Harvester Configuration
     IS_TEST_MODE = False  # True: usa ficheiro em /tmp/ine.xml (você gere) | False: download automático com limpeza
-    BULK_SIZE = 500
+    BULK_SIZE = 500  # tamanho inicial (fixo se ADAPTIVE_BULK_SIZE = False)
+    ADAPTIVE_BULK_SIZE = True  # ajusta o tamanho do chunk ao débito observado
+    BULK_SIZE_MIN = 100  # limites; sobrepostos por bulk_size_min/bulk_size_max na config da fonte
+    BULK_SIZE_MAX = 5000
+    BULK_MAX_FLUSH_SECONDS = 30  # um bulk_write mais lento reduz o tamanho
     LOG_EVERY = 200
     CHECK_CHANGES = True
     USE_LOCAL_FILE = (
         True  # True: salva/reutiliza /tmp/ine.xml | False: baixa direto para RAM
     )
     LOCAL_FILE_PATH = "/tmp/ine.xml"
+    STREAMING_PIPELINE = True  # True: escreve por chunk durante o parsing | False: 2 fases
+    # Items (além das falhas) mantidos em job.items para a página do job no admin;
+    # a lista completa está em HarvestItemRecord (API /harvest/job/<id>/items/)
+    JOB_ITEMS_SUMMARY_SIZE = 500
+
+    # Download + parsing em paralelo (tem prioridade sobre USE_LOCAL_FILE)
+    STREAM_PARSE = True  # True: alimenta o parser diretamente do stream HTTP
+    STREAM_CHUNK_SIZE = 256 * 1024
+    STREAM_QUEUE_SIZE = 32  # chunks em buffer entre download e parser (~8 MB)
+    STREAM_TEE_LOCAL_FILE = False  # True: guarda cópia em LOCAL_FILE_PATH para debug
+
+    # Extração de metadados multi-processo (fase 1)
+    EXTRACT_WORKERS = 1  # 1: extração no próprio worker; sobreposto por extract_workers na config da fonte
+    EXTRACT_BATCH_SIZE = 200  # indicadores serializados enviados por tarefa ao pool
 
     # Regex patterns
-    _KW_SPLIT_RE = re.compile(r"\s*(?:;|,|/|\n|\r|\t|\s+-\s+)\s*")
-    _NON_ALNUM_DASH_RE = re.compile(r"[^a-z0-9\-]+")
-    _MULTI_DASH_RE = re.compile(r"\-+")
+    _KW_SPLIT_RE = KW_SPLIT_RE
+
+    # Campos carregados na pré-busca (comparados em _has_changed) e
+    # campos reescritos ($set) num UPDATE
+    PREFETCH_FIELDS = ("id", "title", "description", "tags", "resources", "harvest")
+    UPDATE_FIELDS = (
+        "title",
+        "description",
+        "tags",
+        "resources",
+        "license",
+        "frequency",
+        "harvest",
+    )
 
-    HVD_INDICATOR_IDS: set[str] = set()
+    HVD_URL = "https://www.ine.pt/ine/xml_indic_hvd.jsp?opc=3&lang=PT"
+    HVD_INDICATOR_IDS: frozenset[str] = frozenset()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self._cc_by_license = None
+        self._http_cache = HTTPValidatorCache.for_backend(self)
 
         self._session = requests.Session()
         adapter = requests.adapters.HTTPAdapter(
@@ -125,118 +291,31 @@ class INEBackend(BaseBackend):
     # Normalização de tags
     # --------------------------
     def _normalize_tag(self, tag: str) -> str:
-        if not tag:
-            return ""
-
-        nfd = unicodedata.normalize("NFD", tag)
-        tag = "".join(ch for ch in nfd if unicodedata.category(ch) != "Mn")
-        tag = tag.lower()
-        tag = self._NON_ALNUM_DASH_RE.sub("-", tag)
-        tag = self._MULTI_DASH_RE.sub("-", tag).strip("-")
-        return tag
+        return normalize_tag(tag)
 
     # --------------------------
     # HVD IDs
     # --------------------------
-    def _fetch_hvd_ids(self) -> set[str]:
-        url = "https://www.ine.pt/ine/xml_indic_hvd.jsp?opc=3&lang=PT"
+    def _fetch_hvd_ids(self) -> frozenset[str]:
+        # Registo persistido (Mongo), partilhado com o harvester INE HVD:
+        # só é atualizado a partir de HVD_URL quando expira o TTL
         try:
-            resp = self._make_request_with_retry(url, timeout=30, stream=False)
-            root = ET.fromstring(resp.content)
-            ids = {
-                ind.attrib["id"]
-                for ind in root.findall(".//indicator")
-                if "id" in ind.attrib
-            }
+            registry = HVDRegistry(
+                self.HVD_URL, get=self._make_request_with_retry, http_cache=self._http_cache
+            )
+            # Em dryrun o registo não é atualizado
+            ids = registry.ids(refresh=not self.dryrun)
             self._log.info("[INE] HVD IDs carregados: %s", len(ids))
             return ids
         except Exception as e:
             self._log.warning("[INE] Falha ao carregar HVD IDs: %s", e)
-            return set()
+            return frozenset()
 
     # --------------------------
     # Extrai metadados do indicator (já normalizados)
     # --------------------------
     def _extract_metadata(self, elem: ET.Element) -> dict:
-        md = {}
-
-        node = elem.find("title")
-        if node is not None and node.text:
-            md["title"] = node.text
-
-        desc = ""
-        remote_url = None
-        node = elem.find("description")
-        if node is not None and node.text:
-            desc = node.text
-
-        html_node = elem.find("html")
-        if html_node is not None:
-            bdd_url = html_node.find("bdd_url")
-            if bdd_url is not None and bdd_url.text:
-                remote_url = bdd_url.text.strip()
-                desc = (desc + "\n" + bdd_url.text) if desc else bdd_url.text
-
-        if desc:
-            md["description"] = desc
-        if remote_url:
-            md["remote_url"] = remote_url
-
-        resources = []
-        json_node = elem.find("json")
-        if json_node is not None:
-            jds = json_node.find("json_dataset")
-            if jds is not None and jds.text:
-                resources.append(
-                    {
-                        "title": "Dataset json url",
-                        "description": "Dataset em formato json",
-                        "url": normalize_url_slashes(jds.text),
-                        "filetype": "remote",
-                        "format": "json",
-                    }
-                )
-            jmi = json_node.find("json_metainfo")
-            if jmi is not None and jmi.text:
-                resources.append(
-                    {
-                        "title": "Json metainfo url",
-                        "description": "Metainfo em formato json",
-                        "url": normalize_url_slashes(jmi.text),
-                        "filetype": "remote",
-                        "format": "json",
-                    }
-                )
-
-        md["resources"] = resources
-        md["resource_urls"] = [r["url"].strip() for r in resources]
-        md["resource_sig"] = {
-            (r["url"].strip(), r["title"], r["description"], r["format"])
-            for r in resources
-        }
-
-        keywords = set()
-        for kn in elem.findall("keywords"):
-            text = (kn.text or "").strip()
-            if not text:
-                continue
-            for part in self._KW_SPLIT_RE.split(text):
-                part = part.strip().strip(",")
-                if part:
-                    keywords.add(part)
-
-        for tagname in ("theme", "subtheme"):
-            for tn in elem.findall(tagname):
-                val = (tn.text or "").strip()
-                if val:
-                    keywords.add(val)
-
-        tags_norm = {self._normalize_tag(t) for t in keywords if t}
-        tags_norm.discard("")
-        tags_norm.add("ine-pt")
-        md["tags_norm"] = sorted(tags_norm)
-
-        return md
+        return extract_metadata(elem)
 
     # --------------------------
     # Change detection (barato + deep size check)
@@ -271,6 +350,13 @@ class INEBackend(BaseBackend):
 
         return False
 
+    def _metadata_fingerprint(self, remote_id: str, md: dict) -> str:
+        """Fingerprint dos metadados normalizados (inclui a classificação HVD)."""
+        return metadata_fingerprint(
+            dict(md, hvd=remote_id in self.HVD_INDICATOR_IDS),
+            salt=fingerprint_salt(self),
+        )
+
     # --------------------------
     # Aplica metadata ao dataset (sem salvar)
     # --------------------------
@@ -377,6 +463,8 @@ class INEBackend(BaseBackend):
             dt = time.time() - t0
             details = getattr(bwe, "details", {}) or {}
             werrors = details.get("writeErrors", []) or []
+            # a primeira chamada (batch completo) vê todos os erros
+            self._write_errors = max(getattr(self, "_write_errors", 0), len(werrors))
 
             self._log.error(
                 "[INE] BulkWriteError em %.2fs (ops=%s). writeErrors=%s",
@@ -409,334 +497,725 @@ class INEBackend(BaseBackend):
             return 0, 0, 0
 
     # --------------------------
-    # inner_harvest (2 fases)
+    # Fonte do XML (modo teste, ficheiro local ou memória)
     # --------------------------
-    def inner_harvest(self):
-        self._log.info("[INE] Iniciando harvester de %s", self.source.url)
-        self._log.info(
-            "[INE] Config: BulkSize=%s, LogEvery=%s, CheckChanges=%s, TestMode=%s",
-            self.BULK_SIZE,
-            self.LOG_EVERY,
-            self.CHECK_CHANGES,
-            self.IS_TEST_MODE,
-        )
+    def _uses_local_file(self) -> bool:
+        """True se o harvest escreve LOCAL_FILE_PATH (a remover no fim)."""
+        if self.IS_TEST_MODE:
+            return False
+        if self.STREAM_PARSE:
+            return self.STREAM_TEE_LOCAL_FILE
+        return self.USE_LOCAL_FILE
+
+    def _open_source(self):
+        """
+        Devolve o iterador de eventos (event, elem) do XML: stream HTTP
+        (STREAM_PARSE), ficheiro local ou BytesIO no modo memória.
+        Devolve None se o catálogo não mudou desde o último harvest (HTTP 304).
+        """
+        from io import BytesIO
 
-        start_time = time.time()
-        self.HVD_INDICATOR_IDS = self._fetch_hvd_ids()
+        events = ("start", "end")
 
-        try:
-            import os
-            from io import BytesIO
-
-            # Determina a fonte do XML baseado no modo de operação
-            if self.IS_TEST_MODE:
-                # Modo teste: usa ficheiro em /tmp/ine.xml (usuário responsável por gerenciá-lo)
-                if not os.path.exists(self.LOCAL_FILE_PATH):
-                    raise FileNotFoundError(
-                        f"[INE] Modo teste ativo mas ficheiro não encontrado: {self.LOCAL_FILE_PATH}"
-                    )
-                self._log.info(
-                    "[INE] Modo TESTE: usando ficheiro local %s (você gere remoção)",
-                    self.LOCAL_FILE_PATH,
-                )
-                source_context = self.LOCAL_FILE_PATH
-            elif self.USE_LOCAL_FILE:
-                # Modo produção com ficheiro local: baixa, processa e remove
-                self._log.info(
-                    "[INE] Baixando XML e salvando em %s (será removido após processamento)...",
-                    self.LOCAL_FILE_PATH,
+        if self.IS_TEST_MODE:
+            # Modo teste: usa ficheiro em /tmp/ine.xml (usuário responsável por gerenciá-lo)
+            if not os.path.exists(self.LOCAL_FILE_PATH):
+                raise FileNotFoundError(
+                    f"[INE] Modo teste ativo mas ficheiro não encontrado: {self.LOCAL_FILE_PATH}"
                 )
-                # Usar _make_request_with_retry para robustez e stream=True para memória
-                resp = self._make_request_with_retry(self.source.url, stream=True)
-                with open(self.LOCAL_FILE_PATH, "wb") as f:
-                    for chunk in resp.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                self._log.info("[INE] Download concluído.")
-                source_context = self.LOCAL_FILE_PATH
-            else:
-                # Modo memória: baixa direto para RAM
-                self._log.info("[INE] Baixando XML para memória...")
-                resp = self._make_request_with_retry(self.source.url, stream=False)
-                source_context = BytesIO(resp.content)
-
-            # Fase 1: Criação do iterador sobre o XML
-            # source_context pode ser file path ou file-like object (BytesIO)
-            context = ET.iterparse(source_context, events=("start", "end"))
-            context = iter(context)
-            event, root = next(context)  # Pega o elemento raiz
-
-            metadata_map = {}  # {remote_id: metadata_dict}
-            total_parsed = 0
-
-            for event, elem in context:
-                if event == "end" and elem.tag == "indicator":
-                    total_parsed += 1
-                    md = self._extract_metadata(elem)
-                    remote_id = elem.get("id")
-
-                    # Skip items without title (mandatory field)
-                    if remote_id and md.get("title"):
-                        metadata_map[remote_id] = md
-                    elif remote_id:
-                        self._log.warning(
-                            "[INE] Skipping item %s: missing title", remote_id
-                        )
+            self._log.info(
+                "[INE] Modo TESTE: usando ficheiro local %s (você gere remoção)",
+                self.LOCAL_FILE_PATH,
+            )
+            return ET.iterparse(self.LOCAL_FILE_PATH, events=events)
 
-                    elem.clear()
-                    root.clear()  # Limpa memoria da arvore XML
+        if self.STREAM_PARSE:
+            # Modo stream: download e parsing sobrepõem-se, sem ficheiro intermédio
+            self._log.info(
+                "[INE] Download + parsing em paralelo (chunk=%s, fila=%s, tee=%s)...",
+                self.STREAM_CHUNK_SIZE,
+                self.STREAM_QUEUE_SIZE,
+                self.STREAM_TEE_LOCAL_FILE,
+            )
+            resp = self._fetch_catalogue(stream=True)
+            if resp is None:
+                return None
+            return self._iter_stream_events(resp, events)
 
+        if self.USE_LOCAL_FILE:
+            # Modo produção com ficheiro local: baixa, processa e remove
             self._log.info(
-                "[INE] Parsing XML concluído. Total items: %s. Iniciando processamento...",
-                total_parsed,
+                "[INE] Baixando XML e salvando em %s (será removido após processamento)...",
+                self.LOCAL_FILE_PATH,
             )
+            # Usar _make_request_with_retry para robustez e stream=True para memória
+            resp = self._fetch_catalogue(stream=True)
+            if resp is None:
+                return None
+            with open(self.LOCAL_FILE_PATH, "wb") as f:
+                for chunk in resp.iter_content(chunk_size=8192):
+                    if chunk:
+                        f.write(chunk)
+            self._log.info("[INE] Download concluído.")
+            return ET.iterparse(self.LOCAL_FILE_PATH, events=events)
+
+        # Modo memória: baixa direto para RAM
+        self._log.info("[INE] Baixando XML para memória...")
+        resp = self._fetch_catalogue(stream=False)
+        if resp is None:
+            return None
+        return ET.iterparse(BytesIO(resp.content), events=events)
+
+    def _fetch_catalogue(self, stream: bool):
+        """GET condicional (ETag/Last-Modified) do catálogo; None se HTTP 304."""
+        resp = self._http_cache.fetch(
+            self.source.url, get=self._make_request_with_retry, stream=stream,
+            force=self.dryrun,
+        )
+        if resp.status_code == 304:
+            resp.close()
+            return None
+        return resp
 
-        except Exception as e:
-            self._log.error("[INE] Erro no download/parsing do XML: %s", e)
-            # Remover ficheiro descarregado em caso de erro (não remover em modo teste)
-            if not self.IS_TEST_MODE and self.USE_LOCAL_FILE:
+    def _iter_stream_events(self, resp, events):
+        """
+        Pipe limitado entre uma thread de download e o XMLPullParser.
+
+        A thread lê o stream HTTP em chunks de STREAM_CHUNK_SIZE e coloca-os
+        numa fila com STREAM_QUEUE_SIZE posições (bloqueia se o parser estiver
+        atrasado); o gerador alimenta o parser e devolve os eventos à medida
+        que ficam disponíveis. Com STREAM_TEE_LOCAL_FILE os bytes são também
+        escritos em LOCAL_FILE_PATH.
+        """
+        pipe = queue.Queue(maxsize=self.STREAM_QUEUE_SIZE)
+        stop = threading.Event()
+        eof = object()
+
+        def put(obj):
+            # Desiste se o consumidor já terminou (erro ou fim do harvest)
+            while not stop.is_set():
                 try:
-                    import os
+                    pipe.put(obj, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def download():
+            total = 0
+            tee = None
+            try:
+                if self.STREAM_TEE_LOCAL_FILE:
+                    tee = open(self.LOCAL_FILE_PATH, "wb")
+                for chunk in resp.iter_content(chunk_size=self.STREAM_CHUNK_SIZE):
+                    if stop.is_set():
+                        return
+                    if not chunk:
+                        continue
+                    total += len(chunk)
+                    if tee is not None:
+                        tee.write(chunk)
+                    put(chunk)
+                self._log.info("[INE] Download concluído: %s bytes.", total)
+                put(eof)
+            except Exception as e:
+                put(e)
+            finally:
+                if tee is not None:
+                    tee.close()
+                resp.close()
 
-                    if os.path.exists(self.LOCAL_FILE_PATH):
-                        # os.remove(self.LOCAL_FILE_PATH)
-                        self._log.info(
-                            "[INE] Ficheiro mantido para debug após erro: %s",
-                            self.LOCAL_FILE_PATH,
-                        )
-                        self._log.info(
-                            "[INE] Ficheiro mantido para debug após erro: %s",
-                            self.LOCAL_FILE_PATH,
-                        )
-                except Exception as cleanup_e:
-                    self._log.warning(
-                        "[INE] Falha ao remover ficheiro após erro %s: %s",
-                        self.LOCAL_FILE_PATH,
-                        cleanup_e,
-                    )
-            raise
+        downloader = threading.Thread(target=download, name="ine-download", daemon=True)
+        downloader.start()
 
-        # --- Fim Fase 1, Inicio Fase 2 (Processamento) ---
-        self._log.info(
-            "[INE] Fase 2: change detection + bulk_write (bulk_size=%s)",
-            self.BULK_SIZE,
-        )
+        parser = ET.XMLPullParser(events=events)
+        try:
+            while True:
+                chunk = pipe.get()
+                if chunk is eof:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                parser.feed(chunk)
+                yield from parser.read_events()
+            parser.close()
+            yield from parser.read_events()
+        finally:
+            stop.set()
+            downloader.join(timeout=5)
 
-        from pymongo import ReplaceOne, UpdateOne
+    # --------------------------
+    # Fase 1: iterador de indicadores (streaming)
+    # --------------------------
+    def _iter_indicators(self, context):
+        """
+        Gera (remote_id, metadados) por cada `indicator` do XML, à medida que
+        o parser avança. A árvore é limpa após cada elemento, pelo que só
+        um indicador de cada vez está em memória.
 
-        ops = []
-        op_ids = []
-        # Lista temporária para HarvestItems deste batch
-        batch_harvest_items = []
+        Com extract_workers > 1 a extração corre num ProcessPoolExecutor:
+        as subárvores seguem serializadas em batches e os metadados voltam
+        pela mesma ordem.
+        """
+        workers = self._extract_workers()
+        if workers > 1:
+            pairs = self._iter_parallel_metadata(
+                self._iter_indicator_elements(context, serialize=True), workers
+            )
+        else:
+            pairs = self._iter_indicator_elements(context, serialize=False)
+
+        seen = set()
+        for remote_id, md in pairs:
+            # Skip items without title (mandatory field)
+            if not md.get("title"):
+                self._log.warning("[INE] Skipping item %s: missing title", remote_id)
+                continue
+            if remote_id in seen:
+                self._log.warning(
+                    "[INE] Skipping item %s: indicador duplicado no XML", remote_id
+                )
+                continue
 
-        dataset_collection = None
+            seen.add(remote_id)
+            yield remote_id, md
 
-        changed = 0
-        created = 0
-        skipped = 0
-        failed = 0
-        processed = 0
+    def _iter_indicator_elements(self, context, serialize: bool):
+        """
+        Gera (remote_id, payload) por indicador: os metadados extraídos ou,
+        com serialize=True, a subárvore serializada para o pool de extração.
+        """
+        # context: eventos (event, elem) do iterparse ou do XMLPullParser
+        context = iter(context)
+        event, root = next(context)  # Pega o elemento raiz
 
-        # Para reporting no Job
-        if not hasattr(self, "job") or self.job is None:
-            self._log.warning(
-                "[INE] Atenção: self.job não existe. O progresso não será visível na UI."
-            )
+        total_parsed = 0
+        for event, elem in context:
+            if event != "end" or elem.tag != "indicator":
+                continue
+
+            total_parsed += 1
+            remote_id = elem.get("id")
+            if remote_id:
+                payload = ET.tostring(elem) if serialize else self._extract_metadata(elem)
+
+            elem.clear()
+            root.clear()  # Limpa memoria da arvore XML
 
-        # Processar em batches para eficiência com escrita em massa.
-        # Estratégia: iterar metadados em chunks, fazer change detection,
-        # acumular operações Mongo, e fazer flush quando atinge BULK_SIZE.
-        all_items = list(metadata_map.items())
-        total_items = len(all_items)
+            if remote_id:
+                yield remote_id, payload
 
-        # Processar em chunks do tamanho do bulk_size
-        for i in range(0, total_items, self.BULK_SIZE):
-            chunk = all_items[i : i + self.BULK_SIZE]
+        self._log.info("[INE] Parsing XML concluído. Total items: %s", total_parsed)
 
-            # --- Passo A: Pré-buscar datasets ---
-            for remote_id, md in chunk:
-                md["__dataset_obj"] = self.get_dataset(remote_id)
+    def _extract_workers(self) -> int:
+        """Número de processos de extração (config da fonte: extract_workers)."""
+        try:
+            workers = int(self.config.get("extract_workers", self.EXTRACT_WORKERS))
+        except (TypeError, ValueError):
+            workers = self.EXTRACT_WORKERS
+        return max(1, min(workers, os.cpu_count() or 1))
+
+    def _iter_parallel_metadata(self, raw, workers: int):
+        """
+        Extrai metadados de (remote_id, subárvore serializada) num
+        ProcessPoolExecutor, mantendo a ordem do XML. No máximo 2 batches
+        por processo ficam em voo, pelo que a memória continua limitada.
 
-            # --- Passo B: Processamento do chunk ---
-            # Guarda remote_ids de datasets criados para buscar IDs depois
-            created_remote_ids = []
+        Se o pool não puder ser usado (p.ex. worker Celery daemonic, que não
+        pode criar processos filhos), a extração continua no próprio processo.
+        """
+        import multiprocessing
+        from collections import deque
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._log.info(
+            "[INE] Extração de metadados em %s processos (batch=%s)",
+            workers,
+            self.EXTRACT_BATCH_SIZE,
+        )
+        pending = deque()
 
-            for remote_id, md in chunk:
-                processed += 1
-                item_status = "done"
-                dataset = md.pop("__dataset_obj")  # recupera e limpa
+        def disable_pool(error):
+            nonlocal pool
+            if pool is not None:
+                self._log.warning(
+                    "[INE] Pool de extração indisponível (%s): extração sequencial",
+                    error,
+                )
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = None
 
+        def results(ids, payloads, future):
+            if future is not None and pool is not None:
                 try:
-                    if dataset_collection is None:
-                        dataset_collection = dataset._get_collection()
-
-                    # Verifica se o dataset existe baseado no harvest.remote_id
-                    # O get_dataset retorna um dataset existente (com id) ou um novo (sem id)
-                    is_existing = (
-                        getattr(dataset, "harvest", None) is not None
-                        and getattr(dataset.harvest, "remote_id", None) == remote_id
-                        and getattr(dataset, "id", None) is not None
-                    )
+                    return zip(ids, future.result())
+                except Exception as e:
+                    disable_pool(e)
+            return zip(ids, extract_metadata_batch(payloads))
+
+        def submit(batch):
+            ids = [remote_id for remote_id, _ in batch]
+            payloads = [payload for _, payload in batch]
+            future = None
+            if pool is not None:
+                try:
+                    future = pool.submit(extract_metadata_batch, payloads)
+                except Exception as e:
+                    disable_pool(e)
+            pending.append((ids, payloads, future))
 
-                    # ========================================
-                    # CASO 1: Dataset já existe na base de dados
-                    # ========================================
-                    if is_existing:
-                        # Verificar se houve alterações nos metadados
-                        if self.CHECK_CHANGES and not self._has_changed(
-                            dataset, md, remote_id
-                        ):
-                            # Sem alterações -> SKIP
-                            skipped += 1
-                            item_status = "skipped"
-                            self._log.debug(
-                                "[INE] SKIP: remote_id=%s (sem alterações)", remote_id
-                            )
-                        else:
-                            # Com alterações -> UPDATE
-                            self._apply_metadata_to_dataset(dataset, remote_id, md)
-                            doc = dataset.to_mongo()
-                            doc_dict = dict(doc)
-                            _id = doc_dict.get("_id", dataset.id)
-                            ops.append(ReplaceOne({"_id": _id}, doc_dict, upsert=False))
-                            op_ids.append(remote_id)
-                            changed += 1
-                            self._log.debug(
-                                "[INE] UPDATE: remote_id=%s (metadados alterados)",
-                                remote_id,
-                            )
+        try:
+            batch = []
+            for item in raw:
+                batch.append(item)
+                if len(batch) >= self.EXTRACT_BATCH_SIZE:
+                    submit(batch)
+                    batch = []
+                while len(pending) >= workers * 2:
+                    yield from results(*pending.popleft())
+            if batch:
+                submit(batch)
+            while pending:
+                yield from results(*pending.popleft())
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    def _iter_chunks(self, items):
+        """Agrupa o iterador de indicadores em chunks do tamanho atual do batch."""
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= self._batch_sizer.size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
-                        # HarvestItem para datasets existentes
-                        if self.job:
-                            h_item = HarvestItem(
-                                remote_id=remote_id, status=item_status
-                            )
-                            h_item.dataset = dataset.id
-                            batch_harvest_items.append(h_item)
+    # --------------------------
+    # Fase 2: change detection + bulk_write por chunk
+    # --------------------------
+    def _reset_pipeline_state(self):
+        """Estado partilhado entre chunks (operações pendentes e contadores)."""
+        self._ops = []
+        self._op_ids = []
+        # Items (remote_id, dataset_id, status) do chunk atual, gravados em
+        # bulk no HarvestItemRecord (o documento do job não cresce)
+        self._batch_harvest_items = []
+        self._job_items_summary = 0
+        self._dataset_collection = None
+        self._next_progress_log = self.LOG_EVERY * 5
+        self._batch_sizer = self._make_batch_sizer()
+        self._stats = {
+            "processed": 0,
+            "changed": 0,
+            "created": 0,
+            "skipped": 0,
+            "failed": 0,
+        }
+
+    def _make_batch_sizer(self):
+        """Controlador do tamanho de batch (limites configuráveis por fonte)."""
+        minimum = int(self.config.get("bulk_size_min", self.BULK_SIZE_MIN))
+        maximum = int(self.config.get("bulk_size_max", self.BULK_SIZE_MAX))
+        if not self.ADAPTIVE_BULK_SIZE:
+            minimum = maximum = self.BULK_SIZE
+        return AdaptiveBatchSizer(
+            initial=self.BULK_SIZE,
+            minimum=minimum,
+            maximum=maximum,
+            max_latency=self.BULK_MAX_FLUSH_SECONDS,
+        )
+
+    def _prefetch_datasets(self, remote_ids):
+        """
+        Carrega numa única query todos os datasets existentes do chunk
+        (mesmo critério do get_dataset: remote_id + domínio/fonte), apenas
+        com os campos usados por _has_changed e pelo UPDATE.
+        Devolve {remote_id: dataset}.
+        """
+        query = {
+            "harvest.remote_id": {"$in": list(remote_ids)},
+            "$or": [
+                {"harvest.domain": self.source.domain},
+                {"harvest.source_id": str(self.source.id)},
+            ],
+        }
+        existing = {}
+        for dataset in Dataset.objects(__raw__=query).only(*self.PREFETCH_FIELDS):
+            existing.setdefault(dataset.harvest.remote_id, dataset)
+        return existing
+
+    def _new_dataset(self):
+        """Dataset novo, atribuído como no get_dataset do BaseBackend."""
+        if self.source.organization:
+            return Dataset(organization=self.source.organization)
+        if self.source.owner:
+            return Dataset(owner=self.source.owner)
+        return Dataset()
+
+    def _process_chunk(self, chunk):
+        from pymongo import UpdateMany, UpdateOne
+
+        stats = self._stats
+
+        if self._dataset_collection is None:
+            self._dataset_collection = Dataset._get_collection()
+
+        # --- Passo A: Fingerprints guardados (query projetada, sem mongoengine) ---
+        fingerprints = {
+            remote_id: self._metadata_fingerprint(remote_id, md)
+            for remote_id, md in chunk
+        }
+        stored = (
+            stored_fingerprints(self.source, list(fingerprints))
+            if self.CHECK_CHANGES
+            else {}
+        )
+
+        pending = []
+        unchanged_ids = []
+        for remote_id, md in chunk:
+            dataset_id, stored_fp = stored.get(remote_id, (None, None))
+            if stored_fp is not None and stored_fp == fingerprints[remote_id]:
+                # Fingerprint igual -> SKIP sem carregar o dataset
+                stats["processed"] += 1
+                stats["skipped"] += 1
+                self._log.debug("[INE] SKIP: remote_id=%s (fingerprint igual)", remote_id)
+                unchanged_ids.append(dataset_id)
+                self._batch_harvest_items.append((remote_id, dataset_id, "skipped"))
+            else:
+                pending.append((remote_id, md))
+
+        # --- Passo B: Pré-buscar datasets restantes (uma query por chunk) ---
+        existing = (
+            self._prefetch_datasets([remote_id for remote_id, _ in pending])
+            if pending
+            else {}
+        )
 
-                    # ========================================
-                    # CASO 2: Dataset não existe -> CREATE
-                    # ========================================
+        # --- Passo C: Processamento do chunk ---
+        # Guarda remote_ids de datasets criados para buscar IDs depois
+        created_remote_ids = []
+
+        for remote_id, md in pending:
+            stats["processed"] += 1
+            item_status = "done"
+            dataset = existing.get(remote_id)
+            fingerprint = fingerprints[remote_id]
+            fingerprint_field = "extras." + HARVEST_FINGERPRINT_KEY
+
+            try:
+                # ========================================
+                # CASO 1: Dataset já existe na base de dados
+                # ========================================
+                if dataset is not None:
+                    # Sem fingerprint guardado (dataset anterior à funcionalidade):
+                    # verificar alterações campo a campo
+                    _, stored_fp = stored.get(remote_id, (None, None))
+                    if (
+                        self.CHECK_CHANGES
+                        and stored_fp is None
+                        and not self._has_changed(dataset, md, remote_id)
+                    ):
+                        # Sem alterações -> SKIP (grava apenas o fingerprint)
+                        self._ops.append(
+                            UpdateOne(
+                                {"_id": dataset.id},
+                                {
+                                    "$set": {
+                                        fingerprint_field: fingerprint,
+                                        "harvest.last_update": datetime.now(timezone.utc),
+                                    },
+                                    # Dataset de novo presente na origem: desarquivar
+                                    "$unset": {
+                                        "archived": "",
+                                        "harvest.archived": "",
+                                        "harvest.archived_at": "",
+                                    },
+                                },
+                                upsert=False,
+                            )
+                        )
+                        self._op_ids.append(remote_id)
+                        stats["skipped"] += 1
+                        item_status = "skipped"
+                        self._log.debug(
+                            "[INE] SKIP: remote_id=%s (sem alterações)", remote_id
+                        )
                     else:
+                        # Com alterações -> UPDATE
+                        # O documento foi carregado com projeção: só os campos
+                        # geridos pelo harvester são reescritos ($set).
                         self._apply_metadata_to_dataset(dataset, remote_id, md)
+                        # Dataset de novo presente na origem: desarquivar
+                        if dataset.harvest:
+                            dataset.harvest.archived = None
+                            dataset.harvest.archived_at = None
                         doc = dataset.to_mongo()
-                        doc_dict = dict(doc)
-                        # Remover _id pois será gerado pelo MongoDB
-                        doc_dict.pop("_id", None)
-                        ops.append(
+                        update = {k: doc[k] for k in self.UPDATE_FIELDS if k in doc}
+                        update[fingerprint_field] = fingerprint
+                        self._ops.append(
                             UpdateOne(
-                                {
-                                    "harvest.remote_id": str(remote_id),
-                                    "harvest.source_id": (
-                                        str(self.source.id) if self.source.id else None
-                                    ),
-                                },
-                                {"$setOnInsert": doc_dict},
-                                upsert=True,
+                                {"_id": dataset.id},
+                                {"$set": update, "$unset": {"archived": ""}},
+                                upsert=False,
                             )
                         )
-                        op_ids.append(remote_id)
-                        created += 1
-                        created_remote_ids.append(remote_id)
+                        self._op_ids.append(remote_id)
+                        stats["changed"] += 1
                         self._log.debug(
-                            "[INE] CREATE: remote_id=%s (novo dataset)", remote_id
+                            "[INE] UPDATE: remote_id=%s (metadados alterados)",
+                            remote_id,
                         )
 
-                except Exception:
-                    failed += 1
-                    item_status = "failed"
-                    self._log.exception(
-                        "[INE] Falha na fase 2 para remote_id=%s", remote_id
+                    self._batch_harvest_items.append((remote_id, dataset.id, item_status))
+
+                # ========================================
+                # CASO 2: Dataset não existe -> CREATE
+                # ========================================
+                else:
+                    # Objeto novo só é construído aqui (lazy)
+                    dataset = self._apply_metadata_to_dataset(
+                        self._new_dataset(), remote_id, md
                     )
-                    # HarvestItem para falhas
-                    if self.job:
-                        h_item = HarvestItem(remote_id=remote_id, status=item_status)
-                        batch_harvest_items.append(h_item)
-
-            # --- Fim do loop do chunk ---
-
-            # Flush Ops
-            if len(ops) >= self.BULK_SIZE and dataset_collection is not None:
-                self._flush_bulk(dataset_collection, ops, op_ids)
-                ops, op_ids = [], []
-
-            # Buscar IDs dos datasets criados e criar HarvestItems
-            if self.job and created_remote_ids and dataset_collection is not None:
-                for rid in created_remote_ids:
-                    try:
-                        ds_doc = dataset_collection.find_one(
-                            {"harvest.remote_id": str(rid)}, {"_id": 1}
+                    dataset.extras[HARVEST_FINGERPRINT_KEY] = fingerprint
+                    doc_dict = dict(dataset.to_mongo())
+                    # Remover _id pois será gerado pelo MongoDB
+                    doc_dict.pop("_id", None)
+                    self._ops.append(
+                        UpdateOne(
+                            {
+                                "harvest.remote_id": str(remote_id),
+                                "harvest.source_id": (
+                                    str(self.source.id) if self.source.id else None
+                                ),
+                            },
+                            {"$setOnInsert": doc_dict},
+                            upsert=True,
                         )
-                        h_item = HarvestItem(remote_id=rid, status="done")
-                        if ds_doc:
-                            h_item.dataset = ds_doc["_id"]
-                        batch_harvest_items.append(h_item)
-                    except Exception:
-                        self._log.warning(
-                            "[INE] Não foi possível buscar ID do dataset criado: %s",
-                            rid,
-                        )
-                        h_item = HarvestItem(remote_id=rid, status="done")
-                        batch_harvest_items.append(h_item)
-
-            if self.job and len(batch_harvest_items) >= (self.BULK_SIZE * 2):
-                before_len = len(self.job.items)
-                self.job.items.extend(batch_harvest_items)
-                self.job.save()
-                after_len = len(self.job.items)
-                self._log.info(
-                    "[INE] Job Save: items grew from %s to %s (added %s)",
-                    before_len,
-                    after_len,
-                    len(batch_harvest_items),
+                    )
+                    self._op_ids.append(remote_id)
+                    stats["created"] += 1
+                    created_remote_ids.append(remote_id)
+                    self._log.debug("[INE] CREATE: remote_id=%s (novo dataset)", remote_id)
+
+            except Exception:
+                stats["failed"] += 1
+                item_status = "failed"
+                self._log.exception("[INE] Falha na fase 2 para remote_id=%s", remote_id)
+                self._batch_harvest_items.append((remote_id, None, item_status))
+                # Falhas ficam também no job, para o estado final (done-errors)
+                if self.job:
+                    self.job.items.append(HarvestItem(remote_id=remote_id, status=item_status))
+
+        # --- Fim do loop do chunk ---
+
+        # Só um resumo dos items fica em job.items: o autoarchive não vê os outros,
+        # por isso os datasets saltados (SKIP por fingerprint) têm o
+        # harvest.last_update atualizado (um único UpdateMany por chunk)
+        if unchanged_ids and not self.dryrun:
+            self._ops.append(
+                UpdateMany(
+                    {"_id": {"$in": unchanged_ids}},
+                    {"$set": {"harvest.last_update": datetime.now(timezone.utc)}},
                 )
-                batch_harvest_items = []
+            )
+            self._op_ids.append("<skipped:%s>" % len(unchanged_ids))
 
-            if processed % (self.LOG_EVERY * 5) == 0:
-                self._log.info(
-                    "[INE] Fase 2 progresso: processed=%s changed=%s created=%s skipped=%s failed=%s",
-                    processed,
-                    changed,
-                    created,
-                    skipped,
-                    failed,
+        # Flush Ops: um bulk_write por chunk, enquanto o parsing continua
+        self._flush_ops()
+
+        # Buscar IDs dos datasets criados (uma query)
+        if self.job and created_remote_ids:
+            created_ids = {}
+            try:
+                cursor = self._dataset_collection.find(
+                    {
+                        "harvest.remote_id": {"$in": created_remote_ids},
+                        "harvest.source_id": str(self.source.id) if self.source.id else None,
+                    },
+                    {"_id": 1, "harvest.remote_id": 1},
+                )
+                created_ids = {doc["harvest"]["remote_id"]: doc["_id"] for doc in cursor}
+            except Exception:
+                self._log.warning(
+                    "[INE] Não foi possível buscar IDs dos datasets criados: %s",
+                    len(created_remote_ids),
                 )
+            for rid in created_remote_ids:
+                self._batch_harvest_items.append((rid, created_ids.get(rid), "done"))
 
-        # Final Flush Ops
-        if ops and dataset_collection is not None:
-            self._flush_bulk(dataset_collection, ops, op_ids)
+        # Um insert_many de items por chunk: custo O(chunk), não O(total)
+        self._flush_job_items()
 
-        # Final Flush Job Items
-        if self.job and batch_harvest_items:
-            before_len = len(self.job.items)
-            self.job.items.extend(batch_harvest_items)
+        if stats["processed"] >= self._next_progress_log:
+            self._next_progress_log += self.LOG_EVERY * 5
+            self._log.info(
+                "[INE] Fase 2 progresso: processed=%s changed=%s created=%s skipped=%s failed=%s",
+                stats["processed"],
+                stats["changed"],
+                stats["created"],
+                stats["skipped"],
+                stats["failed"],
+            )
+
+    def _flush_ops(self):
+        if self.dryrun:
+            # Pré-visualização: nenhum dataset é gravado
+            self._ops, self._op_ids = [], []
+            return
+        if self._ops and self._dataset_collection is not None:
+            self._write_errors = 0
+            t0 = time.time()
+            self._flush_bulk(self._dataset_collection, self._ops, self._op_ids)
+            dt = time.time() - t0
+
+            previous = self._batch_sizer.size
+            size = self._batch_sizer.record(len(self._ops), dt, self._write_errors)
+            self._log.info(
+                "[INE] bulk_size: %s -> %s | %.0f ops/s (ops=%s erros=%s em %.2fs)",
+                previous,
+                size,
+                len(self._ops) / max(dt, 1e-6),
+                len(self._ops),
+                self._write_errors,
+                dt,
+            )
+        self._ops, self._op_ids = [], []
+
+    def _flush_job_items(self, final=False):
+        items, self._batch_harvest_items = self._batch_harvest_items, []
+        if not self.job or not items:
+            return
+        if self.dryrun:
+            # Pré-visualização: job em memória, nada é gravado
+            for remote_id, dataset_id, status in items:
+                h_item = HarvestItem(remote_id=remote_id, status=status)
+                h_item.dataset = dataset_id
+                self.job.items.append(h_item)
+            return
+        try:
+            stored = store_harvest_items(self.job, items)
+        except Exception:
+            self._log.exception("[INE] Falha ao gravar %s harvest items", len(items))
+            return
+        # Resumo limitado em job.items (as falhas já lá estão)
+        for remote_id, dataset_id, status in items:
+            if self._job_items_summary >= self.JOB_ITEMS_SUMMARY_SIZE:
+                break
+            if status == "failed":
+                continue
+            h_item = HarvestItem(remote_id=remote_id, status=status)
+            h_item.dataset = dataset_id
+            self.job.items.append(h_item)
+            self._job_items_summary += 1
+        self._log.debug(
+            "[INE] %s: %s harvest items gravados",
+            "Final Job Items" if final else "Job Items",
+            stored,
+        )
+        if final and self.job.items:
+            # Apenas as falhas e o resumo ficam embebidos no documento do job
             self.job.save()
-            after_len = len(self.job.items)
+
+    # --------------------------
+    # inner_harvest (pipeline parse -> chunk -> bulk_write)
+    # --------------------------
+    @with_tag_stats
+    def inner_harvest(self):
+        self._log.info("[INE] Iniciando harvester de %s", self.source.url)
+        self._log.info(
+            "[INE] Config: BulkSize=%s, LogEvery=%s, CheckChanges=%s, TestMode=%s, Streaming=%s, StreamParse=%s",
+            self.BULK_SIZE,
+            self.LOG_EVERY,
+            self.CHECK_CHANGES,
+            self.IS_TEST_MODE,
+            self.STREAMING_PIPELINE,
+            self.STREAM_PARSE,
+        )
+
+        start_time = time.time()
+        self.HVD_INDICATOR_IDS = self._fetch_hvd_ids()
+        self._reset_pipeline_state()
+
+        # Para reporting no Job
+        if not hasattr(self, "job") or self.job is None:
+            self._log.warning(
+                "[INE] Atenção: self.job não existe. O progresso não será visível na UI."
+            )
+
+        try:
+            context = self._open_source()
+            if context is None:
+                self._log.info(
+                    "[INE] Catálogo sem alterações desde o último harvest (HTTP 304): %s",
+                    self._http_cache.stats(self.source.url),
+                )
+                if not self.dryrun:
+                    mark_source_unchanged(self.source)
+                return
+
+            items = self._iter_indicators(context)
+
+            if not self.STREAMING_PIPELINE:
+                # Modo 2 fases: materializa todos os metadados antes de escrever
+                items = list(items)
+
+            # Com STREAMING_PIPELINE cada chunk de indicadores segue para
+            # change detection + bulk_write enquanto o XML ainda é lido,
+            # pelo que a memória fica limitada a um chunk.
             self._log.info(
-                "[INE] Final Job Save: items grew from %s to %s (added %s)",
-                before_len,
-                after_len,
-                len(batch_harvest_items),
+                "[INE] Fase 2: change detection + bulk_write (bulk_size=%s, adaptativo=%s, limites=%s-%s)",
+                self._batch_sizer.size,
+                self.ADAPTIVE_BULK_SIZE,
+                self._batch_sizer.minimum,
+                self._batch_sizer.maximum,
             )
+            for chunk in self._iter_chunks(items):
+                self._process_chunk(chunk)
 
+            # Final Flush Ops
+            self._flush_ops()
+
+        except Exception as e:
+            self._log.error("[INE] Erro no download/parsing/escrita do XML: %s", e)
+            # Ficheiro descarregado é mantido para debug (não remover em modo teste)
+            if self._uses_local_file():
+                if os.path.exists(self.LOCAL_FILE_PATH):
+                    self._log.info(
+                        "[INE] Ficheiro mantido para debug após erro: %s",
+                        self.LOCAL_FILE_PATH,
+                    )
+            raise
+
+        # Final Flush Job Items
+        self._flush_job_items(final=True)
+
+        # Validadores HTTP só ficam guardados após um harvest sem falhas
+        if not self.dryrun and not self._stats["failed"]:
+            self._http_cache.commit(self.source.url)
+
+        stats = self._stats
         total_time = time.time() - start_time
         self._log.info(
             "[INE] FAST MODE concluído em %ss (%.1f min) | processed=%s changed=%s created=%s skipped=%s failed=%s",
             round(total_time, 1),
             total_time / 60,
-            processed,
-            changed,
-            created,
-            skipped,
-            failed,
+            stats["processed"],
+            stats["changed"],
+            stats["created"],
+            stats["skipped"],
+            stats["failed"],
         )
+        self._log.info("[INE] bulk_write: %s", self._batch_sizer.summary())
 
         # Remover ficheiro descarregado após processamento bem-sucedido
         # (não remover em modo teste)
-        if not self.IS_TEST_MODE and self.USE_LOCAL_FILE:
+        if self._uses_local_file():
             try:
-                import os
-
                 if os.path.exists(self.LOCAL_FILE_PATH):
                     os.remove(self.LOCAL_FILE_PATH)
                     self._log.info(
@@ -1,13 +1,79 @@
+import logging
+
 from udata.models import db, Resource, License
 from udata.harvest.backends.base import BaseBackend
 from datetime import datetime
-from xml.dom import minidom, Node
+from io import BytesIO
+import xml.etree.ElementTree as ET
 import requests
 from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
 import re
 
 from udata.harvest.models import HarvestItem
-from .tools.harvester_utils import normalize_url_slashes
+from .tools.harvester_utils import mark_source_unchanged, normalize_url_slashes
+from .tools.http_cache import HTTPValidatorCache
+from .tools.hvd_registry import HVDRegistry
+from .tools.tag_normalizer import normalize_tags, with_tag_stats
+
+log = logging.getLogger(__name__)
+
+
+def _text(node):
+    '''Text of `node` (text nodes and CDATA sections), without its children'''
+    if node is None:
+        return ''
+    return ''.join([node.text or ''] + [child.tail or '' for child in node]).strip()
+
+
+def _find_text(elem, *path):
+    '''Text of the first descendant matching each tag of `path` in turn'''
+    node = elem
+    for tag in path:
+        node = node.find('.//' + tag)
+        if node is None:
+            return ''
+    return _text(node)
+
+
+def indicator_fields(elem):
+    '''Extract the fields mapped by `INEHvdBackend` from an `indicator` element'''
+    return {
+        'has_details': elem.find('.//title') is not None,
+        'title': _find_text(elem, 'title'),
+        'description': _find_text(elem, 'description'),
+        'keywords': _find_text(elem, 'keywords'),
+        'theme': _find_text(elem, 'theme'),
+        'subtheme': _find_text(elem, 'subtheme'),
+        'periodicity': _find_text(elem, 'periodicity'),
+        'geo_lastlevel': _find_text(elem, 'geo_lastlevel'),
+        'source': _find_text(elem, 'source'),
+        'has_dates': elem.find('.//dates') is not None,
+        'last_period_available': _find_text(elem, 'dates', 'last_period_available'),
+        'last_update': _find_text(elem, 'dates', 'last_update'),
+        'has_html': elem.find('.//html') is not None,
+        'bdd_url': _find_text(elem, 'html', 'bdd_url'),
+        'json_dataset': _find_text(elem, 'json', 'json_dataset'),
+        'json_metainfo': _find_text(elem, 'json', 'json_metainfo'),
+    }
+
+
+def parse_indicators(content):
+    '''
+    Stream-parse an INE indicators document and return `{id: fields}`
+    (in document order). Without an `id` attribute, indicators are
+    indexed under `None` (first one only).
+    '''
+    indicators = {}
+    context = ET.iterparse(BytesIO(content), events=('start', 'end'))
+    _event, root = next(context)
+    for event, elem in context:
+        if event != 'end' or elem.tag != 'indicator':
+            continue
+        indicators.setdefault(elem.get('id'), indicator_fields(elem))
+        elem.clear()
+        root.clear()
+    return indicators
+
 
 class INEHvdBackend(BaseBackend):
     '''
@@ -31,44 +97,60 @@ class INEHvdBackend(BaseBackend):
     '''
     display_name = 'Instituto nacional de estatística (HVD)'
 
+    # Indicator ids per detail request (`varcd=id1,id2,...`), for indicators
+    # without their metadata in the catalogue document
+    DETAIL_BATCH_SIZE = 20
+
+    @with_tag_stats
     def inner_harvest(self):
         '''
         Changes the status of the harvesting process.
         Fetches the main source XML, parses the available indicators (datasets),
         and initiates the processing for each identified dataset ID.
         '''
-        try:
-            from ineDatasets import datasetIds
-        except ImportError:
-            datasetIds = set([])
-
-        # Fetch the catalog
-        req = requests.get(self.source.url)
+        # Fetch the catalog (conditional GET: short-circuit if unchanged)
+        http_cache = HTTPValidatorCache.for_backend(self)
+        req = http_cache.fetch(self.source.url, force=self.dryrun)
+        if req.status_code == 304:
+            if not self.dryrun:
+                mark_source_unchanged(self.source)
+            return
         # Handle potential encoding issues if needed, usually requests detects it
         if req.encoding is None:
             req.encoding = 'utf-8'
 
-        doc = minidom.parseString(req.content)
-        properties = doc.getElementsByTagName('indicator')
+        # Index the catalogue indicators by id: their metadata is reused
+        # when the catalogue carries it, instead of one request per indicator
+        catalogue = parse_indicators(req.content)
+        catalogue.pop(None, None)
 
-        for propNode in properties:
-            if propNode.hasAttribute('id'):
-                currentId = propNode.getAttribute('id')
-                datasetIds.add(currentId)
+        # The catalogue refreshes the HVD registry shared with the INE harvester,
+        # which also holds the seed ids (ineDatasets). Only the ids of this
+        # source and the seed ids are harvested, not those of other origins.
+        registry = HVDRegistry(self.source.url)
+        if not self.dryrun:
+            registry.seed()
+            registry.update(catalogue, self.source.url)
+        datasetIds = registry.origin_ids(self.source.url) | set(catalogue)
+
+        self.indicators = {
+            dsId: fields for dsId, fields in catalogue.items() if fields['has_details']
+        }
+        missing = [dsId for dsId in datasetIds if dsId not in self.indicators]
+        if missing:
+            self.indicators.update(self.fetch_details(missing))
 
         for dsId in datasetIds:
-            self.process_dataset(dsId)
+            self.process_dataset(dsId, indicator=self.indicators.get(dsId))
+
+        if not self.dryrun and not any(i.status == 'failed' for i in self.job.items):
+            http_cache.commit(self.source.url)
 
-    def inner_process_dataset(self, item: HarvestItem):
+    def detail_url(self, ids):
         '''
-        Processing a specific item (dataset) from the harvest.
-        Fetches the detailed XML for the specific dataset ID, extracts metadata
-        (title, description, tags, etc.), maps them to the uData Dataset object,
-        and defines the associated resources (JSON data and metadata).
+        Build the detail URL of the indicators `ids` (`varcd` parameter),
+        preserving hostname/path of source.url
         '''
-        dataset = self.get_dataset(item.remote_id)
-
-        # Build final URL preserving hostname/path if present in source.url
         base_url = self.source.url
         parsed = urlparse(base_url)
         qs = parse_qs(parsed.query)
@@ -78,45 +160,68 @@ class INEHvdBackend(BaseBackend):
             qs['lang'] = ['PT']
 
         # add varcd (dataset id) param used by INE endpoints
-        qs['varcd'] = [str(item.remote_id)]
+        qs['varcd'] = [','.join(str(i) for i in ids)]
 
         new_query = urlencode({k: v[0] for k, v in qs.items()})
-        final_url = urlunparse(parsed._replace(query=new_query))
+        return urlunparse(parsed._replace(query=new_query))
 
-        req = requests.get(final_url, headers={'charset': 'utf8'})
-        
-        # Parse content
-        doc = minidom.parseString(req.content)
-        properties = doc.getElementsByTagName('indicator')
-        
-        target = None
-        for propNode in properties:
-            if propNode.hasAttribute('id') and str(propNode.getAttribute('id')) == str(item.remote_id):
-                target = propNode
-                break
-        
-        if not target:
-            # Fallback (though ideally we should find the exact ID)
-            target = properties[0] if properties else None
+    def fetch_details(self, ids):
+        '''
+        Fetch the metadata of the indicators `ids` and return `{id: fields}`.
+
+        Ids are requested by groups of `DETAIL_BATCH_SIZE`; those missing from
+        a group answer are requested one by one, and a single indicator
+        answer without the requested id is used as is.
+        '''
+        details = {}
+        with requests.Session() as session:
+            session.headers['charset'] = 'utf8'
+            for start in range(0, len(ids), self.DETAIL_BATCH_SIZE):
+                batch = ids[start:start + self.DETAIL_BATCH_SIZE]
+                if len(batch) > 1:
+                    try:
+                        req = session.get(self.detail_url(batch))
+                        req.raise_for_status()
+                        found = parse_indicators(req.content)
+                        details.update((i, found[i]) for i in batch if i in found)
+                    except (requests.RequestException, ET.ParseError) as e:
+                        log.warning('INE HVD: grouped detail request failed (%s)', e)
+                for dsId in batch:
+                    if dsId in details:
+                        continue
+                    try:
+                        req = session.get(self.detail_url([dsId]))
+                        found = parse_indicators(req.content)
+                    except (requests.RequestException, ET.ParseError) as e:
+                        log.warning('INE HVD: detail request failed for %s (%s)', dsId, e)
+                        continue
+                    # Fallback (though ideally we should find the exact ID)
+                    fields = found.get(dsId) or next(iter(found.values()), None)
+                    if fields is not None:
+                        details[dsId] = fields
+        log.info('INE HVD: details fetched for %s/%s indicators', len(details), len(ids))
+        return details
+
+    def inner_process_dataset(self, item: HarvestItem, indicator=None, **kwargs):
+        '''
+        Processing a specific item (dataset) from the harvest.
+        Maps the indicator metadata (title, description, tags, etc.), indexed
+        from the catalogue or from the detail requests, to the uData Dataset
+        object, and defines the associated resources (JSON data and metadata).
+        '''
+        dataset = self.get_dataset(item.remote_id)
+        target = indicator
 
         if not target:
             return dataset
 
         # --- Extract Fields ---
 
-        # Helper to get text content from elements
-        def get_text(node_list):
-            if not node_list:
-                return ''
-            node = node_list[0]
-            # Join text nodes and CData sections
-            return ''.join([n.nodeValue or '' for n in node.childNodes if n.nodeType in (n.TEXT_NODE, n.CDATA_SECTION_NODE)]).strip()
-
         # Title
-        dataset.title = get_text(target.getElementsByTagName('title'))
+        dataset.title = target['title']
 
         # Description
-        dataset.description = get_text(target.getElementsByTagName('description'))
+        dataset.description = target['description']
 
         # License (Guessing cc-by as in ine.py)
         dataset.license = License.guess('cc-by')
@@ -125,66 +230,62 @@ class INEHvdBackend(BaseBackend):
         keywordSet = set()
         
         # Keywords
-        kw_text = get_text(target.getElementsByTagName('keywords'))
+        kw_text = target['keywords']
         if kw_text:
             # Split by common separators
             parts = re.split(r'[;,/]|\\s+\\-\\s+|\\s+\\|\\s+', kw_text)
             for p in parts:
                 p = p.strip().strip(',')
                 if p:
-                    keywordSet.add(p.lower())
+                    keywordSet.add(p)
 
         # Theme & Subtheme
         for tagname in ('theme', 'subtheme'):
-            val = get_text(target.getElementsByTagName(tagname))
+            val = target[tagname]
             if val:
-                keywordSet.add(val.lower())
+                keywordSet.add(val)
 
-        dataset.tags = sorted(list(keywordSet))
+        dataset.tags = normalize_tags(keywordSet)
         if 'ine.pt' not in dataset.tags:
             dataset.tags.append('ine.pt')
 
         # Frequency / Periodicity
-        periodicity = get_text(target.getElementsByTagName('periodicity'))
+        periodicity = target['periodicity']
         dataset.frequency = self.map_frequency(periodicity)
 
         # Extras
-        dataset.extras['geo_lastlevel'] = get_text(target.getElementsByTagName('geo_lastlevel'))
-        dataset.extras['source_description'] = get_text(target.getElementsByTagName('source'))
+        dataset.extras['geo_lastlevel'] = target['geo_lastlevel']
+        dataset.extras['source_description'] = target['source']
         
-        dates_node = target.getElementsByTagName('dates')
-        if dates_node:
-            dataset.extras['last_period_available'] = get_text(dates_node[0].getElementsByTagName('last_period_available'))
-            dataset.extras['last_update_remote'] = get_text(dates_node[0].getElementsByTagName('last_update'))
+        if target['has_dates']:
+            dataset.extras['last_period_available'] = target['last_period_available']
+            dataset.extras['last_update_remote'] = target['last_update']
 
-        html_node = target.getElementsByTagName('html')
-        if html_node:
-            dataset.extras['bdd_url'] = get_text(html_node[0].getElementsByTagName('bdd_url'))
+        if target['has_html']:
+            dataset.extras['bdd_url'] = target['bdd_url']
 
         # Resources
         dataset.resources = []
         
-        json_node = target.getElementsByTagName('json')
-        if json_node:
-            # JSON Dataset Resource
-            json_ds_url = get_text(json_node[0].getElementsByTagName('json_dataset'))
-            if json_ds_url:
-                dataset.resources.append(Resource(
-                    title='Dados (JSON)',
-                    url=json_ds_url,
-                    filetype='remote',
-                    mime='application/json'
-                ))
-            
-            # JSON Metainfo Resource
-            json_meta_url = get_text(json_node[0].getElementsByTagName('json_metainfo'))
-            if json_meta_url:
-                dataset.resources.append(Resource(
-                    title='Metainfo (JSON)',
-                    url=json_meta_url,
-                    filetype='remote',
-                    mime='application/json'
-                ))
+        # JSON Dataset Resource
+        json_ds_url = target['json_dataset']
+        if json_ds_url:
+            dataset.resources.append(Resource(
+                title='Dados (JSON)',
+                url=json_ds_url,
+                filetype='remote',
+                mime='application/json'
+            ))
+        
+        # JSON Metainfo Resource
+        json_meta_url = target['json_metainfo']
+        if json_meta_url:
+            dataset.resources.append(Resource(
+                title='Metainfo (JSON)',
+                url=json_meta_url,
+                filetype='remote',
+                mime='application/json'
+            ))
 
         return dataset
 
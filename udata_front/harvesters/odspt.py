@@ -1,5 +1,7 @@
 import mimetypes
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from dateutil.parser import parse as parse_date
 
@@ -7,13 +9,17 @@ from udata.frontend.markdown import parse_html
 from udata.i18n import gettext as _
 from udata.harvest.backends.base import BaseBackend, HarvestFilter, HarvestFeature
 from udata.harvest.exceptions import HarvestSkipException
-from udata.models import License, Resource, Organization
+from udata.models import License, Resource
 from udata.utils import get_by
 
 from urllib.parse import urlparse
 
 from udata.harvest.models import HarvestItem
-from .tools.harvester_utils import normalize_url_slashes
+from .tools.harvester_utils import (
+    HARVEST_FINGERPRINT_KEY, normalize_url_slashes, skip_if_unchanged
+)
+from .tools.organization_resolver import OrganizationResolver
+from .tools.tag_normalizer import normalize_tags, with_tag_stats
 
 def guess_format(mimetype, url=None):
     '''
@@ -41,6 +47,9 @@ def guess_mimetype(mimetype, url=None):
 
 class OdsBackendPT(BaseBackend):
     display_name = 'OpenDataSoft PT'
+    # Version of the payload -> dataset mapping: bump it whenever the mapping
+    # changes so that datasets with an unchanged payload are mapped again
+    MAPPING_VERSION = 2
     verify_ssl = False
     filters = (
         HarvestFilter(_('Tag'), 'tags', str, _('A tag name')),
@@ -57,6 +66,13 @@ class OdsBackendPT(BaseBackend):
         'publisher': 'publisher',
     }
 
+    # Rows requested per search page and number of pages fetched ahead
+    # while the current page is processed (both overridable by the source config)
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 1000
+    PREFETCH_PAGES = 2
+    MAX_PREFETCH_PAGES = 8
+
     # above this records count limit, shapefile export will be disabled
     # since it would be a partial export
     SHAPEFILE_RECORDS_LIMIT = 50000
@@ -100,37 +116,85 @@ class OdsBackendPT(BaseBackend):
     def export_url(self, dataset_id):
         return '{0}?tab=export'.format(self.explore_url(dataset_id))
 
+    def _config_int(self, key, default, maximum):
+        try:
+            value = int(self.config.get(key, default))
+        except (TypeError, ValueError):
+            value = default
+        return max(1, min(value, maximum))
+
+    def get_page_size(self):
+        return self._config_int('page_size', self.PAGE_SIZE, self.MAX_PAGE_SIZE)
+
+    def get_prefetch_pages(self):
+        return self._config_int('prefetch_pages', self.PREFETCH_PAGES, self.MAX_PREFETCH_PAGES)
+
+    def search_params(self, start, rows):
+        params = {
+            'start': start,
+            'rows': rows,
+            'interopmetas': 'true',
+        }
+        for f in self.get_filters():
+            ods_key = self.FILTERS.get(f['key'], f['key'])
+            op = 'exclude' if f.get('type') == 'exclude' else 'refine'
+            key = '.'.join((op, ods_key))
+            param = params.get(key, set())
+            param.add(f['value'])
+            params[key] = param
+        return params
+
+    def fetch_page(self, start, rows):
+        response = self.get(self.api_url, params=self.search_params(start, rows))
+        response.raise_for_status()
+        return response.json()
+
+    def iter_datasets(self):
+        '''
+        Yield the remote datasets in the order of the search results.
+
+        The first page gives `nhits`: the remaining pages are then requested
+        by `start` offset on a thread pool, up to `prefetch_pages` pages ahead
+        of the one being processed. Only `max_items` datasets are requested.
+        A failed page raises, as it would fail the whole harvest anyway.
+        '''
+        page_size = self.get_page_size()
+        rows = min(page_size, self.max_items) if self.max_items else page_size
+        data = self.fetch_page(0, rows)
+        nhits = data['nhits']
+        limit = min(nhits, self.max_items) if self.max_items else nhits
+        for dataset in data['datasets'][:limit]:
+            yield dataset
+        if len(data['datasets']) < rows:
+            return
+
+        offsets = deque(range(rows, limit, page_size))
+        if not offsets:
+            return
+        prefetch = self.get_prefetch_pages()
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=prefetch) as pool:
+            try:
+                while offsets or pending:
+                    while offsets and len(pending) < prefetch:
+                        start = offsets.popleft()
+                        pending.append(pool.submit(self.fetch_page, start, min(page_size, limit - start)))
+                    datasets = pending.popleft().result()['datasets']
+                    for dataset in datasets:
+                        yield dataset
+                    if not datasets:
+                        # The catalogue shrank during the harvest
+                        break
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    @with_tag_stats
     def inner_harvest(self):
-        count = 0
-        nhits = None
-
-        def should_fetch():
-            if nhits is None:
-                return True
-            max_value = min(nhits, self.max_items) if self.max_items else nhits
-            return count < max_value
-
-        while should_fetch():
-            params = {
-                'start': count,
-                'rows': 50,
-                'interopmetas': 'true',
-            }
-            for f in self.get_filters():
-                ods_key = self.FILTERS.get(f['key'], f['key'])
-                op = 'exclude' if f.get('type') == 'exclude' else 'refine'
-                key = '.'.join((op, ods_key))
-                param = params.get(key, set())
-                param.add(f['value'])
-                params[key] = param
-            response = self.get(self.api_url, params=params)
-            response.raise_for_status()
-            data = response.json()
-            nhits = data['nhits']
-            for dataset in data['datasets']:
-                count += 1
-                #self.add_item(dataset['datasetid'], dataset=dataset)
-                self.process_dataset(dataset['datasetid'], dataset=dataset)
+        self.organizations = OrganizationResolver(dryrun=self.dryrun)
+        for dataset in self.iter_datasets():
+            #self.add_item(dataset['datasetid'], dataset=dataset)
+            self.process_dataset(dataset['datasetid'], dataset=dataset)
 
     def inner_process_dataset(self, item: HarvestItem, **kwargs):
         ods_dataset = kwargs.get('dataset')
@@ -146,6 +210,7 @@ class OdsBackendPT(BaseBackend):
             msg = 'Dataset {datasetid} has INSPIRE metadata'
             raise HarvestSkipException(msg.format(**ods_dataset))
 
+        fingerprint = skip_if_unchanged(self, item, ods_dataset)
         dataset = self.get_dataset(item.remote_id)
 
         dataset.title = ods_metadata['title']
@@ -160,17 +225,10 @@ class OdsBackendPT(BaseBackend):
         except KeyError:
             pass
         else:
-            orgObj = Organization.objects(acronym=organization_acronym).first()
-            if orgObj:
-                dataset.organization = orgObj
-            else:
-                orgObj = Organization()
-                orgObj.acronym = organization_acronym
-                orgObj.name = organization_acronym
-                orgObj.description = organization_acronym
-                orgObj.save()
-
-                dataset.organization = orgObj
+            org = self.organizations.get_or_create(organization_acronym)
+            # None in dryrun when the organization does not exist yet
+            if org is not None:
+                dataset.organization = org
 
         tags = set()
         if 'keyword' in ods_metadata:
@@ -182,12 +240,11 @@ class OdsBackendPT(BaseBackend):
         if 'theme' in ods_metadata:
             if isinstance(ods_metadata['theme'], list):
                 for theme in ods_metadata['theme']:
-                    tags.update([t.strip().lower() for t in theme.split(',')])
+                    tags.update(theme.split(','))
             else:
-                themes = ods_metadata['theme'].split(',')
-                tags.update([t.strip().lower() for t in themes])
+                tags.update(ods_metadata['theme'].split(','))
 
-        dataset.tags = list(tags)
+        dataset.tags = normalize_tags(tags)
         dataset.tags.append(urlparse(self.source.url).hostname)
 
         # Detect license
@@ -210,6 +267,7 @@ class OdsBackendPT(BaseBackend):
 
         dataset.extras['ods:url'] = self.explore_url(dataset_id)
         dataset.extras['harvest:name'] = self.source.name
+        dataset.extras[HARVEST_FINGERPRINT_KEY] = fingerprint
         
         if 'references' in ods_metadata:
             dataset.extras['ods:references'] = ods_metadata['references']
@@ -1,13 +1,74 @@
 import logging
+import re
+from urllib.parse import urljoin
+
 import requests
 
+try:
+    import ijson
+except ImportError:
+    # Streaming is disabled, catalogues are parsed with `json`
+    ijson = None
+
 from udata.i18n import gettext as _
 from udata.harvest.backends.base import BaseBackend, HarvestFilter
 from udata.models import Resource, Dataset, License, SpatialCoverage, Organization
 from udata.core.contact_point.models import ContactPoint
 from udata.harvest.models import HarvestItem
 
-from .tools.harvester_utils import normalize_url_slashes
+from .tools.contact_point_resolver import ContactPointResolver
+from .tools.filter_engine import FilterEngine
+from .tools.harvester_utils import (
+    HARVEST_FINGERPRINT_KEY,
+    mark_source_unchanged,
+    normalize_url_slashes,
+    save_job_data,
+    skip_if_unchanged,
+)
+from .tools.http_cache import HTTPValidatorCache
+from .tools.organization_resolver import OrganizationResolver
+from .tools.tag_normalizer import normalize_tags, with_tag_stats
+
+
+# Top-level members of a catalogue page kept while streaming its datasets
+PAGE_MEMBERS = ("provider", "links")
+
+# Entries held back while streaming a page, waiting for its top-level provider
+MAX_DEFERRED_ENTRIES = 100
+
+
+def stream_catalogue(fileobj, page):
+    """
+    Yield the objects of the top-level `dataset` member of the JSON document
+    read from `fileobj`, one at a time, without building the whole document.
+
+    The `PAGE_MEMBERS` found at the top level are stored into `page`, and
+    the top-level keys into `page["@keys"]`.
+    """
+    keys = page.setdefault("@keys", [])
+    builder = root = None
+    for prefix, event, value in ijson.parse(fileobj, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == root and event in ("end_map", "end_array"):
+                if root in PAGE_MEMBERS:
+                    page[root] = builder.value
+                else:
+                    yield builder.value
+                builder = root = None
+            continue
+
+        if prefix == "" and event == "map_key":
+            keys.append(value)
+        elif event in ("start_map", "start_array") and (
+            prefix in PAGE_MEMBERS
+            or (prefix == "dataset.item" and event == "start_map")
+            or (prefix == "dataset" and event == "start_map")
+        ):
+            builder, root = ijson.ObjectBuilder(), prefix
+            builder.event(event, value)
+        elif prefix in PAGE_MEMBERS:
+            page[prefix] = value
 
 
 class OGCBackend(BaseBackend):
@@ -18,6 +79,10 @@ class OGCBackend(BaseBackend):
 
     display_name = "Harvester OGC"
 
+    # Version of the payload -> dataset mapping: bump it whenever the mapping
+    # changes so that datasets with an unchanged payload are mapped again
+    MAPPING_VERSION = 2
+
     # Filtros configuráveis expostos no backoffice para este harvester.
     # Cada filtro é um `HarvestFilter(label, field, type, help_text)` que permite
     # incluir ou excluir datasets com base em campos do metadata.
@@ -29,6 +94,11 @@ class OGCBackend(BaseBackend):
     # Exemplos de configuração (no campo `filters` da fonte):
     #  - {"type": "exclude", "field": "organization", "value": "turismo-de-portugal-ip"}
     #  - {"type": "include", "field": "tags", "value": "climate"}
+    # Os filtros são compilados uma vez por job (ver `tools/filter_engine.py`), que
+    # suporta ainda `match` ('contains', 'exact' ou 'regex'), listas de valores e
+    # grupos AND/OR, p.ex.:
+    #  - {"type": "include", "all": [{"field": "tags", "value": ["clima", "solo"], "match": "exact"},
+    #                                {"field": "organization", "value": "dgt"}]}
     filters = (
         HarvestFilter(
             _("Organization"), "organization", str, _("A OGC Organization name")
@@ -52,6 +122,7 @@ class OGCBackend(BaseBackend):
         Get or create a ContactPoint with the given parameters.
         First checks if a ContactPoint with the same organization exists,
         then falls back to checking by name, email and role.
+        Resolved contact points are cached for the whole job.
 
         Args:
             name: Contact point name
@@ -62,130 +133,182 @@ class OGCBackend(BaseBackend):
         Returns:
             ContactPoint instance (existing or newly created)
         """
-        contact = None
-
-        # First, try to find by organization if provided
-        if organization:
-            contact = ContactPoint.objects(organization=organization, role=role).first()
-
-            if contact:
-                # Update name and email if they changed
-                updated = False
-                if name and contact.name != name:
-                    contact.name = name
-                    updated = True
-                if email and contact.email != email:
-                    contact.email = email
-                    updated = True
-                if updated:
-                    try:
-                        contact.save()
-                        self.logger.debug(
-                            f"Updated ContactPoint for organization {organization.name}: {name}"
-                        )
-                    except Exception as e:
-                        self.logger.warning(
-                            f"Could not update contact point {name}: {e}"
-                        )
-                return contact
-
-        # Fallback: try to find by name, email and role
-        if not contact:
-            query = {"name": name, "role": role}
-            if email:
-                query["email"] = email
-            contact = ContactPoint.objects(**query).first()
-
-        # Create new if not found
-        if not contact:
-            contact = ContactPoint(
-                name=name,
-                email=email,
-                role=role,
-                organization=organization,
-            )
-            try:
-                contact.save()
-                self.logger.info(
-                    f"Created new ContactPoint: {name} (role={role}, org={organization.name if organization else 'None'})"
-                )
-            except Exception as e:
-                self.logger.warning(f"Could not save contact point {name}: {e}")
-                return None
-
-        return contact
+        resolver = getattr(self, "contact_points", None)
+        if resolver is None:
+            resolver = self.contact_points = ContactPointResolver(self.source.organization)
+        return resolver.get_or_create(name, email, role, organization)
 
+    @with_tag_stats
     def inner_harvest(self):
         """
         Fetches OGC API collections (JSON-LD) and enqueues them for processing.
+
+        Catalogue pages are parsed as a stream when `ijson` is installed
+        (unless the source config sets `"stream": false`), so that only one
+        `dataset` object is built at a time. OGC API `next` links are followed.
         """
+        self.organizations = OrganizationResolver(dryrun=self.dryrun)
+        self.contact_points = ContactPointResolver(self.source.organization)
         headers = {"content-type": "application/json", "Accept-Charset": "utf-8"}
+        stream = ijson is not None and self.config.get("stream", True)
 
+        # Filters are compiled once: an invalid filter fails the job
         try:
-            res = requests.get(self.source.url, headers=headers)
-            res.encoding = "utf-8"
-            data = res.json()
-        except Exception as e:
-            msg = f"Error fetching OGC data: {e}"
-            self.logger.error(msg)
-            raise Exception(msg)
-
-        # OGC/Schema.org JSON-LD structure: look for 'dataset' array
-        metadata = data.get("dataset")
-
-        if not metadata:
-            msg = f'Could not find "dataset" in OGC response. Keys found: {list(data.keys())}'
+            self.filter_engine = FilterEngine(self.config.get("filters", []) or [])
+        except (ValueError, re.error) as e:
+            msg = f"Invalid OGC harvest filters: {e}"
             self.logger.error(msg)
             raise Exception(msg)
 
-        # Ensure metadata is always a list
-        if isinstance(metadata, dict):
-            metadata = [metadata]
-
-        # Loop through the metadata and process each dataset
-        for each in metadata:
-            remote_id = each.get("@id")
-
-            if not remote_id:
-                self.logger.warning(
-                    f"Skipping OGC dataset without @id: {each.get('name')}"
-                )
-                continue
-
-            item = {
-                "remote_id": str(remote_id),
-                "title": each.get("name") or "Untitled Dataset",
-                "description": each.get("description") or "",
-                "keywords": each.get("keywords") or [],
-                "distributions": each.get("distribution") or [],
-                "license": each.get("license"),
-                "temporal_coverage": each.get("temporalCoverage"),
-                "provider": each.get("provider") or data.get("provider"),
-            }
-
-            # Apply configurable filters (if any) before processing
-            filters = self.config.get("filters", []) or []
+        # Conditional GET: short-circuit if the catalogue is unchanged
+        http_cache = HTTPValidatorCache.for_backend(self)
+        url = self.source.url
+        seen_urls = set()
+        single_page = False
+        while url and url not in seen_urls:
+            seen_urls.add(url)
             try:
-                if not self._passes_filters(item, filters):
-                    self.logger.debug(
-                        f"Skipping dataset {item.get('remote_id')} due to filters"
-                    )
-                    continue
+                if url == self.source.url:
+                    res = http_cache.fetch(url, headers=headers, stream=True, force=self.dryrun)
+                else:
+                    res = requests.get(url, headers=headers, stream=True, timeout=60)
+                if res.status_code == 304:
+                    self.logger.info(f"OGC catalogue unchanged: {self.source.url}")
+                    if not self.dryrun:
+                        mark_source_unchanged(self.source)
+                    return
+                res.raise_for_status()
             except Exception as e:
-                self.logger.error(
-                    f"Error while applying filters for {item.get('remote_id')}: {e}"
+                msg = f"Error fetching OGC data: {e}"
+                self.logger.error(msg)
+                raise Exception(msg)
+
+            with res:
+                page = {}
+                found = self._harvest_page(res, page, stream)
+
+            if not found and url == self.source.url:
+                msg = f'Could not find "dataset" in OGC response. Keys found: {page.get("@keys", [])}'
+                self.logger.error(msg)
+                raise Exception(msg)
+            if self.has_reached_max_items():
+                break
+            url = self._next_url(url, page.get("links"))
+            if len(seen_urls) == 1:
+                single_page = url is None
+
+        if self.filter_engine:
+            save_job_data(self.job, filters=self.filter_engine.report(self.logger))
+
+        # Validators are only kept for a single page catalogue: a 304 on the
+        # first page says nothing about the following ones
+        if (single_page and not self.dryrun
+                and not any(i.status == "failed" for i in self.job.items)):
+            http_cache.commit(self.source.url)
+
+    def _harvest_page(self, res, page, stream):
+        """
+        Process the `dataset` entries of a catalogue page and return their count.
+
+        `page` receives the top-level `provider` and `links` of the page.
+        When streaming, the first `MAX_DEFERRED_ENTRIES` entries without a
+        provider are held back until the top-level `provider` has been read
+        (it may follow the datasets). Past that bound the page most likely
+        has no provider: deferring stops so that the page is not kept in
+        memory.
+        """
+        if stream:
+            res.raw.decode_content = True
+            datasets = stream_catalogue(res.raw, page)
+        else:
+            res.encoding = "utf-8"
+            data = res.json()
+            page.update(data)
+            page.setdefault("provider", None)
+            page["@keys"] = list(data.keys())
+            datasets = data.get("dataset") or []
+            # Ensure metadata is always a list
+            if isinstance(datasets, dict):
+                datasets = [datasets]
+
+        count = 0
+        deferred = []
+        for each in datasets:
+            count += 1
+            if deferred is not None and not each.get("provider") and "provider" not in page:
+                deferred.append(each)
+                if len(deferred) < MAX_DEFERRED_ENTRIES:
+                    continue
+                self.logger.info(
+                    f"No provider before {len(deferred)} OGC datasets, no longer deferring them"
+                )
+                entries, deferred = deferred, None
+            else:
+                entries = (each,)
+            for entry in entries:
+                self._harvest_entry(entry, page.get("provider"))
+                if self.has_reached_max_items():
+                    return count
+        for each in deferred or ():
+            self._harvest_entry(each, page.get("provider"))
+            if self.has_reached_max_items():
+                break
+        return count
+
+    def _harvest_entry(self, each, default_provider=None):
+        """Map a catalogue `dataset` entry, apply filters and process it."""
+        if not isinstance(each, dict):
+            return
+        remote_id = each.get("@id")
+
+        if not remote_id:
+            self.logger.warning(
+                f"Skipping OGC dataset without @id: {each.get('name')}"
+            )
+            return
+
+        item = {
+            "remote_id": str(remote_id),
+            "title": each.get("name") or "Untitled Dataset",
+            "description": each.get("description") or "",
+            "keywords": each.get("keywords") or [],
+            "distributions": each.get("distribution") or [],
+            "license": each.get("license"),
+            "temporal_coverage": each.get("temporalCoverage"),
+            "provider": each.get("provider") or default_provider,
+        }
+
+        # Apply configurable filters (if any) before processing
+        try:
+            if not self._passes_filters(item):
+                self.logger.debug(
+                    f"Skipping dataset {item.get('remote_id')} due to filters"
                 )
-                # On filter errors, skip the dataset to avoid processing unintended items
-                continue
+                return
+        except Exception as e:
+            self.logger.error(
+                f"Error while applying filters for {item.get('remote_id')}: {e}"
+            )
+            # On filter errors, skip the dataset to avoid processing unintended items
+            return
 
-            self.process_dataset(item["remote_id"], items=item)
+        self.process_dataset(item["remote_id"], items=item)
+
+    @staticmethod
+    def _next_url(url, links):
+        """Return the absolute URL of the OGC API `next` link, if any."""
+        for link in links or []:
+            if isinstance(link, dict) and link.get("rel") == "next" and link.get("href"):
+                return urljoin(url, link["href"])
+        return None
 
     def inner_process_dataset(self, item: HarvestItem, **kwargs):
         """
         Process harvested OGC JSON-LD data into a dataset.
         """
-        dataset = self.get_dataset(item.remote_id)
         item_data = kwargs.get("items")
+        fingerprint = skip_if_unchanged(self, item, item_data)
+        dataset = self.get_dataset(item.remote_id)
 
         # Set basic dataset fields
         dataset.title = item_data["title"]
@@ -199,12 +322,10 @@ class OGCBackend(BaseBackend):
 
         # Add keywords as tags
         keywords = item_data.get("keywords", [])
+        if isinstance(keywords, str):
+            keywords = [keywords]
         if isinstance(keywords, list):
-            for keyword in keywords:
-                if keyword and isinstance(keyword, str):
-                    dataset.tags.append(keyword)
-        elif isinstance(keywords, str) and keywords:
-            dataset.tags.append(keywords)
+            dataset.tags.extend(normalize_tags(keywords))
 
         # Recreate all resources
         dataset.resources = []
@@ -251,6 +372,7 @@ class OGCBackend(BaseBackend):
 
         # Add extra metadata
         dataset.extras["harvest:name"] = self.source.name
+        dataset.extras[HARVEST_FINGERPRINT_KEY] = fingerprint
 
         # License logic
         license_url = item_data.get("license")
@@ -277,18 +399,14 @@ class OGCBackend(BaseBackend):
             # If no organization on the dataset, try to find by provider name
             if not organization and publisher_name:
                 # Try to find organization by name or acronym
-                organization = Organization.objects(name__iexact=publisher_name).first()
-                if not organization:
-                    organization = Organization.objects(
-                        acronym__iexact=publisher_name
-                    ).first()
+                organization = self.organizations.get(
+                    publisher_name, by_name=True
+                ) or self.organizations.get(publisher_name)
 
                 # Try to extract acronym from "ACRONYM - Name" format
                 if not organization and " - " in publisher_name:
                     possible_acronym = publisher_name.split(" - ")[0]
-                    organization = Organization.objects(
-                        acronym__iexact=possible_acronym
-                    ).first()
+                    organization = self.organizations.get(possible_acronym)
 
             # First create a contact point with role="contact" if email is available
             contact_email = provider.get("contactPoint", {}).get("email")
@@ -322,130 +440,20 @@ class OGCBackend(BaseBackend):
 
         return dataset
 
-    def _normalize_val(self, value):
-        """Normalize a value for comparisons (lowercased string)."""
-        if value is None:
-            return ""
-        if isinstance(value, (list, tuple)):
-            # flatten to a comma-separated string
-            return ",".join([str(v).strip().lower() for v in value if v is not None])
-        return str(value).strip().lower()
-
-    def _normalize_filter(self, f):
-        """Turn a filter spec (dict/tuple/str) into a normalized dict.
-
-        Expected normalized keys: {'type': 'include'|'exclude', 'field': <field>, 'value': <value>}
-        Acceptable input forms:
-        - dict with 'type'/'field'/'value'
-        - tuple/list (type, field, value) or (field, value)
-        - string (interpreted as a tag include)
-        """
-        if isinstance(f, dict):
-            ftype = f.get("type", "include") or "include"
-            field = f.get("field") or f.get("key") or f.get("name")
-            value = f.get("value")
-        elif isinstance(f, (list, tuple)):
-            if len(f) == 3:
-                ftype, field, value = f
-            elif len(f) == 2:
-                ftype = "include"
-                field, value = f
-            else:
-                raise ValueError("Invalid filter tuple/sequence")
-        else:
-            # plain string -> tag include
-            ftype = "include"
-            field = "tags"
-            value = f
-
-        return {
-            "type": str(ftype).strip().lower(),
-            "field": str(field).strip().lower() if field is not None else "",
-            "value": str(value).strip() if value is not None else "",
-        }
-
-    def _matches_filter(self, f, item):
-        """Return True if `item` matches the single normalized filter `f`.
+    def _passes_filters(self, item, filters=None):
+        """Evaluate the filters for a given `item`.
 
-        Supported fields: 'organization' (provider name or id), 'tags' (keywords), 'id' (remote_id), 'title'
-        Matching is case-insensitive and uses substring matching for convenience.
+        Uses the filters compiled for the job (see `tools.filter_engine`),
+        or compiles `filters` when given.
         """
-        field = f.get("field")
-        value = self._normalize_val(f.get("value"))
-        if not value:
-            return False
-
-        # Organization: check provider name / id
-        if field in ("organization", "org", "organization_id"):
-            provider = item.get("provider") or {}
-            if isinstance(provider, dict):
-                provider_name = self._normalize_val(
-                    provider.get("name")
-                    or provider.get("id")
-                    or provider.get("identifier")
-                )
-                return value in provider_name
-            # provider may be a string
-            prov_str = self._normalize_val(provider)
-            return value in prov_str
-
-        # Tags: check keywords
-        if field in ("tag", "tags", "label"):
-            keywords = item.get("keywords") or []
-            if isinstance(keywords, str):
-                keywords = [k.strip() for k in keywords.split(",") if k.strip()]
-            for kw in keywords:
-                if value in self._normalize_val(kw):
-                    return True
-            return False
-
-        # ID: check remote_id
-        if field in ("id", "remote_id", "dataset_id"):
-            remote = self._normalize_val(item.get("remote_id"))
-            return value in remote
-
-        # Title: check title substring
-        if field in ("title",):
-            title = self._normalize_val(item.get("title"))
-            return value in title
-
-        # Fallback: try to look in remote_id or title
-        remote = self._normalize_val(item.get("remote_id"))
-        title = self._normalize_val(item.get("title"))
-        return (value in remote) or (value in title)
-
-    def _passes_filters(self, item, filters):
-        """Evaluate the list of filters for a given `item`.
-
-        - Any matching 'exclude' filter will cause the item to be excluded (returns False).
-        - If one or more 'include' filters are present, the item must match at least one include to pass.
-        - If no include filters are present, and no exclude matches, the item passes.
-        """
-        if not filters:
-            return True
-
-        parsed = [self._normalize_filter(f) for f in filters]
-
-        # Exclude if any exclude filter matches
-        for f in parsed:
-            if f.get("type") == "exclude" and self._matches_filter(f, item):
-                self.logger.debug(
-                    f"Filter exclude matched for {item.get('remote_id')}: {f}"
-                )
-                return False
-
-        # Check include filters (if any)
-        include_filters = [f for f in parsed if f.get("type") == "include"]
-        if include_filters:
-            for f in include_filters:
-                if self._matches_filter(f, item):
-                    return True
-            # No include filters matched
-            self.logger.debug(f"No include filters matched for {item.get('remote_id')}")
-            return False
-
-        # No include filters and no excludes matched => pass
-        return True
+        if filters is not None:
+            return FilterEngine(filters)(item)
+        engine = getattr(self, "filter_engine", None)
+        if engine is None:
+            engine = self.filter_engine = FilterEngine(
+                self.config.get("filters", []) or []
+            )
+        return engine(item)
 
     def _extract_format_from_mime(self, mime_type: str) -> str:
         """
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive batch size controller for bulk writes.
+
+The best `bulk_write` batch size depends on the load of the replica set:
+a size that saturates the primary at night may cause long write stalls
+during the day. `AdaptiveBatchSizer` hill-climbs on the observed write
+throughput (ops/second) and backs off on write errors or slow flushes.
+"""
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveBatchSizer(object):
+    '''
+    Grow or shrink a batch size from the outcome of each flush.
+
+    - while throughput does not degrade by more than `tolerance`,
+      keep moving the size in the current direction (by `step`)
+    - when throughput degrades, reverse direction with a smaller step,
+      so that the size settles around the best value
+    - when the error rate exceeds `max_error_rate` or a flush takes
+      longer than `max_latency` seconds, multiply the size by `backoff`
+
+    The size always stays within [`minimum`, `maximum`].
+    '''
+
+    def __init__(self, initial, minimum, maximum, step=1.5, backoff=0.5,
+                 tolerance=0.1, max_error_rate=0.01, max_latency=30.0):
+        if minimum > maximum:
+            raise ValueError('minimum batch size must not exceed maximum')
+        self.minimum = int(minimum)
+        self.maximum = int(maximum)
+        self.step = step
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.max_error_rate = max_error_rate
+        self.max_latency = max_latency
+        self.size = self._clamp(initial)
+        self.current_step = step
+        self.direction = 1
+        self.last_rate = None
+        self.flushes = 0
+        self.total_ops = 0
+        self.total_seconds = 0.0
+        self.total_errors = 0
+
+    def _clamp(self, size):
+        return max(self.minimum, min(self.maximum, int(size)))
+
+    def record(self, ops, seconds, errors=0):
+        '''
+        Record a flush of `ops` operations taking `seconds`, `errors` of which
+        failed, and return the next batch size.
+        '''
+        if ops <= 0:
+            return self.size
+
+        seconds = max(seconds, 1e-6)
+        rate = ops / seconds
+        self.flushes += 1
+        self.total_ops += ops
+        self.total_seconds += seconds
+        self.total_errors += errors
+
+        if errors / ops > self.max_error_rate or seconds > self.max_latency:
+            self.size = self._clamp(self.size * self.backoff)
+            self.current_step = self.step
+            self.direction = -1
+        else:
+            if self.last_rate is not None and rate < self.last_rate * (1 - self.tolerance):
+                self.direction = -self.direction
+                self.current_step = max(self.current_step ** 0.5, 1.05)
+            if self.direction > 0:
+                self.size = self._clamp(self.size * self.current_step)
+            else:
+                self.size = self._clamp(self.size / self.current_step)
+
+        self.last_rate = rate
+        return self.size
+
+    @property
+    def throughput(self):
+        '''Average throughput (ops/second) over all recorded flushes'''
+        if not self.total_seconds:
+            return 0.0
+        return self.total_ops / self.total_seconds
+
+    def summary(self):
+        return {
+            'size': self.size,
+            'flushes': self.flushes,
+            'ops': self.total_ops,
+            'errors': self.total_errors,
+            'ops_per_second': round(self.throughput, 1),
+        }
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Contact point lookup shared by the datasets of a harvest job.
+
+The same few providers appear on every dataset of a catalogue, and
+resolving their contact point used to cost one or two `ContactPoint`
+queries per dataset. `ContactPointResolver` preloads the contact points of
+the source organization in one query and resolves every distinct
+`(name, email, role, organization)` only once per job.
+"""
+import logging
+import threading
+
+from udata.core.contact_point.models import ContactPoint
+
+log = logging.getLogger(__name__)
+
+
+class ContactPointResolver(object):
+    '''
+    Per-job cache of contact points.
+
+    `get_or_create` follows the harvester rules:
+
+    - a contact point with the same organization and role is reused, and its
+      name and email are updated when they changed
+    - otherwise a contact point with the same name, role (and email when
+      given) is reused
+    - otherwise a new contact point is created; if a concurrent job created
+      the same one in the meantime, the oldest is kept
+    '''
+
+    def __init__(self, organization=None):
+        self._lock = threading.Lock()
+        self._resolved = {}
+        self._by_organization = {}
+        self.queries = 0
+        self.created = 0
+        if organization is not None:
+            self.preload(organization)
+
+    def preload(self, organization):
+        '''Load the contact points of `organization` in one query'''
+        self.queries += 1
+        for contact in ContactPoint.objects(organization=organization).order_by('id'):
+            self._by_organization.setdefault((organization.id, contact.role), contact)
+        self._by_organization.setdefault((organization.id, None), None)
+        log.debug('Contact point resolver: %s contact points preloaded',
+                  len(self._by_organization) - 1)
+
+    def _for_organization(self, organization, role):
+        key = (organization.id, role)
+        if key not in self._by_organization:
+            if (organization.id, None) in self._by_organization:
+                # Preloaded organization without a contact point for this role
+                return None
+            self.queries += 1
+            self._by_organization[key] = ContactPoint.objects(
+                organization=organization, role=role
+            ).order_by('id').first()
+        return self._by_organization[key]
+
+    def get_or_create(self, name, email=None, role='contact', organization=None):
+        '''Return the contact point for these attributes (None if it could not be saved)'''
+        key = (name, email, role, organization.id if organization else None)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        with self._lock:
+            if key not in self._resolved:
+                contact = self._resolve(name, email, role, organization)
+                if contact is None:
+                    return None
+                self._resolved[key] = contact
+            return self._resolved[key]
+
+    def _resolve(self, name, email, role, organization):
+        if organization:
+            contact = self._for_organization(organization, role)
+            if contact:
+                # Update name and email if they changed
+                updated = False
+                if name and contact.name != name:
+                    contact.name = name
+                    updated = True
+                if email and contact.email != email:
+                    contact.email = email
+                    updated = True
+                if updated:
+                    try:
+                        contact.save()
+                        log.debug('Updated ContactPoint for organization %s: %s',
+                                  organization.name, name)
+                    except Exception as e:
+                        log.warning('Could not update contact point %s: %s', name, e)
+                return contact
+
+        # Fallback: try to find by name, email and role
+        query = {'name': name, 'role': role}
+        if email:
+            query['email'] = email
+        self.queries += 1
+        contact = ContactPoint.objects(**query).order_by('id').first()
+        if contact:
+            return contact
+
+        return self._create(name, email, role, organization)
+
+    def _create(self, name, email, role, organization):
+        contact = ContactPoint(name=name, email=email, role=role, organization=organization)
+        try:
+            contact.save()
+        except Exception as e:
+            log.warning('Could not save contact point %s: %s', name, e)
+            return None
+        self.created += 1
+        log.info('Created new ContactPoint: %s (role=%s, org=%s)',
+                 name, role, organization.name if organization else 'None')
+
+        # Another job may have created the same contact point concurrently:
+        # keep the oldest one so all jobs converge on it
+        query = {'name': name, 'role': role, 'organization': organization}
+        if email:
+            query['email'] = email
+        oldest = ContactPoint.objects(**query).order_by('id').first()
+        if oldest is not None and oldest.id != contact.id:
+            log.warning('ContactPoint %s created twice, keeping %s', name, oldest.id)
+            contact.delete()
+            self.created -= 1
+            contact = oldest
+
+        if organization:
+            self._by_organization.setdefault((organization.id, role), contact)
+        return contact
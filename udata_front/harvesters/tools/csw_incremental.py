@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental harvesting of CSW catalogues by modification date.
+
+A full harvest pages through the whole catalogue. In incremental mode only
+the records modified since the last successful harvest are requested, with
+an OGC `PropertyIsGreaterThanOrEqualTo` filter on the `Modified` queryable.
+
+The high-water mark is the start date of the last harvest job of the source
+which ended without errors (`job.data['csw_incremental']`), so that records
+of a failed or partial harvest are requested again on the next run.
+Deleted records are only detected by a full sweep: one runs at least every
+`full_sweep_days` days (7 by default, in the source config) and autoarchive
+is skipped on incremental runs, which do not see unmodified records.
+
+Incremental mode is an opt-in source feature: a server silently ignoring the
+`Modified` constraint answers with no matches, so it should only be enabled
+for catalogues known to support it.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from owslib.fes import PropertyIsGreaterThanOrEqualTo
+
+from udata.harvest.models import HarvestJob
+
+log = logging.getLogger(__name__)
+
+INCREMENTAL_KEY = 'csw_incremental'
+FULL_SWEEP_DAYS = 7
+MODIFIED_PROPERTY = 'Modified'
+
+# Margin applied to the high-water mark: catalogues often only store
+# the modification day and their clock may differ from ours
+SAFETY_MARGIN = timedelta(days=1)
+
+
+def _last_job(source, mode=None, statuses=('done',)):
+    query = {'data__{0}__exists'.format(INCREMENTAL_KEY): True}
+    if mode:
+        query['data__{0}__mode'.format(INCREMENTAL_KEY)] = mode
+    return (HarvestJob.objects(source=source, status__in=statuses, **query)
+            .order_by('-created').first())
+
+
+def _full_sweep_days(config):
+    try:
+        return max(0, int(config.get('full_sweep_days', FULL_SWEEP_DAYS)))
+    except (TypeError, ValueError):
+        return FULL_SWEEP_DAYS
+
+
+def start_incremental(backend, enabled=True, now=None):
+    '''
+    Pick the mode of the harvest run by `backend` and record it in the job.
+
+    Returns the datetime from which modified records must be requested,
+    or None for a full sweep (first harvest, incremental mode disabled,
+    or last full sweep older than `full_sweep_days`).
+    '''
+    now = now or datetime.utcnow()
+    since = None
+    if enabled and not backend.max_items:
+        last = _last_job(backend.source)
+        last_full = _last_job(backend.source, mode='full', statuses=('done', 'done-errors'))
+        sweep_days = _full_sweep_days(backend.config)
+        if last is None or last_full is None:
+            log.info('CSW incremental: no previous harvest, running a full sweep')
+        elif now - last_full.data[INCREMENTAL_KEY]['started_at'] >= timedelta(days=sweep_days):
+            log.info('CSW incremental: last full sweep older than %s days, running a full sweep',
+                     sweep_days)
+        else:
+            since = last.data[INCREMENTAL_KEY]['started_at'] - SAFETY_MARGIN
+            log.info('CSW incremental: requesting records modified since %s', since.date())
+
+    backend.incremental_since = since
+    if backend.job is not None:
+        backend.job.data[INCREMENTAL_KEY] = {
+            'mode': 'incremental' if since else 'full',
+            'since': since,
+            'started_at': now,
+        }
+    return since
+
+
+def fall_back_to_full(backend, error):
+    '''Switch the current run to a full sweep (eg. the filter was rejected)'''
+    log.warning('CSW incremental: modification date filter failed (%s), running a full sweep', error)
+    backend.incremental_since = None
+    if backend.job is not None and INCREMENTAL_KEY in backend.job.data:
+        backend.job.data[INCREMENTAL_KEY].update(mode='full', since=None)
+
+
+def modified_constraints(backend):
+    '''`getrecords2` constraints of the current run (empty list for a full sweep)'''
+    since = getattr(backend, 'incremental_since', None)
+    if since is None:
+        return []
+    prop = backend.config.get('modified_property', MODIFIED_PROPERTY)
+    return [PropertyIsGreaterThanOrEqualTo(prop, since.strftime('%Y-%m-%d'))]
+
+
+def is_incremental(backend):
+    return getattr(backend, 'incremental_since', None) is not None
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Harvest filters compiled once per job.
+
+The filters of a source (`source.config['filters']`) are parsed into a
+predicate when the harvest starts, so evaluating them for a dataset only
+compares precomputed lowercased values. Filters apply to harvested item
+dicts with `remote_id`, `title`, `keywords` and `provider` keys.
+
+A filter is a dict (`type`, `field` and `value`), a `(type, field, value)`
+or `(field, value)` sequence, or a plain string (a tag to include):
+
+- `type`: `include` (default) or `exclude`
+- `field`: `organization` (provider name or id), `tags`, `id` or `title`;
+  unknown fields look into the remote id and the title
+- `value`: a string or a list of strings (matching any of them)
+- `match`: `contains` (default, case insensitive substring), `exact`
+  or `regex` (case insensitive search)
+
+Groups combine filters: `{"type": "include", "all": [...]}` matches when
+all of its filters match, `{"any": [...]}` when at least one does.
+
+An item is rejected when any `exclude` filter matches. When `include`
+filters exist, it must also match at least one of them.
+"""
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+FIELD_ALIASES = {
+    'organization': 'organization',
+    'org': 'organization',
+    'organization_id': 'organization',
+    'tag': 'tags',
+    'tags': 'tags',
+    'label': 'tags',
+    'id': 'id',
+    'remote_id': 'id',
+    'dataset_id': 'id',
+    'title': 'title',
+}
+
+MATCH_MODES = ('contains', 'exact', 'regex')
+
+
+def _lower(value):
+    if isinstance(value, str):
+        return value.strip().lower()
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        # flatten to a comma-separated string
+        return ','.join(str(v).strip().lower() for v in value if v is not None)
+    return str(value).strip().lower()
+
+
+# Separator of multi-valued fields searched as a single string:
+# it cannot appear in a filter value
+SEPARATOR = '\x00'
+
+
+def _organization(item):
+    provider = item.get('provider') or {}
+    if isinstance(provider, dict):
+        return (_lower(provider.get('name') or provider.get('id')
+                       or provider.get('identifier')),)
+    # provider may be a string
+    return (_lower(provider),)
+
+
+def _tags(item):
+    keywords = item.get('keywords') or []
+    if isinstance(keywords, str):
+        keywords = [k.strip() for k in keywords.split(',') if k.strip()]
+    return tuple([_lower(kw) for kw in keywords])
+
+
+FIELD_GETTERS = {
+    'organization': _organization,
+    'tags': _tags,
+    'id': lambda item: (_lower(item.get('remote_id')),),
+    'title': lambda item: (_lower(item.get('title')),),
+    'other': lambda item: (_lower(item.get('remote_id')), _lower(item.get('title'))),
+}
+
+
+class ItemFields(dict):
+    '''
+    Lowercased values of an item, computed on first use: `fields[name]` is
+    the tuple of values of a field, `fields[name, 'text']` their joined
+    string (for substring search) and `fields[name, 'set']` their set.
+    '''
+
+    def __init__(self, item):
+        super().__init__()
+        self.item = item
+
+    def __missing__(self, key):
+        if isinstance(key, tuple):
+            name, form = key
+            values = self[name]
+            value = SEPARATOR.join(values) if form == 'text' else frozenset(values)
+        else:
+            value = FIELD_GETTERS[key](self.item)
+        self[key] = value
+        return value
+
+
+class Filter(object):
+    '''A single field filter'''
+
+    def __init__(self, field, values, match='contains'):
+        field_name = FIELD_ALIASES.get(field, 'other')
+        self.label = '{0} {1} {2}'.format(field, match, ','.join(values))
+        self.matched = 0
+        if match == 'regex':
+            patterns = tuple(re.compile(v, re.IGNORECASE) for v in values if v)
+            self.test = lambda fields: any(
+                pattern.search(text) for text in fields[field_name] for pattern in patterns
+            )
+            self.empty = not patterns
+            return
+
+        values = [v for v in (_lower(v) for v in values) if v]
+        self.empty = not values
+        if match == 'exact':
+            key, values = (field_name, 'set'), frozenset(values)
+            self.test = lambda fields: not values.isdisjoint(fields[key])
+        elif len(values) == 1:
+            key, value = (field_name, 'text'), values[0]
+            self.test = lambda fields: value in fields[key]
+        else:
+            key = (field_name, 'text')
+            self.test = lambda fields: any(value in fields[key] for value in values)
+
+    def __call__(self, fields):
+        return not self.empty and self.test(fields)
+
+
+class Group(object):
+    '''Filters combined with `all` (AND) or `any` (OR)'''
+
+    def __init__(self, operator, filters):
+        self.operator = operator
+        self.filters = filters
+        self.matched = 0
+        self.label = '{0}({1})'.format(operator, ', '.join(f.label for f in filters))
+
+    def __call__(self, fields):
+        if self.operator == 'all':
+            return bool(self.filters) and all(f(fields) for f in self.filters)
+        return any(f(fields) for f in self.filters)
+
+
+def _parse(spec):
+    '''Return `(type, compiled filter)` for a filter spec'''
+    if isinstance(spec, dict):
+        ftype = spec.get('type', 'include') or 'include'
+        for operator in ('all', 'any'):
+            if operator in spec:
+                members = spec[operator]
+                if not isinstance(members, (list, tuple)):
+                    raise ValueError('"{0}" filter group must be a list'.format(operator))
+                return ftype, Group(operator, [_parse(member)[1] for member in members])
+        field = spec.get('field') or spec.get('key') or spec.get('name')
+        value = spec.get('value')
+        match = spec.get('match', 'contains') or 'contains'
+    elif isinstance(spec, (list, tuple)):
+        if len(spec) == 3:
+            ftype, field, value = spec
+        elif len(spec) == 2:
+            ftype = 'include'
+            field, value = spec
+        else:
+            raise ValueError('Invalid filter tuple/sequence')
+        match = 'contains'
+    else:
+        # plain string -> tag include
+        ftype, field, value, match = 'include', 'tags', spec, 'contains'
+
+    ftype = str(ftype).strip().lower()
+    match = str(match).strip().lower()
+    if match not in MATCH_MODES:
+        raise ValueError('Unknown filter match "{0}"'.format(match))
+    values = value if isinstance(value, (list, tuple, set)) else [value]
+    values = [str(v).strip() for v in values if v is not None]
+    field = str(field).strip().lower() if field is not None else ''
+    return ftype, Filter(field, values, match)
+
+
+class FilterEngine(object):
+    '''
+    Predicate compiled from a list of filter specs.
+
+    Calling the engine with an item returns whether it passes the filters.
+    Each top-level filter counts the items it matched (`counts`).
+    Invalid specs raise `ValueError` when the engine is built.
+    '''
+
+    def __init__(self, filters):
+        self.includes = []
+        self.excludes = []
+        for spec in filters or []:
+            ftype, compiled = _parse(spec)
+            if ftype == 'exclude':
+                self.excludes.append(compiled)
+            elif ftype == 'include':
+                self.includes.append(compiled)
+            else:
+                raise ValueError('Unknown filter type "{0}"'.format(ftype))
+        self.evaluated = 0
+
+    def __bool__(self):
+        return bool(self.includes or self.excludes)
+
+    def __call__(self, item):
+        if not self:
+            return True
+        self.evaluated += 1
+        fields = ItemFields(item)
+        # Every top-level filter is evaluated so that counts are exact
+        excluded = included = False
+        for compiled in self.excludes:
+            if compiled(fields):
+                compiled.matched += 1
+                excluded = True
+        for compiled in self.includes:
+            if compiled(fields):
+                compiled.matched += 1
+                included = True
+        if excluded:
+            return False
+        return included or not self.includes
+
+    @property
+    def counts(self):
+        '''Match count of each top-level filter, as `{'filter', 'type', 'matched'}` dicts'''
+        return [
+            {'filter': f.label, 'type': ftype, 'matched': f.matched}
+            for ftype, filters in (('exclude', self.excludes), ('include', self.includes))
+            for f in filters
+        ]
+
+    def report(self, logger=None):
+        '''Log the match counts of the filters and return them'''
+        logger = logger or log
+        counts = self.counts
+        for count in counts:
+            logger.info('Filter %s %s matched %s/%s datasets',
+                        count['type'], count['filter'], count['matched'], self.evaluated)
+        return counts
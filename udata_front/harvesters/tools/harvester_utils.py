@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
 import logging
-from datetime import datetime
+from datetime import date, datetime
 from udata.i18n import lazy_gettext as _
 
 from flask import current_app, render_template
@@ -12,54 +14,169 @@ from udata_front import theme
 from udata.models import (
     Dataset, User, Role
 )
+from udata.harvest.exceptions import HarvestSkipException
+from udata.harvest.models import HarvestJob
+from udata.search import reindex
+from udata_front.models import HarvestItemRecord
 
 log = logging.getLogger(__name__)
 
-'''
-Checks for missing datasets in source
-'''
+# Number of unpublished datasets listed in the warning e-mail
+MISSING_DATASETS_PREVIEW = 50
+
+
+def _item_dataset_id(item):
+    # Read the stored reference without dereferencing the dataset
+    return item.to_mongo().get('dataset')
+
+
+# Items whose dataset must not be unpublished: they exist remotely
+KEPT_ITEM_STATUSES = ('failed', 'skipped')
+
+
+def _remote_id(doc):
+    return (doc.get('harvest') or {}).get('remote_id') \
+        or (doc.get('extras') or {}).get('harvest:remote_id')
+
+
 def missing_datasets_warning(job_items, source):
+    """
+    Unpublish the datasets of `source.domain` missing from `job_items`
+    and warn the organization admins by e-mail.
 
-    job_datasets = [item.dataset.id for item in job_items]
+    The public datasets of the domain are loaded as ids only and compared
+    to the job datasets as sets. Datasets of failed or skipped items are
+    kept. The others are unpublished with a single `update_many` and sent
+    to reindexing. The e-mail lists at most `MISSING_DATASETS_PREVIEW` of
+    them and the number of the others. Returns the number of unpublished
+    datasets.
+    """
+    job_datasets = {_item_dataset_id(item) for item in job_items}
+    job_datasets.discard(None)
+    kept_remote_ids = {
+        str(item.remote_id) for item in job_items if item.status in KEPT_ITEM_STATUSES
+    }
 
-    domain_harvested_datasets = Dataset.objects(__raw__={
+    collection = Dataset._get_collection()
+    domain_query = {
         'extras.harvest:domain': source.domain,
         'private': False,
         'deleted': None
-    }).all()
-    
-    missing_datasets = []
-    for dataset in domain_harvested_datasets:
-        if dataset.id not in job_datasets:
-            dataset.private = True
-            missing_datasets.append(dataset)
-            dataset.save()
-    
-    if missing_datasets:
+    }
+    projection = {'_id': 1, 'harvest.remote_id': 1, 'extras.harvest:remote_id': 1}
+    missing_ids = [
+        doc['_id'] for doc in collection.find(domain_query, projection)
+        if doc['_id'] not in job_datasets and _remote_id(doc) not in kept_remote_ids
+    ]
+    if not missing_ids:
+        return 0
+
+    result = collection.update_many(
+        {'_id': {'$in': missing_ids}, 'private': False},
+        {'$set': {'private': True}},
+    )
+    log.info('Source %s: %s missing datasets unpublished', source, result.modified_count)
+    # The raw update skips post_save: unindex the now private datasets
+    for dataset_id in missing_ids:
+        reindex.delay(Dataset.__name__, str(dataset_id))
+
+    missing_datasets = list(Dataset.objects(id__in=missing_ids[:MISSING_DATASETS_PREVIEW]))
+    remaining = len(missing_ids) - len(missing_datasets)
+
+    org_recipients = []
+    if source.organization:
         org_recipients = [ member.user.email for member in source.organization.members if member.role == 'admin' ]
-        admin_role = Role.objects.filter(name='admin').first()
-        recipients = [ user.email for user in User.objects.filter(roles=admin_role).all() ]
+    admin_role = Role.objects.filter(name='admin').first()
+    recipients = [ user.email for user in User.objects.filter(roles=admin_role).all() ]
+
+    #recipients = list(set(org_recipients + recipients))
+
+    subject = 'Relatório harvesting dados.gov - {}.'.format(source)
+
+    context = {
+        'subject': subject,
+        'harvester': source,
+        'datasets': missing_datasets,
+        'server': current_app.config.get('SERVER_NAME')
+    }
 
-        #recipients = list(set(org_recipients + recipients))
+    msg = Message(subject=subject, sender='dados@ama.pt', recipients=org_recipients, cc=['dados@ama.pt'], bcc=recipients)
+    msg.body = theme.render('mail/harvester_warning.txt', **context)
+    msg.html = theme.render('mail/harvester_warning.html', **context)
+    if remaining > 0:
+        # The template only lists the preview
+        more = 'E mais {0} conjuntos de dados despublicados.'.format(remaining)
+        msg.body += '\n\n{0}\n'.format(more)
+        msg.html += '<p>{0}</p>'.format(more)
 
-        subject = 'Relatório harvesting dados.gov - {}.'.format(source)
+    mail = current_app.extensions.get('mail')
+    try:
+        mail.send(msg)
+    except:
+        pass
 
-        context = {
-            'subject': subject,
-            'harvester': source,
-            'datasets': missing_datasets,
-            'server': current_app.config.get('SERVER_NAME')
-        }
+    return len(missing_ids)
 
-        msg = Message(subject=subject, sender='dados@ama.pt', recipients=org_recipients, cc=['dados@ama.pt'], bcc=recipients)
-        msg.body = theme.render('mail/harvester_warning.txt', **context)
-        msg.html = theme.render('mail/harvester_warning.html', **context)
 
-        mail = current_app.extensions.get('mail')
-        try:
-            mail.send(msg)
-        except:
-            pass
+def mark_source_unchanged(source):
+    """
+    Refresh `harvest.last_update` of every dataset harvested by `source`.
+
+    Used when the remote document answered `304 Not Modified`: the harvest
+    short-circuits without items, and the datasets must not look stale to
+    the autoarchive.
+    """
+    result = Dataset._get_collection().update_many(
+        {'harvest.source_id': str(source.id)},
+        {'$set': {'harvest.last_update': datetime.utcnow()}},
+    )
+    log.info('Source %s unchanged, %s datasets refreshed', source, result.modified_count)
+    return result.modified_count
+
+
+def store_harvest_items(job, items):
+    """
+    Bulk insert harvest items of `job` as `HarvestItemRecord`.
+
+    `items` is a list of `(remote_id, dataset_id, status)` tuples. The records
+    are inserted with a single `insert_many` and the job only receives
+    `$inc` on its `data.items` counters, so the cost of a call depends on
+    the number of items, not on the size of the job.
+    """
+    if not job or not items:
+        return 0
+    now = datetime.utcnow()
+    records = []
+    counters = {'data.items.total': len(items)}
+    for remote_id, dataset_id, status in items:
+        record = {'job': job.id, 'remote_id': remote_id, 'status': status, 'created': now}
+        if dataset_id is not None:
+            record['dataset'] = dataset_id
+        records.append(record)
+        key = 'data.items.{0}'.format(status)
+        counters[key] = counters.get(key, 0) + 1
+
+    HarvestItemRecord._get_collection().insert_many(records, ordered=False)
+    HarvestJob._get_collection().update_one({'_id': job.id}, {'$inc': counters})
+    return len(records)
+
+
+def save_job_data(job, **values):
+    """
+    Set `values` in `job.data` and persist them with a single `$set`,
+    without saving the whole job document.
+    """
+    if job is None or not values:
+        return
+    job.data.update(values)
+    if job.pk is None:
+        # Job not saved (eg. dryrun)
+        return
+    HarvestJob._get_collection().update_one(
+        {'_id': job.pk},
+        {'$set': {'data.{0}'.format(key): value for key, value in values.items()}},
+    )
+
 
 def normalize_url_slashes(url: str) -> str:
     """
@@ -77,4 +194,130 @@ def normalize_url_slashes(url: str) -> str:
         parts[1] = re.sub(r'/+', '/', parts[1])
         return "://".join(parts)
     else:
-        return re.sub(r'/+', '/', url)
\ No newline at end of file
+        return re.sub(r'/+', '/', url)
+
+HARVEST_FINGERPRINT_KEY = 'harvest:fingerprint'
+
+
+def _fingerprint_value(value):
+    """
+    Turn a metadata value into a JSON-serializable structure with a stable order.
+    """
+    if isinstance(value, dict):
+        return {str(k): _fingerprint_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_fingerprint_value(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((_fingerprint_value(v) for v in value), key=json.dumps)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if hasattr(value, '__dict__'):
+        # eg. OWSLib objects (bounding boxes)
+        return _fingerprint_value(vars(value))
+    return str(value)
+
+
+def fingerprint_salt(backend) -> str:
+    """
+    Fingerprint salt of `backend`: its class name and `MAPPING_VERSION`.
+
+    Backends bump `MAPPING_VERSION` whenever the way they map a payload to a
+    dataset changes, so that unchanged payloads are mapped again once.
+    """
+    return '{0}:{1}'.format(type(backend).__name__, getattr(backend, 'MAPPING_VERSION', 1))
+
+
+def metadata_fingerprint(metadata: dict, salt: str = '') -> str:
+    """
+    Compute a stable content hash of a harvested metadata dict.
+
+    `salt` should identify the backend and its mapping version (see
+    `fingerprint_salt`) so that two mappings of the same payload never
+    share a fingerprint.
+    """
+    payload = json.dumps(
+        _fingerprint_value(metadata),
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(',', ':'),
+    )
+    return hashlib.sha1(f'{salt}:{payload}'.encode('utf-8')).hexdigest()
+
+
+# Remote ids per `$in` query of `stored_extras`
+STORED_EXTRAS_CHUNK_SIZE = 1000
+
+
+def stored_extras(source, remote_ids, *keys):
+    """
+    Fetch some extras of the datasets harvested by `source`.
+
+    Runs projected queries on the raw collection (no mongoengine document
+    is built), one per `STORED_EXTRAS_CHUNK_SIZE` remote ids so that the
+    query stays well under the BSON document size limit, and returns
+    `{remote_id: (dataset_id, extras)}` where `extras` only holds `keys`.
+
+    Archived datasets are left out: they must go through a full processing,
+    which unarchives them, even when their payload did not change.
+    """
+    remote_ids = [str(rid) for rid in remote_ids]
+    if not remote_ids:
+        return {}
+
+    projection = {'_id': 1, 'harvest.remote_id': 1}
+    projection.update(('extras.' + key, 1) for key in keys)
+    collection = Dataset._get_collection()
+    stored = {}
+    for i in range(0, len(remote_ids), STORED_EXTRAS_CHUNK_SIZE):
+        cursor = collection.find(
+            {
+                'harvest.remote_id': {'$in': remote_ids[i:i + STORED_EXTRAS_CHUNK_SIZE]},
+                '$or': [
+                    {'harvest.domain': source.domain},
+                    {'harvest.source_id': str(source.id)},
+                ],
+                'archived': None,
+                'harvest.archived_at': None,
+            },
+            projection,
+        )
+        for doc in cursor:
+            remote_id = doc['harvest']['remote_id']
+            stored.setdefault(remote_id, (doc['_id'], doc.get('extras') or {}))
+    return stored
+
+
+def stored_fingerprints(source, remote_ids):
+    """
+    Fetch the stored fingerprints of the datasets harvested by `source`.
+
+    Returns `{remote_id: (dataset_id, fingerprint)}`.
+    """
+    return {
+        remote_id: (dataset_id, extras.get(HARVEST_FINGERPRINT_KEY))
+        for remote_id, (dataset_id, extras)
+        in stored_extras(source, remote_ids, HARVEST_FINGERPRINT_KEY).items()
+    }
+
+
+def skip_if_unchanged(backend, item, metadata: dict) -> str:
+    """
+    Fingerprint check for backends processing one item at a time.
+
+    Raise `HarvestSkipException` when the dataset harvested for `item` was
+    built from the same `metadata`, before any dataset is loaded.
+    Otherwise return the fingerprint to store in
+    `dataset.extras[HARVEST_FINGERPRINT_KEY]`.
+    """
+    fingerprint = metadata_fingerprint(metadata, salt=fingerprint_salt(backend))
+    dataset_id, stored = stored_fingerprints(backend.source, [item.remote_id]).get(
+        str(item.remote_id), (None, None)
+    )
+    if stored == fingerprint:
+        item.dataset = dataset_id
+        raise HarvestSkipException(
+            'Dataset {0} unchanged since last harvest'.format(item.remote_id)
+        )
+    return fingerprint
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of HTTP validators (ETag / Last-Modified) for harvest sources.
+
+Harvesters fetch their source document through `HTTPValidatorCache.fetch`,
+which sends `If-None-Match` / `If-Modified-Since` when validators from a
+previous successful harvest are known. A `304 Not Modified` answer means
+the remote catalogue did not change and the harvest can short-circuit.
+
+Validators are only persisted by `commit`, once the document has been fully
+processed, so that a failed harvest is never skipped on the next run.
+"""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+
+import requests
+from flask import current_app
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = '/tmp/udata-harvest-http-cache'
+
+
+def _config(key, default):
+    try:
+        return current_app.config.get(key, default)
+    except RuntimeError:
+        # Outside of an application context
+        return default
+
+
+class HTTPValidatorCache(object):
+    '''
+    Conditional GET helper keyed by URL (and `namespace`, see `for_backend`).
+
+    Each URL has a small JSON entry holding its validators and statistics
+    (number of 304 answers and bytes saved). With `keep_body=True` the
+    response body is stored alongside, for small documents that must be
+    reused on a 304 (eg. identifier lists).
+    '''
+
+    def __init__(self, directory=None, enabled=None, namespace=''):
+        if directory is None:
+            directory = _config('HARVEST_HTTP_CACHE_DIR', DEFAULT_CACHE_DIR)
+        if enabled is None:
+            enabled = _config('HARVEST_HTTP_CACHE_ENABLED', True)
+        self.directory = directory
+        self.enabled = enabled
+        self.namespace = namespace
+        self._pending = {}
+
+    @classmethod
+    def for_backend(cls, backend, **kwargs):
+        '''
+        Cache of the harvests run by `backend`.
+
+        Entries are also keyed by the backend class, its `MAPPING_VERSION`,
+        its `max_items` and its source config, so that a harvest with another
+        configuration is never short-circuited by a 304.
+        '''
+        config = json.dumps(
+            [getattr(backend, 'config', None) or {}, getattr(backend, 'max_items', None)],
+            sort_keys=True,
+            default=str,
+        )
+        namespace = '{0}:{1}:{2}'.format(
+            type(backend).__name__,
+            getattr(backend, 'MAPPING_VERSION', 1),
+            hashlib.sha1(config.encode('utf-8')).hexdigest(),
+        )
+        return cls(namespace=namespace, **kwargs)
+
+    def _path(self, url, ext):
+        if self.namespace:
+            url = '{0}|{1}'.format(self.namespace, url)
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{0}.{1}'.format(key, ext))
+
+    def load(self, url):
+        '''Return the cache entry of `url` (empty dict if unknown)'''
+        try:
+            with open(self._path(url, 'json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, url, entry):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(url, 'json')
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            log.warning('Unable to write HTTP cache entry for %s: %s', url, e)
+
+    def body(self, url):
+        '''Return the stored body of `url` (only with `keep_body=True`)'''
+        try:
+            with open(self._path(url, 'body'), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def fetch(self, url, get=None, keep_body=False, headers=None, force=False, **kwargs):
+        '''
+        Perform a conditional GET on `url`.
+
+        `get` is the callable performing the request (defaults to
+        `requests.get`) and receives `headers` and `kwargs`.
+        With `force=True` the known validators are not sent (eg. when what
+        was built from the previous document has been lost).
+        Returns the response: a `304` status means the document did not change.
+        '''
+        get = get or requests.get
+        headers = dict(headers or {})
+        entry = self.load(url) if self.enabled else {}
+        if force or (keep_body and self.body(url) is None):
+            # Nothing to reuse on a 304: ask for the full document
+            entry = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        response = get(url, headers=headers, **kwargs)
+
+        if response.status_code == 304:
+            entry['not_modified'] = entry.get('not_modified', 0) + 1
+            entry['bytes_saved'] = entry.get('bytes_saved', 0) + entry.get('size', 0)
+            entry['checked_at'] = datetime.utcnow().isoformat()
+            self._save(url, entry)
+            log.info(
+                'HTTP cache: %s not modified (%s bytes saved, %s total over %s runs)',
+                url, entry.get('size', 0), entry['bytes_saved'], entry['not_modified']
+            )
+        elif self.enabled and response.ok:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if etag or last_modified:
+                if kwargs.get('stream'):
+                    size = int(response.headers.get('Content-Length') or 0)
+                else:
+                    size = len(response.content)
+                self._pending[url] = {
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'size': size,
+                }
+        return response
+
+    def commit(self, url, body=None):
+        '''
+        Persist the validators received for `url` once its document has been
+        successfully processed. `body` is stored for `keep_body` fetches.
+        '''
+        pending = self._pending.pop(url, None)
+        if not pending:
+            return
+        entry = self.load(url)
+        entry.update(pending)
+        entry['updated_at'] = datetime.utcnow().isoformat()
+        if body is not None:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self._path(url, 'body'), 'wb') as f:
+                    f.write(body)
+            except OSError as e:
+                log.warning('Unable to write HTTP cache body for %s: %s', url, e)
+                return
+        self._save(url, entry)
+
+    def stats(self, url):
+        '''Statistics of `url`: number of 304 answers and bytes saved'''
+        entry = self.load(url)
+        return {
+            'not_modified': entry.get('not_modified', 0),
+            'bytes_saved': entry.get('bytes_saved', 0),
+        }
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the INE indicators classified as High Value Datasets (HVD).
+
+The ids are persisted in the `hvd_indicator` collection (`HVDIndicator`)
+and shared by the INE and INE HVD harvesters. The registry is refreshed from
+the INE HVD catalogue only when its last refresh is older than
+`HARVEST_HVD_REGISTRY_TTL_HOURS`, with a conditional GET, so most harvests
+classify indicators with a single query and no network call.
+
+Refreshes are incremental: only new ids are inserted and only ids no longer
+listed are removed; the ids known beforehand (`ineDatasets.datasetIds`) are
+kept as the `seed` origin.
+"""
+import logging
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from io import BytesIO
+
+from flask import current_app
+from pymongo import UpdateOne
+
+from udata_front.models import HVDIndicator
+
+from .http_cache import HTTPValidatorCache
+
+log = logging.getLogger(__name__)
+
+HVD_URL = 'https://www.ine.pt/ine/xml_indic_hvd.jsp?opc=3&lang=PT'
+SEED_ORIGIN = 'seed'
+DEFAULT_TTL_HOURS = 24
+
+
+def _ttl():
+    try:
+        hours = current_app.config.get('HARVEST_HVD_REGISTRY_TTL_HOURS', DEFAULT_TTL_HOURS)
+    except RuntimeError:
+        # Outside of an application context
+        hours = DEFAULT_TTL_HOURS
+    return timedelta(hours=hours)
+
+
+def parse_indicator_ids(content):
+    '''Stream-parse the `id` attributes of the `indicator` elements of `content`'''
+    ids = set()
+    context = ET.iterparse(BytesIO(content), events=('start', 'end'))
+    _event, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag == 'indicator':
+            if elem.get('id'):
+                ids.add(elem.get('id'))
+            elem.clear()
+            root.clear()
+    return ids
+
+
+def seed_ids():
+    '''HVD indicator ids known beforehand (`ineDatasets.datasetIds`)'''
+    from ..ineDatasets import datasetIds
+    return set(datasetIds)
+
+
+class HVDRegistry(object):
+    '''
+    Persisted set of HVD indicator ids.
+
+    `ids()` returns a frozenset (O(1) membership), refreshed from `url` when
+    stale. `get` is the callable performing the HTTP request (defaults to
+    `requests.get`, see `HTTPValidatorCache.fetch`).
+    '''
+
+    def __init__(self, url=HVD_URL, ttl=None, get=None, http_cache=None):
+        self.url = url
+        self.ttl = ttl if ttl is not None else _ttl()
+        self.get = get
+        self.http_cache = http_cache or HTTPValidatorCache()
+        self._ids = None
+
+    @property
+    def collection(self):
+        return HVDIndicator._get_collection()
+
+    def _origin_ids(self, origin):
+        return {doc['_id'] for doc in self.collection.find({'origins': origin}, {'_id': 1})}
+
+    def origin_ids(self, origin):
+        '''Ids listed by `origin` and the seed ids, without refreshing the registry'''
+        return self._origin_ids(origin) | seed_ids()
+
+    def last_refresh(self, origin=None):
+        '''Date of the last refresh of `origin` (the registry URL by default)'''
+        doc = self.collection.find_one(
+            {'origins': origin or self.url}, {'last_seen': 1}, sort=[('last_seen', -1)]
+        )
+        return doc['last_seen'] if doc else None
+
+    def is_stale(self, now=None):
+        last = self.last_refresh()
+        return last is None or (now or datetime.utcnow()) - last >= self.ttl
+
+    def ids(self, refresh=True):
+        '''All HVD indicator ids, refreshed first when stale (unless `refresh=False`)'''
+        if refresh and self.is_stale():
+            self.refresh()
+        if self._ids is None:
+            self._ids = frozenset(doc['_id'] for doc in self.collection.find({}, {'_id': 1}))
+        return self._ids
+
+    def __contains__(self, indicator_id):
+        return indicator_id in self.ids()
+
+    def refresh(self):
+        '''
+        Refresh the ids listed by `url` (and the seed ids).
+        On failure the registry is kept as is, even if stale.
+        '''
+        self.seed()
+        known = self._origin_ids(self.url)
+        try:
+            kwargs = {'get': self.get} if self.get else {}
+            resp = self.http_cache.fetch(self.url, force=not known, timeout=30, **kwargs)
+            if resp.status_code == 304:
+                self.update(known, self.url)
+                log.info('HVD registry: %s unchanged, %s ids', self.url, len(known))
+                return
+            resp.raise_for_status()
+            ids = parse_indicator_ids(resp.content)
+        except Exception as e:
+            log.warning('HVD registry: refresh from %s failed, keeping %s ids: %s',
+                        self.url, len(known), e)
+            return
+        self.update(ids, self.url)
+        self.http_cache.commit(self.url)
+
+    def seed(self):
+        '''Record the seed ids'''
+        return self.update(seed_ids(), SEED_ORIGIN)
+
+    def update(self, ids, origin):
+        '''
+        Record that `origin` lists exactly `ids`: new ids are inserted,
+        the others only get their `last_seen` refreshed, and the ids no
+        longer listed by `origin` are removed from it.
+        Returns `(added, removed)` counts.
+        '''
+        now = datetime.utcnow()
+        ids = set(ids)
+        known = self._origin_ids(origin)
+        added = ids - known
+        removed = known - ids
+        collection = self.collection
+        if added:
+            collection.bulk_write([
+                UpdateOne(
+                    {'_id': indicator_id},
+                    {
+                        '$addToSet': {'origins': origin},
+                        '$set': {'last_seen': now},
+                        '$setOnInsert': {'first_seen': now},
+                    },
+                    upsert=True,
+                )
+                for indicator_id in added
+            ], ordered=False)
+        if removed:
+            collection.update_many({'_id': {'$in': list(removed)}}, {'$pull': {'origins': origin}})
+            collection.delete_many({'_id': {'$in': list(removed)}, 'origins': {'$size': 0}})
+        if ids:
+            collection.update_many({'origins': origin}, {'$set': {'last_seen': now}})
+        if added or removed:
+            self._ids = None
+            log.info('HVD registry: %s added, %s removed from %s', len(added), len(removed), origin)
+        return len(added), len(removed)
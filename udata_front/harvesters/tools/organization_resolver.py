@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Organization lookup shared by the harvesters resolving publishers by acronym.
+
+Harvested datasets from a handful of publishers used to run one
+`Organization.objects(acronym=...)` query per dataset. `OrganizationResolver`
+loads every organization in a single projected query when the harvest starts
+and serves lookups from memory for the rest of the job.
+"""
+import logging
+import threading
+
+from udata.models import Organization
+
+log = logging.getLogger(__name__)
+
+
+class OrganizationResolver(object):
+    '''
+    Per-job map of acronyms (and names) to organizations.
+
+    - `get` resolves an acronym (or a name with `by_name=True`) from memory
+      and falls back to a query for organizations created since the preload
+    - `get_or_create` creates missing organizations once per acronym, even
+      when called concurrently, and reuses the oldest organization if another
+      job created the same acronym in the meantime
+    - with `dryrun=True` missing organizations are not created: `get_or_create`
+      returns None, since datasets can't reference an unsaved organization
+    '''
+
+    # Fields loaded for the organizations
+    FIELDS = ('id', 'name', 'acronym', 'slug')
+
+    def __init__(self, dryrun=False, preload=True):
+        self.dryrun = dryrun
+        self._lock = threading.Lock()
+        self._by_acronym = {}
+        self._by_name = {}
+        self._missing = set()
+        self.queries = 0
+        self.created = 0
+        if preload:
+            self.preload()
+
+    @staticmethod
+    def _key(value):
+        return (value or '').strip().lower()
+
+    def _remember(self, org):
+        if org.acronym:
+            self._by_acronym.setdefault(self._key(org.acronym), org)
+            self._missing.discard((False, self._key(org.acronym)))
+        if org.name:
+            self._by_name.setdefault(self._key(org.name), org)
+            self._missing.discard((True, self._key(org.name)))
+
+    def preload(self):
+        '''
+        Load all organizations in one query, projected on the fields the
+        resolver reads. Their changed fields may still be saved.
+        '''
+        self.queries += 1
+        for org in Organization.objects.only(*self.FIELDS).order_by('id'):
+            self._remember(org)
+        log.debug('Organization resolver: %s acronyms preloaded', len(self._by_acronym))
+
+    def get(self, value, by_name=False):
+        '''Return the organization matching `value` (case insensitive) or None'''
+        key = self._key(value)
+        if not key:
+            return None
+        index = self._by_name if by_name else self._by_acronym
+        org = index.get(key)
+        if org is None and (by_name, key) not in self._missing:
+            with self._lock:
+                org = index.get(key)
+                if org is None and (by_name, key) not in self._missing:
+                    org = self._query(value, by_name)
+                    if org is None:
+                        self._missing.add((by_name, key))
+                    else:
+                        self._remember(org)
+        return org
+
+    def _query(self, value, by_name=False):
+        self.queries += 1
+        field = 'name__iexact' if by_name else 'acronym__iexact'
+        return (Organization.objects(**{field: value.strip()})
+                .only(*self.FIELDS).order_by('id').first())
+
+    def get_or_create(self, acronym, name=None, description=None):
+        '''
+        Return the organization with `acronym`, creating it when missing.
+        `name` and `description` default to the acronym.
+        Return None for a missing organization in dryrun.
+        '''
+        org = self.get(acronym)
+        if org is not None:
+            return org
+        with self._lock:
+            key = self._key(acronym)
+            org = self._by_acronym.get(key)
+            if org is not None:
+                return org
+            if self.dryrun:
+                log.info('Organization %s would be created', acronym)
+                return None
+            org = Organization(acronym=acronym, name=name or acronym,
+                               description=description or acronym)
+            org.save()
+            self.created += 1
+            # Another job may have created the same acronym concurrently:
+            # keep the oldest one so all jobs converge on it
+            oldest = (Organization.objects(acronym=acronym)
+                      .only(*self.FIELDS).order_by('id').first())
+            if oldest is not None and oldest.id != org.id:
+                log.warning('Organization %s created twice, keeping %s', acronym, oldest.id)
+                org.delete()
+                self.created -= 1
+                org = oldest
+            self._remember(org)
+            return org
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Resource synchronisation for harvesters.
+
+Harvesters used to rebuild `dataset.resources` from scratch on every run,
+which rewrote the whole list (with new resource ids) even when nothing
+changed. `sync_resources` matches the harvested resources to the existing
+ones by normalised URL, updates the matching resources in place and only
+adds or removes what differs, so unchanged resources produce no write and
+keep their id.
+"""
+from urllib.parse import urlsplit, urlunsplit
+
+from udata.models import Resource
+
+from .harvester_utils import normalize_url_slashes
+
+
+def parse_links(links):
+    '''
+    Parse GeoNetwork `link` values (`name|description|url|protocol|format|...`)
+    into `(url, protocol, format)` tuples.
+
+    `links` may be a single string or a list; malformed links are ignored.
+    '''
+    if not links:
+        return []
+    if isinstance(links, str):
+        links = [links]
+    return [
+        (parts[2], parts[3], parts[4])
+        for parts in (link.split('|', 5) for link in links if isinstance(link, str))
+        if len(parts) >= 5
+    ]
+
+
+def normalize_resource_url(url):
+    '''URL used to match resources: trimmed, single slashes, lowercase scheme and host'''
+    url = normalize_url_slashes((url or '').strip())
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    return urlunsplit(parts._replace(scheme=parts.scheme.lower(), netloc=parts.netloc.lower()))
+
+
+class ResourceDiff(object):
+    '''Outcome of `sync_resources`: lists of resources added, removed, changed and unchanged'''
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.unchanged = []
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def summary(self):
+        return {
+            'added': len(self.added),
+            'removed': len(self.removed),
+            'changed': len(self.changed),
+            'unchanged': len(self.unchanged),
+        }
+
+
+def sync_resources(dataset, specs):
+    '''
+    Make `dataset.resources` match `specs` and return the `ResourceDiff`.
+
+    Each spec is a dict of `Resource` fields with at least an `url`.
+    Existing resources are matched by normalised URL (in order, so repeated
+    URLs match repeated resources) and only their differing fields are set.
+    `dataset.resources` is only reassigned when resources are added,
+    removed or reordered.
+    '''
+    diff = ResourceDiff()
+    existing = {}
+    for resource in dataset.resources:
+        existing.setdefault(normalize_resource_url(resource.url), []).append(resource)
+
+    resources = []
+    for spec in specs:
+        if not spec.get('url'):
+            continue
+        matches = existing.get(normalize_resource_url(spec['url']))
+        if not matches:
+            resource = Resource(**spec)
+            diff.added.append(resource)
+        else:
+            resource = matches.pop(0)
+            changed = False
+            for field, value in spec.items():
+                if getattr(resource, field, None) != value:
+                    setattr(resource, field, value)
+                    changed = True
+            (diff.changed if changed else diff.unchanged).append(resource)
+        resources.append(resource)
+
+    diff.removed = [resource for matches in existing.values() for resource in matches]
+
+    current = list(dataset.resources)
+    if len(resources) != len(current) or any(a is not b for a, b in zip(resources, current)):
+        dataset.resources = resources
+    return diff
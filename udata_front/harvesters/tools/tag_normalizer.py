@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Tag normalisation shared by all harvesters.
+
+Tags are normalised to ASCII slugs: accents and other combining marks are
+removed, the text is lowercased and every run of characters outside
+`[a-z0-9-]` becomes a single dash (eg. "Saúde Pública" -> "saude-publica").
+
+The same few thousand keywords repeat across tens of thousands of datasets,
+so `normalize_tag` is memoised with a bounded LRU cache. Latin characters
+are mapped with a precomputed translation table; only tags with characters
+outside that table go through the full `unicodedata` path.
+"""
+import logging
+import re
+import unicodedata
+from functools import lru_cache, wraps
+
+from .harvester_utils import save_job_data
+
+log = logging.getLogger(__name__)
+
+TAG_CACHE_SIZE = 20000
+
+_NON_ALNUM_DASH_RE = re.compile(r'[^a-z0-9\-]+')
+_MULTI_DASH_RE = re.compile(r'\-+')
+_SLUG_RE = re.compile(r'[a-z0-9\-]*')
+
+
+def _strip_marks(value):
+    nfd = unicodedata.normalize('NFD', value)
+    return ''.join(ch for ch in nfd if unicodedata.category(ch) != 'Mn')
+
+
+def _slow_normalize(tag):
+    tag = _strip_marks(tag).lower()
+    tag = _NON_ALNUM_DASH_RE.sub('-', tag)
+    return _MULTI_DASH_RE.sub('-', tag).strip('-')
+
+
+def _build_table():
+    '''Map ASCII, Latin-1 and Latin Extended-A/B to their slug characters'''
+    table = {}
+    for code in range(0x250):
+        char = chr(code)
+        mapped = _NON_ALNUM_DASH_RE.sub('-', _strip_marks(char).lower())
+        if mapped != char:
+            table[code] = mapped
+    return table
+
+
+_TRANSLATION_TABLE = _build_table()
+
+
+@lru_cache(maxsize=TAG_CACHE_SIZE)
+def normalize_tag(tag):
+    '''Normalise `tag` to an ASCII slug (empty string if nothing is left)'''
+    if not tag:
+        return ''
+    value = tag.translate(_TRANSLATION_TABLE)
+    if not _SLUG_RE.fullmatch(value):
+        # Characters outside of the table: full unicode normalisation
+        return _slow_normalize(tag)
+    return _MULTI_DASH_RE.sub('-', value).strip('-')
+
+
+def normalize_tags(tags):
+    '''Normalise an iterable of tags: sorted, without duplicates nor empty values'''
+    normalized = {normalize_tag(tag) for tag in tags if isinstance(tag, str)}
+    normalized.discard('')
+    return sorted(normalized)
+
+
+def tag_cache_info():
+    '''Snapshot of the cache counters, to compute the hit rate of a harvest'''
+    return normalize_tag.cache_info()
+
+
+def tag_cache_stats(since=None):
+    '''
+    Hits, misses and hit rate of the cache, since the `since` snapshot
+    (from `tag_cache_info`) when given.
+    '''
+    info = normalize_tag.cache_info()
+    hits, misses = info.hits, info.misses
+    if since is not None:
+        hits -= since.hits
+        misses -= since.misses
+    calls = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / calls, 4) if calls else 0.0,
+        'cache_size': info.currsize,
+    }
+
+
+def track_tag_stats(backend):
+    '''Start counting the cache hits of a harvest (call at the start of `inner_harvest`)'''
+    backend.tag_cache_snapshot = tag_cache_info()
+
+
+def report_tag_stats(backend):
+    '''
+    Log the cache statistics of the harvest run by `backend` and store them
+    in the job summary (`job.data['tag_normalizer']`).
+    '''
+    stats = tag_cache_stats(getattr(backend, 'tag_cache_snapshot', None))
+    log.info(
+        'Tag normalisation: %s calls, hit rate %.1f%% (cache size %s)',
+        stats['hits'] + stats['misses'], stats['hit_rate'] * 100, stats['cache_size']
+    )
+    save_job_data(getattr(backend, 'job', None), tag_normalizer=stats)
+    return stats
+
+
+def with_tag_stats(inner_harvest):
+    '''
+    Decorate a backend `inner_harvest` to report its tag statistics when it
+    ends, whatever the outcome (udata does not call `finalize` on backends).
+    '''
+    @wraps(inner_harvest)
+    def wrapper(backend, *args, **kwargs):
+        track_tag_stats(backend)
+        try:
+            return inner_harvest(backend, *args, **kwargs)
+        finally:
+            report_tag_stats(backend)
+    return wrapper
@@ -1,8 +1,11 @@
+from datetime import datetime
+
 from udata.i18n import lazy_gettext as _
 from udata.models import (
     db, Dataset, User, Organization, Reuse, TerritoryDataset,
     TERRITORY_DATASETS
 )
+from udata.harvest.models import HarvestJob
 
 Dataset.extras.register('datagouv_ckan_last_sync', db.DateTimeField)
 Organization.extras.register('datagouv_ckan_last_sync', db.DateTimeField)
@@ -10,6 +13,62 @@ Reuse.extras.register('datagouv_ckan_last_sync', db.DateTimeField)
 User.extras.register('datagouv_ckan_last_sync', db.DateTimeField)
 
 
+# Harvesting
+
+# Harvest item records expire with the harvest jobs
+# (udata's default `HARVEST_JOBS_RETENTION_DAYS`)
+HARVEST_ITEM_RECORD_TTL_DAYS = 365
+
+
+class HarvestItemRecord(db.Document):
+    '''
+    Append-only harvest item, stored outside of the `HarvestJob` document.
+
+    Large harvesters insert these records in bulk, one `insert_many` per
+    chunk, instead of growing the embedded `HarvestJob.items` list.
+    The job only holds the counters in `HarvestJob.data['items']`.
+    Records are removed by a TTL index on `created` after
+    `HARVEST_ITEM_RECORD_TTL_DAYS` days.
+    '''
+    job = db.ReferenceField(HarvestJob, required=True)
+    remote_id = db.StringField()
+    dataset = db.ReferenceField(Dataset)
+    status = db.StringField()
+    created = db.DateTimeField(default=datetime.utcnow, required=True)
+
+    meta = {
+        'collection': 'harvest_item_record',
+        'indexes': [
+            ('job', 'status', '_id'),
+            ('job', '_id'),
+            {
+                'fields': ['created'],
+                'expireAfterSeconds': HARVEST_ITEM_RECORD_TTL_DAYS * 24 * 3600,
+            },
+        ],
+    }
+
+
+class HVDIndicator(db.Document):
+    '''
+    INE indicator classified as High Value Dataset.
+
+    Shared by the INE harvesters through
+    `udata_front.harvesters.tools.hvd_registry.HVDRegistry`.
+    `origins` lists where the indicator was found: the URL of an HVD
+    catalogue or `seed` for the ids known beforehand.
+    '''
+    id = db.StringField(primary_key=True)
+    origins = db.ListField(db.StringField())
+    first_seen = db.DateTimeField(default=datetime.utcnow, required=True)
+    last_seen = db.DateTimeField(default=datetime.utcnow, required=True)
+
+    meta = {
+        'collection': 'hvd_indicator',
+        'indexes': [('origins', '-last_seen')],
+    }
+
+
 # Datasets
 SPD = 'spd'
 TRANSPORT = 'transport'
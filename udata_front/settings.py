@@ -83,3 +83,11 @@ QUALITY_METADATA_BACKEND_IGNORE = []
 
 # Activate mourning style in case of national mourning
 NATIONAL_MOURNING = False
+
+# Harvesting
+# On-disk cache of ETag / Last-Modified validators of harvest source documents:
+# unchanged sources (HTTP 304) are not downloaded nor processed again
+HARVEST_HTTP_CACHE_ENABLED = True
+HARVEST_HTTP_CACHE_DIR = '/tmp/udata-harvest-http-cache'
+# Hours before the INE HVD indicator registry is refreshed from its source
+HARVEST_HVD_REGISTRY_TTL_HOURS = 24
@@ -0,0 +1,95 @@
+import pytest
+
+from udata.core.contact_point.models import ContactPoint
+from udata.core.organization.factories import OrganizationFactory
+
+from udata_front.harvesters.tools.contact_point_resolver import ContactPointResolver
+from udata_front.tests import GouvFrSettings
+
+
+def contact_point(name='Provider', email='provider@example.com', role='contact', organization=None):
+    return ContactPoint(name=name, email=email, role=role, organization=organization).save()
+
+
+class RacingResolver(ContactPointResolver):
+    '''Resolver losing the creation race against another job'''
+
+    def _create(self, name, email, role, organization):
+        self.concurrent = contact_point(name, email, role, organization)
+        return super()._create(name, email, role, organization)
+
+
+@pytest.mark.usefixtures('clean_db')
+class ContactPointResolverTest:
+    settings = GouvFrSettings
+    modules = []
+
+    def test_create_once(self):
+        '''A missing contact point is created once and then served from the cache'''
+        org = OrganizationFactory()
+        resolver = ContactPointResolver(org)
+
+        contact = resolver.get_or_create('Provider', 'provider@example.com', organization=org)
+        queries = resolver.queries
+        again = resolver.get_or_create('Provider', 'provider@example.com', organization=org)
+
+        assert again is contact
+        assert resolver.created == 1
+        assert resolver.queries == queries
+        assert ContactPoint.objects(organization=org).count() == 1
+
+    def test_reuse_organization_contact_point(self):
+        '''The contact point of the organization for the role is reused and updated'''
+        org = OrganizationFactory()
+        existing = contact_point('Old name', 'old@example.com', organization=org)
+        resolver = ContactPointResolver(org)
+
+        contact = resolver.get_or_create('New name', 'new@example.com', organization=org)
+
+        assert contact.id == existing.id
+        assert resolver.created == 0
+        existing.reload()
+        assert existing.name == 'New name'
+        assert existing.email == 'new@example.com'
+
+    def test_preloaded_organization_without_role(self):
+        '''A preloaded organization without a contact point for a role needs no query'''
+        org = OrganizationFactory()
+        resolver = ContactPointResolver(org)
+        queries = resolver.queries
+
+        assert resolver._for_organization(org, 'publisher') is None
+        assert resolver.queries == queries
+
+    def test_reuse_by_name_email_and_role(self):
+        '''Without organization, a contact point with the same attributes is reused'''
+        existing = contact_point()
+        resolver = ContactPointResolver()
+
+        contact = resolver.get_or_create('Provider', 'provider@example.com')
+
+        assert contact.id == existing.id
+        assert resolver.created == 0
+
+    def test_distinct_keys(self):
+        '''Different roles resolve to different contact points'''
+        org = OrganizationFactory()
+        resolver = ContactPointResolver(org)
+
+        contact = resolver.get_or_create('Provider', 'provider@example.com', organization=org)
+        publisher = resolver.get_or_create('Provider', 'provider@example.com', 'publisher', org)
+
+        assert contact.id != publisher.id
+        assert resolver.created == 2
+
+    def test_keep_oldest_on_concurrent_creation(self):
+        '''When another job created the same contact point, the oldest is kept'''
+        org = OrganizationFactory()
+        resolver = RacingResolver(org)
+
+        contact = resolver.get_or_create('Provider', 'provider@example.com', organization=org)
+
+        assert contact.id == resolver.concurrent.id
+        assert resolver.created == 0
+        assert ContactPoint.objects(organization=org).count() == 1
+        assert resolver.get_or_create('Provider', 'provider@example.com', organization=org) is contact
@@ -0,0 +1,137 @@
+import pytest
+
+from udata_front.harvesters.tools.filter_engine import FilterEngine
+
+
+def item(remote_id='id-1', title='A title', keywords=None, provider=None):
+    return {
+        'remote_id': remote_id,
+        'title': title,
+        'keywords': keywords if keywords is not None else [],
+        'provider': provider,
+    }
+
+
+CLIMATE = item('clim-1', 'Climate normals', ['Climate', 'Temperatura'], {'name': 'IPMA'})
+SOIL = item('soil-2', 'Soil map', ['Solo', 'Agricultura'], {'name': 'DGT'})
+WATER = item('water-2024', 'Water quality', 'Água, Ambiente', 'APA')
+ITEMS = [CLIMATE, SOIL, WATER]
+
+
+def passing(filters, items=ITEMS):
+    engine = FilterEngine(filters)
+    return [i['remote_id'] for i in items if engine(i)]
+
+
+class FilterEngineTest:
+    def test_no_filters(self):
+        '''Without filters every item passes'''
+        engine = FilterEngine([])
+        assert not engine
+        assert all(engine(i) for i in ITEMS)
+        assert FilterEngine(None)(CLIMATE)
+
+    def test_include_contains_case_insensitive(self):
+        '''`include` keeps items matching a case insensitive substring'''
+        filters = [{'type': 'include', 'field': 'tags', 'value': 'CLIM'}]
+        assert passing(filters) == ['clim-1']
+
+    def test_includes_are_ored(self):
+        '''An item must match at least one include filter'''
+        filters = [
+            {'field': 'tags', 'value': 'climate'},
+            {'field': 'organization', 'value': 'dgt'},
+        ]
+        assert passing(filters) == ['clim-1', 'soil-2']
+
+    def test_exclude(self):
+        '''`exclude` rejects matching items and keeps the others'''
+        filters = [{'type': 'exclude', 'field': 'organization', 'value': 'ipma'}]
+        assert passing(filters) == ['soil-2', 'water-2024']
+
+    def test_exclude_wins_over_include(self):
+        '''An item matching an exclude filter is rejected even if included'''
+        filters = [
+            {'type': 'include', 'field': 'id', 'value': '-2'},
+            {'type': 'exclude', 'field': 'title', 'value': 'soil'},
+        ]
+        assert passing(filters) == ['water-2024']
+
+    def test_exact(self):
+        '''`exact` compares whole values, case insensitive'''
+        assert passing([{'field': 'tags', 'value': 'clim', 'match': 'exact'}]) == []
+        assert passing([{'field': 'tags', 'value': 'Solo', 'match': 'exact'}]) == ['soil-2']
+
+    def test_regex(self):
+        '''`regex` searches the pattern, case insensitive, without lowercasing it'''
+        assert passing([{'field': 'id', 'value': r'-\d{4}$', 'match': 'regex'}]) == ['water-2024']
+        assert passing([{'field': 'title', 'value': '^SOIL', 'match': 'regex'}]) == ['soil-2']
+        # \D must keep its meaning (non digit), not become \d
+        assert passing([{'field': 'id', 'value': r'^\D+-2$', 'match': 'regex'}]) == ['soil-2']
+
+    def test_list_values_match_any(self):
+        '''A list value matches any of its values (not its string representation)'''
+        filters = [{'field': 'tags', 'value': ['solo', 'água']}]
+        assert passing(filters) == ['soil-2', 'water-2024']
+        assert passing([{'field': 'tags', 'value': "['solo'"}]) == []
+
+    def test_keywords_string(self):
+        '''Comma separated keywords are split into tags'''
+        filters = [{'field': 'tags', 'value': 'ambiente', 'match': 'exact'}]
+        assert passing(filters) == ['water-2024']
+
+    def test_provider_string_and_id(self):
+        '''The organization is the provider name, its id or the provider itself'''
+        by_id = item('x', provider={'id': 'org-42'})
+        assert passing([{'field': 'organization', 'value': 'APA'}]) == ['water-2024']
+        assert passing([{'field': 'org', 'value': 'org-42'}], [by_id]) == ['x']
+
+    def test_unknown_field(self):
+        '''Unknown fields look into the remote id and the title'''
+        assert passing([{'field': 'whatever', 'value': 'quality'}]) == ['water-2024']
+
+    def test_spec_shortcuts(self):
+        '''Plain strings are tag includes, sequences are (type, field, value) or (field, value)'''
+        assert passing(['temperatura']) == ['clim-1']
+        assert passing([('exclude', 'tags', 'solo')]) == ['clim-1', 'water-2024']
+        assert passing([('title', 'water')]) == ['water-2024']
+
+    def test_all_group(self):
+        '''An `all` group matches when all of its filters match'''
+        filters = [{'type': 'include', 'all': [
+            {'field': 'tags', 'value': ['solo', 'clima'], 'match': 'exact'},
+            {'field': 'organization', 'value': 'dgt'},
+        ]}]
+        assert passing(filters) == ['soil-2']
+        assert passing([{'all': []}]) == []
+
+    def test_any_group(self):
+        '''An `any` group matches when one of its filters matches'''
+        filters = [{'type': 'exclude', 'any': [
+            {'field': 'id', 'value': 'clim'},
+            {'field': 'title', 'value': 'water'},
+        ]}]
+        assert passing(filters) == ['soil-2']
+
+    def test_counts(self):
+        '''Each top-level filter counts the items it matched'''
+        engine = FilterEngine([
+            {'type': 'exclude', 'field': 'tags', 'value': 'solo'},
+            {'type': 'include', 'field': 'id', 'value': '-'},
+        ])
+        assert [i['remote_id'] for i in ITEMS if engine(i)] == ['clim-1', 'water-2024']
+        assert engine.evaluated == 3
+        assert [(c['type'], c['matched']) for c in engine.counts] == [
+            ('exclude', 1), ('include', 3)
+        ]
+
+    @pytest.mark.parametrize('spec', [
+        {'type': 'maybe', 'field': 'tags', 'value': 'x'},
+        {'field': 'tags', 'value': 'x', 'match': 'fuzzy'},
+        {'all': 'not a list'},
+        ('too', 'many', 'values', 'here'),
+    ])
+    def test_invalid_specs(self, spec):
+        '''Invalid filters raise ValueError when the engine is built'''
+        with pytest.raises(ValueError):
+            FilterEngine([spec])
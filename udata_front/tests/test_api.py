@@ -1,7 +1,10 @@
 from flask import url_for
 from typing import List
+from udata_front.models import HarvestItemRecord
 from udata_front.tests import GouvFrSettings
-from udata.tests import WebTestMixin
+from udata.core.user.factories import AdminFactory
+from udata.harvest.tests.factories import HarvestJobFactory
+from udata.tests import DBTestMixin, WebTestMixin
 
 import logging
 import pytest
@@ -123,4 +126,45 @@ class ApiTest(WebTestMixin):
         self.assert200(response)
         snippet = response.data.decode('utf8')
         assert style in snippet
-        assert self.captchetat_uuid in snippet
\ No newline at end of file
+        assert self.captchetat_uuid in snippet
+
+
+class HarvestJobItemsApiTest(WebTestMixin, DBTestMixin):
+    settings = GouvFrSettings
+    modules: List[str] = []
+
+    def test_harvest_job_items_paginated(self, api):
+        '''It should list job items from the item store, paginated.'''
+        api.login(AdminFactory())
+        job = HarvestJobFactory(data={'items': {'total': 3, 'done': 2, 'failed': 1}})
+        for i, status in enumerate(['done', 'done', 'failed']):
+            HarvestItemRecord.objects.create(job=job, remote_id=str(i), status=status)
+
+        response = api.get(url_for('apiv2.harvest_job_items', ident=str(job.id),
+                                   page=1, page_size=2))
+        self.assert200(response)
+        assert response.json['total'] == 3
+        assert [item['remote_id'] for item in response.json['data']] == ['0', '1']
+        assert response.json['summary'] == {'total': 3, 'done': 2, 'failed': 1}
+
+        response = api.get(url_for('apiv2.harvest_job_items', ident=str(job.id),
+                                   status='failed'))
+        self.assert200(response)
+        assert response.json['total'] == 1
+        assert response.json['data'][0]['remote_id'] == '2'
+
+    def test_harvest_job_items_unknown_job(self, api):
+        '''It should return a 404 for an unknown or invalid job id.'''
+        api.login(AdminFactory())
+        self.assert404(api.get(url_for('apiv2.harvest_job_items', ident='not-an-id')))
+        self.assert404(api.get(url_for('apiv2.harvest_job_items',
+                                       ident='5b4f5c3c8b4c4b0001a1b2c3')))
+
+    def test_harvest_job_items_permissions(self, api):
+        '''It should only list job items to the source owner or an admin.'''
+        job = HarvestJobFactory()
+        url = url_for('apiv2.harvest_job_items', ident=str(job.id))
+
+        self.assert401(api.get(url))
+        api.login()
+        self.assert403(api.get(url))
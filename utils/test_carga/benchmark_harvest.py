@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+"""
+=============================================================================
+BENCHMARK DE HARVESTERS - uData Front PT
+=============================================================================
+Mede o debito dos backends de harvesting (INE, OGC, DGT, CKAN, CSW) contra
+respostas gravadas, servidas por um servidor HTTP local, e uma base Mongo
+efemera.
+
+Metricas por backend e tamanho de fixture:
+- items/segundo
+- pico de RSS (cada caso corre num processo proprio)
+- round trips ao Mongo por item (pymongo CommandListener)
+- tempo por fase: HTTP, Mongo e parsing/transformacao (restante)
+
+As fixtures reproduzem a estrutura das respostas reais (XML do INE,
+JSON-LD OGC, JSON do GeoNetwork/DGT, API CKAN e CSW 2.0.2) com N items,
+de 100 a 100k.
+
+Requer uma instancia Mongo descartavel (p.ex. `docker run --rm -p 27017:27017
+mongo:6`): o mongomock nao emite eventos de monitorizacao de comandos nem
+implementa toda a semantica de bulk_write/upsert usada pelo INE. A base de
+dados (nome com "benchmark") e apagada antes e depois de cada caso.
+
+Uso:
+    python benchmark_harvest.py
+    python benchmark_harvest.py --backends ine,ogc --sizes 100,1000,10000,100000
+    python benchmark_harvest.py --passes 2   # 2o passo: harvest incremental
+    python benchmark_harvest.py --ci --output results.json --baseline baseline.json
+=============================================================================
+"""
+
+import argparse
+import json
+import multiprocessing
+import re
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+BACKENDS = ("ine", "ogc", "dgt", "ckanpt", "cswudata")
+DEFAULT_SIZES = (100, 1000, 10000)
+DEFAULT_MONGO_URI = "mongodb://localhost:27017/udata_harvest_benchmark"
+
+KEYWORDS = (
+    "População", "Região Autónoma dos Açores", "Economia", "Preços",
+    "Território", "Saúde", "Educação", "Emprego", "Ambiente", "Transportes",
+)
+
+
+# =============================================================================
+# FIXTURES
+# =============================================================================
+
+def _keywords(i, count=4):
+    return [KEYWORDS[(i + k) % len(KEYWORDS)] for k in range(count)]
+
+
+@lru_cache(maxsize=None)
+def ine_catalogue(size):
+    parts = ['<?xml version="1.0" encoding="UTF-8"?><catalog>']
+    for i in range(size):
+        parts.append(
+            f'<indicator id="{i:07d}"><title>Indicador {i}</title>'
+            f'<description>Descricao do indicador {i}</description>'
+            f'<keywords>{escape("; ".join(_keywords(i)))}</keywords>'
+            f'<theme>{escape(KEYWORDS[i % 3])}</theme>'
+            f'<subtheme>{escape(KEYWORDS[i % 7])}</subtheme>'
+            f'<html><bdd_url>https://www.ine.pt/xportal/xmain?xpid=INE&amp;indOcorrCod={i:07d}'
+            f'</bdd_url></html>'
+            f'<json><json_dataset>https://www.ine.pt/ine/json_indicador/pindica.jsp?op=2&amp;'
+            f'varcd={i:07d}</json_dataset>'
+            f'<json_metainfo>https://www.ine.pt/ine/json_indicador/pindicaMeta.jsp?varcd={i:07d}'
+            f'</json_metainfo></json></indicator>'
+        )
+    parts.append("</catalog>")
+    return "".join(parts).encode("utf-8")
+
+
+@lru_cache(maxsize=None)
+def ine_hvd(size):
+    ids = "".join(f'<indicator id="{i:07d}"/>' for i in range(0, size, 10))
+    return f'<?xml version="1.0" encoding="UTF-8"?><catalog>{ids}</catalog>'.encode("utf-8")
+
+
+@lru_cache(maxsize=None)
+def ogc_catalogue(size):
+    datasets = [{
+        "@id": f"https://ogcapi.dgterritorio.gov.pt/collections/col-{i}",
+        "name": f"Colecao {i}",
+        "description": f"Descricao da colecao {i}",
+        "keywords": _keywords(i),
+        "distribution": [
+            {"contentURL": f"https://ogcapi.dgterritorio.gov.pt/collections/col-{i}/items?f=json",
+             "encodingFormat": "application/geo+json", "name": "GeoJSON"},
+            {"contentURL": f"https://ogcapi.dgterritorio.gov.pt/collections/col-{i}",
+             "encodingFormat": "text/html", "name": "HTML"},
+        ],
+        "license": "https://creativecommons.org/licenses/by/4.0/",
+        "temporalCoverage": "2020-01-01/2024-12-31",
+    } for i in range(size)]
+    data = {
+        "@context": "https://schema.org/",
+        "@type": "DataCatalog",
+        "provider": {"name": "DGT", "contactPoint": {"email": "dados@dgterritorio.pt"}},
+        "dataset": datasets,
+    }
+    return json.dumps(data).encode("utf-8")
+
+
+@lru_cache(maxsize=None)
+def dgt_catalogue(size):
+    metadata = [{
+        "geonet:info": {"uuid": f"00000000-0000-0000-0000-{i:012d}"},
+        "defaultTitle": f"Conjunto de dados {i}",
+        "defaultAbstract": f"Resumo do conjunto de dados {i}",
+        "keyword": _keywords(i),
+        "link": [
+            f"Download|Ficheiro CSV|https://snig.dgterritorio.gov.pt/files/{i}.csv|WWW:DOWNLOAD|CSV",
+            f"WMS|Servico WMS|https://snig.dgterritorio.gov.pt/wms/{i}|OGC:WMS|WMS",
+        ],
+    } for i in range(size)]
+    return json.dumps({"@from": "1", "@to": str(size), "metadata": metadata}).encode("utf-8")
+
+
+@lru_cache(maxsize=None)
+def ckan_package_list(size):
+    return json.dumps({"success": True, "result": [f"dataset-{i}" for i in range(size)]}).encode()
+
+
+def ckan_package(name):
+    i = int(name.rsplit("-", 1)[-1])
+    stamp = "2024-01-01T00:00:00"
+    result = {
+        "id": f"00000000-0000-0000-0001-{i:012d}",
+        "name": name,
+        "title": f"Dataset {i}",
+        "notes": f"Descricao do dataset {i}",
+        "license_id": "cc-by",
+        "license_title": "Creative Commons Attribution",
+        "tags": [{"id": f"tag-{k}", "name": tag, "display_name": tag, "state": "active"}
+                 for k, tag in enumerate(_keywords(i))],
+        "metadata_created": stamp,
+        "metadata_modified": stamp,
+        "organization": {
+            "id": "org-benchmark", "description": "Organizacao de benchmark",
+            "created": stamp, "title": "Benchmark", "name": "benchmark",
+            "revision_timestamp": stamp, "is_organization": True, "state": "active",
+            "image_url": "", "revision_id": "r1", "type": "organization",
+            "approval_status": "approved",
+        },
+        "resources": [{
+            "id": f"res-{i}", "position": 0, "name": f"Recurso {i}", "description": "CSV",
+            "format": "CSV", "mimetype": "text/csv", "size": 1024, "hash": None,
+            "created": stamp, "last_modified": stamp,
+            "url": f"https://ckan.example.pt/dataset/{name}/resource/{i}.csv",
+            "resource_type": "file",
+        }],
+        "extras": [],
+        "private": False,
+        "type": "dataset",
+        "author": None,
+        "author_email": None,
+        "maintainer": None,
+        "maintainer_email": None,
+        "state": "active",
+    }
+    return json.dumps({"success": True, "result": result}).encode("utf-8")
+
+
+CSW_NS = (
+    'xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" '
+    'xmlns:dc="http://purl.org/dc/elements/1.1/" '
+    'xmlns:dct="http://purl.org/dc/terms/" '
+    'xmlns:ows="http://www.opengis.net/ows" '
+    'xmlns:ogc="http://www.opengis.net/ogc" '
+    'xmlns:xlink="http://www.w3.org/1999/xlink"'
+)
+
+
+def csw_capabilities(url):
+    operations = "".join(
+        f'<ows:Operation name="{name}"><ows:DCP><ows:HTTP>'
+        f'<ows:Get xlink:href="{url}"/><ows:Post xlink:href="{url}"/>'
+        f'</ows:HTTP></ows:DCP></ows:Operation>'
+        for name in ("GetCapabilities", "DescribeRecord", "GetRecords", "GetRecordById")
+    )
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f'<csw:Capabilities {CSW_NS} version="2.0.2">'
+        f'<ows:ServiceIdentification><ows:Title>Benchmark CSW</ows:Title>'
+        f'<ows:ServiceType>CSW</ows:ServiceType>'
+        f'<ows:ServiceTypeVersion>2.0.2</ows:ServiceTypeVersion></ows:ServiceIdentification>'
+        f'<ows:ServiceProvider><ows:ProviderName>Benchmark</ows:ProviderName></ows:ServiceProvider>'
+        f'<ows:OperationsMetadata>{operations}</ows:OperationsMetadata>'
+        f'<ogc:Filter_Capabilities><ogc:Spatial_Capabilities><ogc:GeometryOperands>'
+        f'<ogc:GeometryOperand>gml:Envelope</ogc:GeometryOperand></ogc:GeometryOperands>'
+        f'<ogc:SpatialOperators><ogc:SpatialOperator name="BBOX"/></ogc:SpatialOperators>'
+        f'</ogc:Spatial_Capabilities><ogc:Scalar_Capabilities><ogc:LogicalOperators/>'
+        f'<ogc:ComparisonOperators><ogc:ComparisonOperator>EqualTo</ogc:ComparisonOperator>'
+        f'</ogc:ComparisonOperators></ogc:Scalar_Capabilities>'
+        f'<ogc:Id_Capabilities><ogc:EID/></ogc:Id_Capabilities></ogc:Filter_Capabilities>'
+        f'</csw:Capabilities>'
+    ).encode("utf-8")
+
+
+def csw_record(i):
+    subjects = "".join(f"<dc:subject>{escape(k)}</dc:subject>" for k in _keywords(i))
+    return (
+        f'<csw:Record><dc:identifier>csw-{i:07d}</dc:identifier>'
+        f'<dc:title>Registo {i}</dc:title><dct:abstract>Resumo do registo {i}</dct:abstract>'
+        f'{subjects}<dc:type>dataset</dc:type>'
+        f'<dct:modified>2024-01-01</dct:modified>'
+        f'<dc:URI protocol="WWW:DOWNLOAD-1.0-http--download" name="registo-{i}.csv" '
+        f'description="CSV">https://csw.example.pt/files/{i}.csv</dc:URI>'
+        f'<ows:BoundingBox crs="urn:ogc:def:crs:EPSG::4326">'
+        f'<ows:LowerCorner>36.9 -9.5</ows:LowerCorner><ows:UpperCorner>42.1 -6.2</ows:UpperCorner>'
+        f'</ows:BoundingBox></csw:Record>'
+    )
+
+
+def csw_records(size, start, count):
+    stop = min(size, start - 1 + count)
+    records = "".join(csw_record(i) for i in range(start - 1, stop))
+    next_record = stop + 1 if stop < size else 0
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f'<csw:GetRecordsResponse {CSW_NS} version="2.0.2">'
+        f'<csw:SearchStatus timestamp="2024-01-01T00:00:00"/>'
+        f'<csw:SearchResults numberOfRecordsMatched="{size}" '
+        f'numberOfRecordsReturned="{max(stop - start + 1, 0)}" elementSet="full" '
+        f'nextRecord="{next_record}">{records}</csw:SearchResults>'
+        f'</csw:GetRecordsResponse>'
+    ).encode("utf-8")
+
+
+def csw_records_by_id(ids):
+    records = "".join(csw_record(int(i.rsplit("-", 1)[-1])) for i in ids if i)
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f'<csw:GetRecordByIdResponse {CSW_NS}>{records}</csw:GetRecordByIdResponse>'
+    ).encode("utf-8")
+
+
+# =============================================================================
+# SERVIDOR HTTP DE FIXTURES
+# =============================================================================
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """
+    Rotas:
+        /ine/<n>.xml, /ine/hvd/<n>.xml, /ogc/<n>.json, /dgt/<n>.json
+        /ckan/<n>/api/3/action/package_list | package_show?id=
+        /csw/<n> (GetCapabilities, GetRecords, GetRecordById)
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k.lower(): v[0] for k, v in parse_qs(url.query).items()}
+        parts = url.path.strip("/").split("/")
+        kind, name = parts[0], parts[-1]
+        if kind == "ine" and parts[1] == "hvd":
+            return self._send(ine_hvd(int(name.split(".")[0])), "application/xml")
+        if kind == "ine":
+            return self._send(ine_catalogue(int(name.split(".")[0])), "application/xml")
+        if kind == "ogc":
+            return self._send(ogc_catalogue(int(name.split(".")[0])), "application/json")
+        if kind == "dgt":
+            return self._send(dgt_catalogue(int(name.split(".")[0])), "application/json")
+        if kind == "ckan" and name == "package_list":
+            return self._send(ckan_package_list(int(parts[1])), "application/json")
+        if kind == "ckan" and name == "package_show":
+            return self._send(ckan_package(query["id"]), "application/json")
+        if kind == "csw":
+            request = query.get("request", "GetCapabilities").lower()
+            if request == "getrecordbyid":
+                return self._send(csw_records_by_id(query.get("id", "").split(",")),
+                                  "application/xml")
+            base = f"http://{self.headers['Host']}{url.path}"
+            return self._send(csw_capabilities(base), "application/xml")
+        self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8")
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if parts[0] == "csw":
+            size = int(parts[1])
+            if "GetRecordById" in body:
+                ids = re.findall(r"<csw:Id>([^<]+)</csw:Id>", body)
+                return self._send(csw_records_by_id(ids), "application/xml")
+            start = int((re.search(r'startPosition="(\d+)"', body) or [0, 1])[1])
+            count = int((re.search(r'maxRecords="(\d+)"', body) or [0, 10])[1])
+            return self._send(csw_records(size, start, count), "application/xml")
+        self.send_error(404)
+
+
+def start_fixture_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def source_url(server_url, backend, size):
+    return {
+        "ine": f"{server_url}/ine/{size}.xml",
+        "ogc": f"{server_url}/ogc/{size}.json",
+        "dgt": f"{server_url}/dgt/{size}.json",
+        "ckanpt": f"{server_url}/ckan/{size}/",
+        "cswudata": f"{server_url}/csw/{size}",
+    }[backend]
+
+
+# =============================================================================
+# MEDICAO (processo filho)
+# =============================================================================
+
+class PhaseTimer:
+    """Acumula tempo e chamadas HTTP (requests) e comandos Mongo (pymongo)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.http_seconds = 0.0
+        self.http_calls = 0
+        self.mongo_seconds = 0.0
+        self.mongo_commands = Counter()
+
+    def install(self):
+        import requests
+        from pymongo import monitoring
+
+        timer = self
+        send = requests.Session.send
+
+        def timed_send(session, request, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return send(session, request, **kwargs)
+            finally:
+                with timer.lock:
+                    timer.http_seconds += time.perf_counter() - t0
+                    timer.http_calls += 1
+
+        requests.Session.send = timed_send
+
+        class Listener(monitoring.CommandListener):
+            def started(self, event):
+                with timer.lock:
+                    timer.mongo_commands[event.command_name] += 1
+
+            def succeeded(self, event):
+                with timer.lock:
+                    timer.mongo_seconds += event.duration_micros / 1e6
+
+            def failed(self, event):
+                with timer.lock:
+                    timer.mongo_seconds += event.duration_micros / 1e6
+
+        # Tem de ser registado antes de criar o MongoClient
+        monitoring.register(Listener())
+
+
+def peak_rss_mb():
+    # ru_maxrss em KB no Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def count_items(job):
+    summary = (job.data or {}).get("items") or {}
+    if summary.get("total"):
+        # Items guardados fora do job (HarvestItemRecord)
+        return summary["total"], summary.get("failed", 0)
+    return len(job.items), sum(1 for item in job.items if item.status == "failed")
+
+
+def drop_benchmark_db(db):
+    if "benchmark" not in db.name:
+        raise RuntimeError(f"Recusado apagar a base '{db.name}' (o nome deve conter 'benchmark')")
+    db.client.drop_database(db.name)
+
+
+def run_case(backend_name, size, passes, server_url, mongo_uri, keep_db, results):
+    timer = PhaseTimer()
+    timer.install()
+
+    from udata.app import create_app, standalone
+
+    settings = type("BenchmarkSettings", (), {
+        "MONGODB_HOST": mongo_uri,
+        "CELERY_TASK_ALWAYS_EAGER": True,
+        "SEARCH_SERVICE_API_URL": None,
+        "HARVEST_HTTP_CACHE_ENABLED": False,
+    })
+    app = standalone(create_app(override=settings))
+
+    with app.app_context():
+        from udata.harvest import backends
+        from udata.harvest.models import HarvestSource
+        from udata.models import Dataset
+
+        db = Dataset._get_db()
+        drop_benchmark_db(db)
+        try:
+            source = HarvestSource.objects.create(
+                name=f"benchmark-{backend_name}-{size}",
+                url=source_url(server_url, backend_name, size),
+                backend=backend_name,
+                description="{}",
+            )
+            backend_cls = backends.get(app, backend_name)
+            if backend_name == "ine":
+                backend_cls.HVD_URL = f"{server_url}/ine/hvd/{size}.xml"
+
+            for run in range(1, passes + 1):
+                timer.reset()
+                t0 = time.perf_counter()
+                backend = backend_cls(source)
+                backend.harvest()
+                seconds = time.perf_counter() - t0
+                job = backend.job
+                job.reload()
+                items, failed = count_items(job)
+                mongo_round_trips = sum(timer.mongo_commands.values())
+                results.put({
+                    "backend": backend_name,
+                    "size": size,
+                    "pass": run,
+                    "status": job.status,
+                    "items": items,
+                    "failed": failed,
+                    "seconds": round(seconds, 3),
+                    "items_per_second": round(items / seconds, 1) if seconds else 0.0,
+                    "peak_rss_mb": round(peak_rss_mb(), 1),
+                    "mongo_round_trips": mongo_round_trips,
+                    "mongo_round_trips_per_item": (
+                        round(mongo_round_trips / items, 2) if items else None
+                    ),
+                    "mongo_commands": dict(timer.mongo_commands),
+                    "http_calls": timer.http_calls,
+                    "phases": {
+                        "http": round(timer.http_seconds, 3),
+                        "mongo": round(timer.mongo_seconds, 3),
+                        "parse_transform": round(
+                            max(seconds - timer.http_seconds - timer.mongo_seconds, 0), 3
+                        ),
+                    },
+                })
+        finally:
+            if not keep_db:
+                drop_benchmark_db(db)
+
+
+def run_isolated(backend_name, size, args, server_url):
+    """Corre um caso num processo novo, para que o pico de RSS seja só dele."""
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(
+        target=run_case,
+        args=(backend_name, size, args.passes, server_url, args.mongo_uri, args.keep_db, results),
+    )
+    process.start()
+    rows = []
+    while process.is_alive() or not results.empty():
+        try:
+            rows.append(results.get(timeout=1))
+        except Exception:
+            pass
+    process.join()
+    if process.exitcode != 0 and len(rows) < args.passes:
+        rows.append({"backend": backend_name, "size": size, "pass": len(rows) + 1,
+                     "status": "crashed", "exitcode": process.exitcode})
+    return rows
+
+
+# =============================================================================
+# RELATORIO
+# =============================================================================
+
+def print_report(rows):
+    header = (f"{'backend':<10} {'n':>7} {'passo':>5} {'estado':<12} {'items':>7} "
+              f"{'s':>8} {'items/s':>9} {'RSS MB':>8} {'mongo/it':>8} "
+              f"{'http s':>8} {'mongo s':>8} {'parse s':>8}")
+    print("\n" + "=" * len(header))
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        if row.get("status") == "crashed":
+            print(f"{row['backend']:<10} {row['size']:>7} {row['pass']:>5} "
+                  f"crashed (exit {row['exitcode']})")
+            continue
+        phases = row["phases"]
+        print(f"{row['backend']:<10} {row['size']:>7} {row['pass']:>5} {row['status']:<12} "
+              f"{row['items']:>7} {row['seconds']:>8.2f} {row['items_per_second']:>9.1f} "
+              f"{row['peak_rss_mb']:>8.1f} {row['mongo_round_trips_per_item'] or 0:>8.2f} "
+              f"{phases['http']:>8.2f} {phases['mongo']:>8.2f} {phases['parse_transform']:>8.2f}")
+    print("=" * len(header))
+
+
+def compare_baseline(rows, baseline_file, max_regression):
+    """Devolve as regressoes de items/s face a um resultado anterior."""
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = {
+            (row["backend"], row["size"], row["pass"]): row
+            for row in json.load(f)["results"] if row.get("items_per_second")
+        }
+    regressions = []
+    for row in rows:
+        previous = baseline.get((row["backend"], row["size"], row["pass"]))
+        if not previous or "items_per_second" not in row:
+            continue
+        ratio = row["items_per_second"] / previous["items_per_second"]
+        if ratio < 1 - max_regression:
+            regressions.append(
+                f"{row['backend']} n={row['size']} passo {row['pass']}: "
+                f"{previous['items_per_second']} -> {row['items_per_second']} items/s "
+                f"({(ratio - 1) * 100:.0f}%)"
+            )
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark dos backends de harvesting contra fixtures locais",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__,
+    )
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        help=f"backends a medir (default: {','.join(BACKENDS)})")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="numero de items por fixture, de 100 a 100000 (default: %(default)s)")
+    parser.add_argument("--passes", type=int, default=1,
+                        help="harvests consecutivos por caso; o 2o mede o caminho incremental")
+    parser.add_argument("--mongo-uri", default=DEFAULT_MONGO_URI,
+                        help="Mongo descartavel; o nome da base tem de conter 'benchmark'")
+    parser.add_argument("--keep-db", action="store_true",
+                        help="nao apagar a base no fim de cada caso")
+    parser.add_argument("--output", "-o", help="guardar resultados em JSON")
+    parser.add_argument("--baseline", help="JSON de uma execucao anterior para comparar")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="queda maxima de items/s face a baseline (default: 0.2 = 20%%)")
+    parser.add_argument("--ci", action="store_true",
+                        help="exit code != 0 em falhas ou regressoes")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    unknown = set(backends) - set(BACKENDS)
+    if unknown:
+        print(f"Backends desconhecidos: {', '.join(sorted(unknown))}")
+        sys.exit(2)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+
+    server, server_url = start_fixture_server()
+    print(f"Fixtures servidas em {server_url}")
+
+    rows = []
+    try:
+        for backend in backends:
+            for size in sizes:
+                print(f"-> {backend} n={size} ...", flush=True)
+                rows.extend(run_isolated(backend, size, args, server_url))
+    except KeyboardInterrupt:
+        print("\nInterrompido.")
+        sys.exit(130)
+    finally:
+        server.shutdown()
+
+    print_report(rows)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": rows}, f,
+                      indent=2)
+        print(f"Resultados guardados em {args.output}")
+
+    failed = [row for row in rows if row.get("status") not in ("done", "done-errors")]
+    regressions = compare_baseline(rows, args.baseline, args.max_regression) if args.baseline else []
+    for regression in regressions:
+        print(f"REGRESSAO: {regression}")
+
+    if args.ci and (failed or regressions):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()